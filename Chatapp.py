@@ -1,18 +1,114 @@
-from flask import Flask, render_template_string, request, session, redirect
-from flask_socketio import SocketIO, send
-import sqlite3, os
+import os
 
-app = Flask(__name__)
+# CHAT_ASYNC_MODE selects the Socket.IO runtime: threading (default), eventlet or gevent.
+# The event-loop modes must patch sockets before anything else is imported. Threads are
+# left unpatched so SQLite work can run on real OS threads (see run_blocking).
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet, eventlet.tpool
+    eventlet.monkey_patch(thread=False)
+elif ASYNC_MODE == 'gevent':
+    import gevent
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+elif ASYNC_MODE != 'threading':
+    raise SystemExit(f'Unsupported CHAT_ASYNC_MODE: {ASYNC_MODE}')
+EVENT_LOOP = ASYNC_MODE != 'threading'
+
+from flask import Flask, render_template, request, session, redirect, jsonify
+from flask_socketio import SocketIO, send, join_room, leave_room, rooms
+from socketio import PubSubManager
+import re, sys, time, json, threading, argparse, subprocess
+from concurrent.futures import ThreadPoolExecutor
+import chat_db as db
+import chat_auth as auth
+import chat_mq
+from web_assets import AssetBundle
+
+# Cross-process broadcast through the local Unix-socket hub in chat_mq.py
+class UnixSocketManager(PubSubManager):
+    name = 'unixsocket'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self._pub = None
+        self._pub_lock = threading.Lock()
+
+    def _publish(self, data):
+        payload = json.dumps(data).encode()
+        with self._pub_lock:
+            try:
+                if self._pub is None:
+                    self._pub = chat_mq.connect(self.path)
+                chat_mq.send_frame(self._pub, payload)
+            except OSError:
+                # Reconnect once in case the hub was restarted
+                if self._pub:
+                    self._pub.close()
+                self._pub = chat_mq.connect(self.path)
+                chat_mq.send_frame(self._pub, payload)
+
+    def _listen(self):
+        while True:
+            try:
+                sock = chat_mq.subscribe(self.path)
+            except OSError:
+                time.sleep(1)
+                continue
+            try:
+                while True:
+                    yield json.loads(chat_mq.recv_frame(sock))
+            except (ConnectionError, OSError):
+                sock.close()
+                time.sleep(1)
+
+# CHAT_MESSAGE_QUEUE selects the broadcast backend shared by all workers:
+# unset for a single process, unix:///path for the local hub, or a redis:// / amqp:// URL.
+def message_queue_options(url):
+    if not url:
+        return {}
+    if url.startswith('unix://'):
+        return {'client_manager': UnixSocketManager(url[len('unix://'):])}
+    return {'message_queue': url}
+
+app = Flask(__name__, static_folder=None)
 app.secret_key = 'supersecretkey'
-socketio = SocketIO(app)
+# socket.io client served from static/ with far-future cache headers, see web_assets.py
+assets = AssetBundle().init_app(app)
+# Event-loop modes only accept WebSocket connections; long-polling would pin a request per client
+socketio = SocketIO(app, async_mode=ASYNC_MODE, transports=['websocket'] if EVENT_LOOP else None,
+                    **message_queue_options(os.environ.get('CHAT_MESSAGE_QUEUE')))
+
+def run_blocking(fn, *args):
+    # SQLite calls block; on an event loop they go to a native thread pool instead
+    if ASYNC_MODE == 'eventlet':
+        return eventlet.tpool.execute(fn, *args)
+    if ASYNC_MODE == 'gevent':
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
 
-# DB init
-def init_db():
-    with sqlite3.connect('chat.db') as conn:
-        conn.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)')
-        conn.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, sender TEXT, content TEXT)')
-        conn.commit()
-init_db()
+# The chat page starts with the newest PAGE_SIZE messages; older ones are fetched from /history
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+ROOM_NAME = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+# Password hashing runs on its own small pool so a burst of logins cannot take every
+# thread; beyond KDF_MAX_PENDING queued hashes new logins are turned away.
+KDF_WORKERS = int(os.environ.get('CHAT_KDF_WORKERS', 2))
+KDF_MAX_PENDING = int(os.environ.get('CHAT_KDF_MAX_PENDING', 32))
+kdf_pool = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix='chat-kdf')
+kdf_slots = threading.BoundedSemaphore(KDF_MAX_PENDING)
+user_cache = auth.TTLCache()
+DUMMY_HASH = auth.hash_password('not a real password')
+
+# Write-behind mode broadcasts first and persists in background group commits.
+# A crash can lose up to CHAT_FLUSH_MAX_DELAY seconds of messages.
+WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+
+db.init_db()
+writer = db.MessageWriter(db.pool, max_delay=float(os.environ.get('CHAT_FLUSH_MAX_DELAY', db.FLUSH_MAX_DELAY))) if WRITE_BEHIND else None
 
 # Templates ( HTML + CSS + JS )
 login_page = '''
@@ -59,69 +155,254 @@ chat_page = '''
         .input-area {display: flex; padding: 10px; border-top: 1px solid #ccc;}
         .input-area input {flex: 1; padding: 10px; border: 1px solid #ccc; border-radius: 4px;}
         .input-area button {padding: 10px 20px; margin-left: 10px; background: #2193b0; color: white; border: none; border-radius: 4px;}
-        .msg {margin-bottom: 15px;}
+        .msg {padding-bottom: 15px;}
         .msg span {display: block;}
         .msg .sender {font-weight: bold; color: #333;}
         .msg .content {margin-top: 5px; padding: 10px; background: #e1f5fe; border-radius: 5px;}
-        .avatar {width: 30px; height: 30px; border-radius: 50%; vertical-align: middle; margin-right: 10px;}
+        .msg .avatar {display: inline-block; width: 30px; height: 30px; line-height: 30px; border-radius: 50%; vertical-align: middle; margin-right: 10px; color: white; text-align: center; font-size: 14px;}
     </style>
 </head>
 <body>
-    <div class="navbar">Logged in as {{username}} | <a href="/logout" style="color: yellow;">Logout</a></div>
+    <div class="navbar">
+        #{{room}} | Logged in as {{username}} | <a href="/logout" style="color: yellow;">Logout</a>
+        <form action="/chat" method="get" style="display: inline;">
+            <input type="text" name="room" placeholder="Switch room" pattern="[A-Za-z0-9_-]{1,32}" size="12"/>
+        </form>
+    </div>
     <div class="chat-container">
         <div class="messages" id="messages">
-            {% for sender, content in msgs %}
-            <div class="msg">
-                <span class="sender"><img src="https://i.pravatar.cc/30?u={{sender}}" class="avatar"/> {{sender}}</span>
-                <span class="content">{{content}}</span>
-            </div>
-            {% endfor %}
+            <button id="load-older" onclick="loadOlder()" style="display: none;">Load older messages</button>
+            <div id="spacer-top"></div>
+            <div id="rows"></div>
+            <div id="spacer-bottom"></div>
+            <button id="jump-latest" onclick="location.reload()" style="display: none;">Jump to latest messages</button>
         </div>
         <div class="input-area">
             <input type="text" id="msg" placeholder="Type a message...">
             <button onclick="sendMessage()">Send</button>
         </div>
     </div>
-<script src="https://cdn.socket.io/4.0.0/socket.io.min.js"></script>
+<script src="{{ asset_url('socket.io.min.js') }}"></script>
 <script>
-    var socket = io();
+    var socket = io({% if websocket_only %}{transports: ["websocket"]}{% endif %});
     var input = document.getElementById("msg");
     var box = document.getElementById("messages");
+    var rowsEl = document.getElementById("rows");
+    var spacerTop = document.getElementById("spacer-top");
+    var spacerBottom = document.getElementById("spacer-bottom");
+    var olderBtn = document.getElementById("load-older");
+    var latestBtn = document.getElementById("jump-latest");
+    var room = "{{room}}";
+
+    // Virtualized list: only rows near the viewport are in the DOM. Row heights are
+    // estimated until a row has been rendered once, then the measured height is kept.
+    var MAX_ITEMS = 5000;
+    var EST_HEIGHT = 70;
+    var OVERSCAN = 400;
+    var items = [];
+    var heights = [];
+    var pending = [];
+    var frameRequested = false;
+    var newestTrimmed = false;
+    var loadingOlder = false;
+    var page = {{ initial|tojson }};
+    var oldestId = page.next_before === null ? null : (page.messages.length ? page.messages[0].id : null);
+
+    function escapeHtml(text) {
+        let div = document.createElement("div");
+        div.textContent = text;
+        return div.innerHTML;
+    }
+
+    // Initial-letter avatar with a colour derived from the name: no requests to an avatar service
+    function avatar(name) {
+        let hue = 0;
+        for (let i = 0; i < name.length; i++) hue = (hue * 31 + name.charCodeAt(i)) % 360;
+        return '<span class="avatar" style="background: hsl(' + hue + ', 55%, 45%);">' + escapeHtml((Array.from(name)[0] || '?').toUpperCase()) + '</span>';
+    }
+
+    function renderMsg(data) {
+        let msgDiv = document.createElement("div");
+        msgDiv.className = "msg";
+        msgDiv.innerHTML = '<span class="sender">' + avatar(data.sender) + ' ' + escapeHtml(data.sender) + '</span><span class="content">' + escapeHtml(data.msg) + '</span>';
+        return msgDiv;
+    }
+
+    function atBottom() {
+        return box.scrollHeight - box.scrollTop - box.clientHeight < 50;
+    }
+
+    function firstKnownId() {
+        for (let i = 0; i < items.length; i++) {
+            if (items[i].id !== null && items[i].id !== undefined) return items[i].id;
+        }
+        return oldestId;
+    }
+
+    function render() {
+        let top = box.scrollTop - OVERSCAN, bottom = box.scrollTop + box.clientHeight + OVERSCAN;
+        let offset = 0, start = items.length, end = items.length;
+        for (let i = 0; i < items.length; i++) {
+            if (start === items.length && offset + heights[i] > top) start = i;
+            if (offset > bottom) { end = i; break; }
+            offset += heights[i];
+        }
+        let before = 0, after = 0;
+        for (let i = 0; i < start; i++) before += heights[i];
+        for (let i = end; i < items.length; i++) after += heights[i];
+
+        let frag = document.createDocumentFragment();
+        for (let i = start; i < end; i++) frag.appendChild(renderMsg(items[i]));
+        rowsEl.replaceChildren(frag);
+        spacerTop.style.height = before + "px";
+        spacerBottom.style.height = after + "px";
+
+        let nodes = rowsEl.children;
+        for (let i = 0; i < nodes.length; i++) heights[start + i] = nodes[i].offsetHeight;
+        olderBtn.style.display = oldestId === null ? "none" : "block";
+        latestBtn.style.display = newestTrimmed ? "block" : "none";
+    }
+
+    function scheduleRender() {
+        if (frameRequested) return;
+        frameRequested = true;
+        requestAnimationFrame(function() {
+            frameRequested = false;
+            let stick = atBottom();
+            if (pending.length && !newestTrimmed) {
+                for (let i = 0; i < pending.length; i++) {
+                    items.push(pending[i]);
+                    heights.push(EST_HEIGHT);
+                }
+                // Cap memory by forgetting the oldest rows; they can be fetched again
+                if (items.length > MAX_ITEMS) {
+                    let drop = items.length - MAX_ITEMS;
+                    items.splice(0, drop);
+                    heights.splice(0, drop);
+                    oldestId = firstKnownId();
+                }
+            }
+            pending = [];
+            render();
+            if (stick) {
+                box.scrollTop = box.scrollHeight;
+                render();
+            }
+        });
+    }
+
+    function prepend(messages) {
+        let added = 0;
+        items = messages.concat(items);
+        heights = messages.map(function() { added += EST_HEIGHT; return EST_HEIGHT; }).concat(heights);
+        if (items.length > MAX_ITEMS) {
+            items.length = MAX_ITEMS;
+            heights.length = MAX_ITEMS;
+            newestTrimmed = true;
+        }
+        return added;
+    }
+
+    function loadOlder() {
+        if (oldestId === null || loadingOlder) return;
+        loadingOlder = true;
+        fetch("/history?room=" + encodeURIComponent(room) + "&before=" + oldestId).then(r => r.json()).then(function(page) {
+            let added = prepend(page.messages);
+            oldestId = page.next_before === null ? null : page.messages[0].id;
+            loadingOlder = false;
+            // Keep the rows the user was looking at in place
+            render();
+            box.scrollTop += added;
+            scheduleRender();
+        }, function() {
+            loadingOlder = false;
+        });
+    }
 
     function sendMessage() {
         let text = input.value.trim();
         if (text !== "") {
-            socket.emit("message", text);
+            socket.emit("message", {room: room, msg: text});
             input.value = "";
         }
     }
 
+    box.addEventListener("scroll", function() {
+        if (box.scrollTop < 200) loadOlder();
+        scheduleRender();
+    }, {passive: true});
+    window.addEventListener("resize", scheduleRender);
+
+    // Re-join after every (re)connect; messages are only delivered to room members
+    socket.on("connect", function() {
+        socket.emit("join", room);
+    });
+
+    // Incoming messages are batched and rendered at most once per animation frame
     socket.on("message", function(data) {
-        let msgDiv = document.createElement("div");
-        msgDiv.className = "msg";
-        msgDiv.innerHTML = '<span class="sender"><img src="https://i.pravatar.cc/30?u=' + data.sender + '" class="avatar"/> ' + data.sender + '</span><span class="content">' + data.msg + '</span>';
-        box.appendChild(msgDiv);
-        box.scrollTop = box.scrollHeight;
+        pending.push(data);
+        scheduleRender();
     });
+
+    pending = page.messages;
+    scheduleRender();
 </script>
 </body>
 </html>
 '''
 
+# Compiled once; render_template_string would parse and compile them again on every request
+login_template = app.jinja_env.from_string(login_page)
+chat_template = app.jinja_env.from_string(chat_page)
+
+def room_arg(value):
+    return value if isinstance(value, str) and ROOM_NAME.match(value) else db.DEFAULT_ROOM
+
+def run_kdf(fn, *args):
+    if not kdf_slots.acquire(blocking=False):
+        return None
+    try:
+        return run_blocking(kdf_pool.submit(fn, *args).result)
+    finally:
+        kdf_slots.release()
+
+def get_user(username):
+    user = user_cache.get(username)
+    if user is None:
+        user = run_blocking(db.get_user, username)
+        if user:
+            user_cache.set(username, user)
+    return user
+
+def current_user():
+    username = session.get('username')
+    return username if username and get_user(username) else None
+
+def history_page(room, before, limit):
+    # Fetch one extra row to know whether an older page exists
+    rows = run_blocking(db.fetch_messages, room, before, limit + 1)
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[1:]
+    msgs = [{'id': i, 'sender': s, 'msg': c, 'ts': t} for i, s, c, t in rows]
+    return {'messages': msgs, 'next_before': msgs[0]['id'] if has_more else None}
+
 # Routes
 @app.route('/')
 def home():
     if 'username' in session:
         return redirect('/chat')
-    return render_template_string(login_page)
+    return render_template(login_template)
 
 @app.route('/register', methods=['POST'])
 def register():
     u, p = request.form['username'], request.form['password']
+    hashed = run_kdf(auth.hash_password, p)
+    if hashed is None:
+        return "Server busy, please try again. <a href='/'>Back</a>", 503
     try:
-        with sqlite3.connect('chat.db') as conn:
-            conn.execute('INSERT INTO users (username, password) VALUES (?,?)', (u, p))
-            conn.commit()
+        run_blocking(db.create_user, u, hashed)
+        user_cache.invalidate(u)
         session['username'] = u
         return redirect('/chat')
     except:
@@ -130,9 +411,19 @@ def register():
 @app.route('/login', methods=['POST'])
 def login():
     u, p = request.form['username'], request.form['password']
-    with sqlite3.connect('chat.db') as conn:
-        user = conn.execute('SELECT * FROM users WHERE username=? AND password=?', (u, p)).fetchone()
-    if user:
+    user = get_user(u)
+    # Unknown users still pay for one hash so response time does not reveal which names exist
+    stored = user[2] if user else DUMMY_HASH
+    ok = run_kdf(auth.verify_password, p, stored)
+    if ok is None:
+        return "Server busy, please try again. <a href='/'>Back</a>", 503
+    if user and ok:
+        if auth.needs_rehash(stored):
+            # Upgrades plaintext rows and hashes made with older cost settings
+            rehashed = run_kdf(auth.hash_password, p)
+            if rehashed:
+                run_blocking(db.update_password, u, rehashed)
+                user_cache.invalidate(u)
         session['username'] = u
         return redirect('/chat')
     return "Login failed. <a href='/'>Try again</a>"
@@ -144,19 +435,86 @@ def logout():
 
 @app.route('/chat')
 def chat():
-    if 'username' not in session:
+    if not current_user():
         return redirect('/')
-    with sqlite3.connect('chat.db') as conn:
-        msgs = conn.execute('SELECT sender, content FROM messages').fetchall()
-    return render_template_string(chat_page, username=session['username'], msgs=msgs)
+    room = room_arg(request.args.get('room'))
+    # The first page is embedded as JSON; the client renders it like any later page
+    initial = history_page(room, None, PAGE_SIZE)
+    return render_template(chat_template, username=session['username'], room=room, initial=initial, websocket_only=EVENT_LOOP)
+
+@app.route('/history')
+def history():
+    if not current_user():
+        return jsonify({'error': 'not logged in'}), 401
+    room = room_arg(request.args.get('room'))
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify(history_page(room, before, limit))
+
+@app.route('/stats')
+def stats():
+    if not current_user():
+        return jsonify({'error': 'not logged in'}), 401
+    return jsonify({'db': db.pool.stats(), 'writer': writer.stats() if writer else None, 'user_cache': user_cache.stats()})
+
+@socketio.on('join')
+def handle_join(room):
+    join_room(room_arg(room))
+
+@socketio.on('leave')
+def handle_leave(room):
+    leave_room(room_arg(room))
 
 @socketio.on('message')
-def handle_msg(msg):
+def handle_msg(data):
+    # Clients send {'room': ..., 'msg': ...}; a bare string goes to the default room
+    if isinstance(data, dict):
+        room, msg = room_arg(data.get('room')), data.get('msg', '')
+    else:
+        room, msg = db.DEFAULT_ROOM, data
+    if room not in rooms():
+        return
     sender = session.get('username', 'Guest')
-    with sqlite3.connect('chat.db') as conn:
-        conn.execute('INSERT INTO messages (sender, content) VALUES (?, ?)', (sender, msg))
-        conn.commit()
-    send({'sender': sender, 'msg': msg}, broadcast=True)
+    ts = time.time()
+    if writer:
+        # The row id is only known after the flush, so write-behind messages go out without one
+        writer.put(room, sender, msg, ts)
+        msg_id = None
+    else:
+        msg_id = run_blocking(db.insert_message, room, sender, msg, ts)
+    # Fan-out is limited to the room's members instead of every connected socket
+    send({'id': msg_id, 'room': room, 'sender': sender, 'msg': msg, 'ts': ts}, to=room)
+
+def run_workers(host, port, workers):
+    # Worker i listens on port + i; put a sticky load balancer in front (see README)
+    env = dict(os.environ)
+    hub = None
+    if not env.get('CHAT_MESSAGE_QUEUE'):
+        hub = chat_mq.start_hub(chat_mq.private_socket_path())
+        env['CHAT_MESSAGE_QUEUE'] = 'unix://' + hub.server_address
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--host', host, '--port', str(port + i)], env=env)
+             for i in range(workers)]
+    try:
+        for proc in procs:
+            proc.wait()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+    finally:
+        if hub:
+            hub.shutdown()
+            hub.server_close()
+            os.rmdir(os.path.dirname(hub.server_address))
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser(description='Realtime chat server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes sharing one message queue')
+    args = parser.parse_args()
+    if writer:
+        writer.close_on_sigterm()  # queued messages are flushed on SIGTERM too, not only on a clean exit
+    if args.workers > 1:
+        run_workers(args.host, args.port, args.workers)
+    else:
+        socketio.run(app, host=args.host, port=args.port)
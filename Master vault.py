@@ -1,70 +1,416 @@
 import os
+import sys
 import json
+import time
+import shutil
+import hashlib
+import argparse
+import struct
 import getpass
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import bcrypt
+import vault_agent
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from vault_common import (VaultSession, SearchIndex, add_cli_commands, atomic_open, calibrate_kdf, check_kdf_params,
+                          derive_key, new_kdf_params, read_fd_lines, remove_backups, run_cli_command, run_parallel,
+                          search_prompt)
 
 VAULT_FILE = "vault.bin"
 NONCE_SIZE = 12
+TAG_SIZE = 16
 MASTER_PASS_COUNT = 5
 
+# Segmented vault format (version 3):
+#   two fixed-size header slots, each MAGIC | u32 length | header JSON | nonce | GCM tag,
+#   then an append-only area of records and index blobs, each nonce + AES-GCM ciphertext.
+# Every entry is its own record and the encrypted index maps usernames to record offsets,
+# so reading or changing one entry never touches the others. A save appends the changed
+# records and a new index, then writes the header into the older slot; a crash before that
+# last write leaves the previous header (and vault) intact.
+# Records, index and header tag use a random data key. The header's "envelope" holds that
+# key and the master password hashes, encrypted with the key derived from the master
+# passwords, so changing the master passwords only rewrites the header slots.
+# Version 2 used the derived key for everything and kept the hashes in the index.
+MAGIC = b"MVLT"
+FORMAT_VERSION = 3
+DATA_KEY_SIZE = 32
+HEADER_SLOT_SIZE = 4096
+DATA_START = 2 * HEADER_SLOT_SIZE
+COMPACT_RATIO = 2  # rewrite the file once it is this many times bigger than its live data
+COMPACT_MIN_SIZE = 1024 * 1024
+# Searchable metadata is kept in the encrypted index so searching never decrypts records;
+# the password and notes stay in each entry's own record
+META_FIELDS = ("url", "tags", "modified")
+LEGACY_KDF = "sha256"
+BACKUP_GENERATIONS = 1  # copies of the previous file kept on full rewrites (vault.bin.bak1, ...)
+
 def hash_password(pw):
     return bcrypt.hashpw(pw.encode(), bcrypt.gensalt())
 
 def check_password(pw, hashed):
     return bcrypt.checkpw(pw.encode(), hashed)
 
-def generate_key(master_passwords):
-    # Derive a 32-byte AES key from concatenated master passwords (simple SHA256 here)
-    import hashlib
-    concat = "".join(master_passwords).encode()
-    return hashlib.sha256(concat).digest()
+def verify_master_passwords(master_passwords, master_hashes):
+    # The bcrypt checks run side by side, so unlocking costs about one bcrypt instead of five
+    if len(master_passwords) != len(master_hashes):
+        return False
+    return all(run_parallel(check_password, [(pw, h.encode()) for pw, h in zip(master_passwords, master_hashes)]))
+
+def hash_master_passwords(master_passwords):
+    return [h.decode() for h in run_parallel(hash_password, [(pw,) for pw in master_passwords])]
+
+def generate_key(master_passwords, kdf=LEGACY_KDF):
+    # Derive a 32-byte AES key with the salted scrypt parameters stored in the vault header.
+    # Vaults from before that still use one unsalted SHA256 over the concatenated passwords.
+    if kdf == LEGACY_KDF:
+        concat = "".join(master_passwords).encode()
+        return hashlib.sha256(concat).digest()
+    return derive_key(master_passwords, kdf)
 
-def encrypt(data, key):
+def encrypt(data, key, aad=None):
     aesgcm = AESGCM(key)
     nonce = os.urandom(NONCE_SIZE)
-    ct = aesgcm.encrypt(nonce, data, None)
+    ct = aesgcm.encrypt(nonce, data, aad)
     return nonce + ct
 
-def decrypt(enc_data, key):
+def decrypt(enc_data, key, aad=None):
     aesgcm = AESGCM(key)
     nonce = enc_data[:NONCE_SIZE]
     ct = enc_data[NONCE_SIZE:]
-    return aesgcm.decrypt(nonce, ct, None)
+    return aesgcm.decrypt(nonce, ct, aad)
+
+def pack_header(header, key):
+    body = json.dumps(header, sort_keys=True).encode()
+    nonce = os.urandom(NONCE_SIZE)
+    tag = AESGCM(key).encrypt(nonce, b"", MAGIC + body)
+    slot = MAGIC + struct.pack(">I", len(body)) + body + nonce + tag
+    if len(slot) > HEADER_SLOT_SIZE:
+        raise ValueError("Vault header too large.")
+    return slot.ljust(HEADER_SLOT_SIZE, b"\0")
+
+def unpack_header(slot, key):
+    # Returns None for an empty, torn or forged slot
+    if len(slot) < 8 or slot[:4] != MAGIC:
+        return None
+    (length,) = struct.unpack(">I", slot[4:8])
+    body = slot[8:8 + length]
+    nonce = slot[8 + length:8 + length + NONCE_SIZE]
+    tag = slot[8 + length + NONCE_SIZE:8 + length + NONCE_SIZE + TAG_SIZE]
+    try:
+        AESGCM(key).decrypt(nonce, tag, MAGIC + body)
+    except (InvalidTag, ValueError):
+        return None
+    return json.loads(body)
+
+def peek_header(slot):
+    # The header JSON without checking its tag; only for picking how to unlock it
+    if len(slot) < 8 or slot[:4] != MAGIC:
+        return None
+    (length,) = struct.unpack(">I", slot[4:8])
+    try:
+        return json.loads(slot[8:8 + length])
+    except ValueError:
+        return None
+
+def envelope_aad(file_id):
+    return file_id + b"envelope"
+
+def wrap_data_key(data_key, master_hashes, kek, file_id):
+    body = json.dumps({"data_key": data_key.hex(), "master_hashes": master_hashes}).encode()
+    return encrypt(body, kek, envelope_aad(file_id)).hex()
+
+def unwrap_data_key(envelope, kek, file_id):
+    # Returns (data key, master hashes), or None if kek is not the key it was wrapped with
+    try:
+        body = json.loads(decrypt(bytes.fromhex(envelope), kek, envelope_aad(file_id)))
+    except (InvalidTag, ValueError):
+        return None
+    return bytes.fromhex(body["data_key"]), body["master_hashes"]
+
+def record_aad(file_id, name):
+    return file_id + b"record:" + name.encode()
+
+def index_aad(file_id):
+    return file_id + b"index"
+
+def read_kdf_candidates(path):
+    # The header is authenticated with the derived key, so its KDF parameters have to be
+    # read unverified first. Out-of-range ones are skipped, so a tampered header cannot make
+    # unlocking take unbounded time or memory; any other tampering just makes the unlock fail
+    with open(path, "rb") as f:
+        head = f.read(DATA_START)
+    found = []
+    for i in range(2):
+        header = peek_header(head[i * HEADER_SLOT_SIZE:(i + 1) * HEADER_SLOT_SIZE])
+        if header and "kdf" in header and header["kdf"] not in found:
+            kdf = header["kdf"]
+            if kdf != LEGACY_KDF:
+                try:
+                    check_kdf_params(kdf)
+                except ValueError:
+                    continue
+            found.append(kdf)
+    return found
+
+def is_segmented(path):
+    with open(path, "rb") as f:
+        head = f.read(DATA_START)
+    return head[:4] == MAGIC or head[HEADER_SLOT_SIZE:HEADER_SLOT_SIZE + 4] == MAGIC
+
+def split_record(record):
+    secret = {k: v for k, v in record.items() if k not in META_FIELDS}
+    meta = {k: record[k] for k in META_FIELDS if k in record}
+    return secret, meta
+
+def write_vault_file(path, kek, master_hashes, records, kdf, data_key=None):
+    # Writes a complete vault from (name, record) pairs into a temp file and renames it into place.
+    # `kek` is the key derived from the master passwords; without data_key a new one is made.
+    data_key = data_key or os.urandom(DATA_KEY_SIZE)
+    file_id = os.urandom(16)
+    entries = {}
+    with atomic_open(path, BACKUP_GENERATIONS) as f:
+        f.write(b"\0" * DATA_START)
+        for name, record in records:
+            secret, meta = split_record(record)
+            blob = encrypt(json.dumps(secret).encode(), data_key, record_aad(file_id, name))
+            entries[name] = [f.tell(), len(blob), meta]
+            f.write(blob)
+        index = encrypt(json.dumps({"entries": entries}).encode(), data_key, index_aad(file_id))
+        index_pos = f.tell()
+        f.write(index)
+        header = {"version": FORMAT_VERSION, "generation": 1, "file_id": file_id.hex(), "kdf": kdf,
+                  "index": [index_pos, len(index)],
+                  "envelope": wrap_data_key(data_key, master_hashes, kek, file_id)}
+        # Both slots start out with the same header so either one can be lost
+        f.seek(0)
+        f.write(pack_header(header, data_key) + pack_header(header, data_key))
+
+class VaultFile:
+    # `kek` is the key derived from the master passwords; `key` is the data key it unwraps
+    def __init__(self, path, kek):
+        self.path = path
+        self.kek = kek
+        self.pending = {}  # name -> full record, or None for a deletion
+        self._open()
+
+    def _unlock_slot(self, slot):
+        # Returns (header, data key, master hashes), or None if kek cannot open this slot
+        header = peek_header(slot)
+        if header is None:
+            return None
+        if header.get("version") == 2:
+            data_key, master_hashes = self.kek, None
+        elif header.get("version") == FORMAT_VERSION:
+            unwrapped = unwrap_data_key(header.get("envelope", ""), self.kek, bytes.fromhex(header["file_id"]))
+            if unwrapped is None:
+                return None
+            data_key, master_hashes = unwrapped
+        else:
+            raise ValueError(f"Unsupported vault version {header.get('version')}.")
+        header = unpack_header(slot, data_key)
+        return None if header is None else (header, data_key, master_hashes)
+
+    def _open(self):
+        self._f = open(self.path, "r+b")
+        slots = [self._f.read(HEADER_SLOT_SIZE), self._f.read(HEADER_SLOT_SIZE)]
+        candidates = []
+        try:
+            for i, slot in enumerate(slots):
+                unlocked = self._unlock_slot(slot)
+                if unlocked is not None:
+                    candidates.append((unlocked[0]["generation"], i, unlocked))
+        except ValueError:
+            self._f.close()
+            raise
+        if not candidates:
+            self._f.close()
+            raise ValueError("Master password incorrect or vault header corrupt.")
+        _, self.slot, (self.header, self.key, master_hashes) = max(candidates, key=lambda c: c[:2])
+        self.file_id = bytes.fromhex(self.header["file_id"])
+        index = json.loads(decrypt(self._read(*self.header["index"]), self.key, index_aad(self.file_id)))
+        self.master_hashes = master_hashes or index["master_hashes"]
+        self.entries = index["entries"]
+
+    def _read(self, offset, length):
+        self._f.seek(offset)
+        return self._f.read(length)
+
+    def __contains__(self, name):
+        if name in self.pending:
+            return self.pending[name] is not None
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.names())
+
+    def names(self):
+        names = [n for n in self.entries if n not in self.pending]
+        names += [n for n, rec in self.pending.items() if rec is not None]
+        return names
+
+    def meta(self, name):
+        # url, tags and modified time, without decrypting the record
+        if name in self.pending:
+            return split_record(self.pending[name] or {})[1]
+        entry = self.entries.get(name)
+        # Entries written before metadata existed are [offset, length]
+        return entry[2] if entry and len(entry) > 2 else {}
+
+    def get_record(self, name):
+        if name in self.pending:
+            return self.pending[name]
+        if name not in self.entries:
+            return None
+        offset, length = self.entries[name][:2]
+        record = json.loads(decrypt(self._read(offset, length), self.key, record_aad(self.file_id, name)))
+        record.update(self.meta(name))
+        return record
+
+    def get(self, name):
+        record = self.get_record(name)
+        return record["password"] if record else None
+
+    def put(self, name, password, url="", notes="", tags=(), modified=None):
+        self.pending[name] = {"password": password, "notes": notes, "url": url,
+                              "tags": list(tags), "modified": modified or time.time()}
+
+    def delete(self, name):
+        self.pending[name] = None
+
+    @property
+    def dirty(self):
+        return bool(self.pending)
+
+    def save(self):
+        # Appends only the changed records plus a new index, then flips the header slot
+        if not self.pending:
+            return False
+        self._f.seek(0, os.SEEK_END)
+        entries = dict(self.entries)
+        for name, record in self.pending.items():
+            if record is None:
+                entries.pop(name, None)
+                continue
+            secret, meta = split_record(record)
+            blob = encrypt(json.dumps(secret).encode(), self.key, record_aad(self.file_id, name))
+            entries[name] = [self._f.tell(), len(blob), meta]
+            self._f.write(blob)
+        index = encrypt(json.dumps({"master_hashes": self.master_hashes, "entries": entries}).encode(),
+                        self.key, index_aad(self.file_id))
+        index_pos = self._f.tell()
+        self._f.write(index)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+        self._write_slot(dict(self.header, generation=self.header["generation"] + 1, index=[index_pos, len(index)]))
+        self.entries = entries
+        self.pending.clear()
+
+        live = sum(entry[1] for entry in entries.values()) + len(index) + DATA_START
+        if os.fstat(self._f.fileno()).st_size > max(COMPACT_MIN_SIZE, COMPACT_RATIO * live):
+            self.rewrite()
+        return True
+
+    def _write_slot(self, header):
+        slot = 1 - self.slot
+        self._f.seek(slot * HEADER_SLOT_SIZE)
+        self._f.write(pack_header(header, self.key))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.header, self.slot = header, slot
+
+    def rekey(self, kek, master_hashes, kdf):
+        # Wraps the same data key for new master passwords: only the two header slots are
+        # rewritten. The older slot goes first, so a crash in between leaves a slot that
+        # still opens with one set of passwords or the other.
+        self.save()
+        envelope = wrap_data_key(self.key, master_hashes, kek, self.file_id)
+        for _ in range(2):
+            self._write_slot(dict(self.header, generation=self.header["generation"] + 1, kdf=kdf, envelope=envelope))
+        self.kek, self.master_hashes = kek, master_hashes
+
+    def rewrite(self, kek=None, master_hashes=None, kdf=None, data_key=None):
+        # Full rewrite into a new file; used for compaction, format upgrades and replacing the
+        # data key. Keeps the current data key unless one is given.
+        self.save()
+        kek = kek or self.kek
+        records = ((name, self.get_record(name)) for name in list(self.entries))
+        write_vault_file(self.path, kek, master_hashes or self.master_hashes, records,
+                         kdf or self.header["kdf"], data_key or self.key)
+        self._f.close()
+        self.kek = kek
+        self._open()
+
+    def close(self):
+        self._f.close()
+
+def migrate_legacy_vault(path, master_passwords):
+    # Version 1 files are a single AES-GCM blob of the whole vault JSON under the SHA256 key
+    with open(path, "rb") as f:
+        data = json.loads(decrypt(f.read(), generate_key(master_passwords)))
+    backup = path + ".v1.bak"
+    shutil.copy2(path, backup)
+    kdf = new_kdf_params()
+    kek = generate_key(master_passwords, kdf)
+    write_vault_file(path, kek, data["master_hashes"],
+                     ((name, {"password": pw}) for name, pw in data["vault"].items()), kdf)
+    # The old file is only protected by the unsalted SHA256 key, so no copy of it is kept
+    # once the new one is known to open with every entry in it
+    vault = VaultFile(path, kek)
+    try:
+        if set(vault.entries) != set(data["vault"]):
+            raise ValueError(f"Vault upgrade could not be verified; the old file is kept as {backup}.")
+    finally:
+        vault.close()
+    os.remove(backup)
+    remove_backups(path, BACKUP_GENERATIONS)
+    print(f"Vault upgraded to format version {FORMAT_VERSION}.")
 
 def create_vault(master_passwords):
-    key = generate_key(master_passwords)
-    empty_data = json.dumps({"master_hashes": [hash_password(pw).decode() for pw in master_passwords], "vault": {}}).encode()
-    encrypted = encrypt(empty_data, key)
-    with open(VAULT_FILE, "wb") as f:
-        f.write(encrypted)
+    kdf = new_kdf_params()
+    key = generate_key(master_passwords, kdf)
+    write_vault_file(VAULT_FILE, key, hash_master_passwords(master_passwords), [], kdf)
     print("Vault created and encrypted.")
 
+def open_vault_file(path, master_passwords):
+    for kdf in read_kdf_candidates(path):
+        try:
+            return VaultFile(path, generate_key(master_passwords, kdf))
+        except ValueError:
+            continue
+    raise ValueError("Master password incorrect or vault header corrupt.")
+
 def load_vault(master_passwords):
     if not os.path.exists(VAULT_FILE):
         print("Vault file not found. Creating new vault.")
         create_vault(master_passwords)
-    key = generate_key(master_passwords)
-    with open(VAULT_FILE, "rb") as f:
-        enc = f.read()
     try:
-        dec = decrypt(enc, key)
-        data = json.loads(dec)
+        if not is_segmented(VAULT_FILE):
+            migrate_legacy_vault(VAULT_FILE, master_passwords)
+        vault = open_vault_file(VAULT_FILE, master_passwords)
         # verify master passwords hashes:
-        for i, h in enumerate(data["master_hashes"]):
-            if not check_password(master_passwords[i], h.encode()):
-                raise ValueError("Master password incorrect.")
-        return data, key
+        if not verify_master_passwords(master_passwords, vault.master_hashes):
+            vault.close()
+            raise ValueError("Master password incorrect.")
+        if vault.header["version"] < FORMAT_VERSION:
+            # The derived key encrypted everything directly; move the records under a new data key
+            kdf = vault.header["kdf"]
+            legacy = kdf == LEGACY_KDF
+            if legacy:
+                kdf = new_kdf_params()
+                print("Vault key upgraded to salted scrypt.")
+            vault.rewrite(generate_key(master_passwords, kdf), vault.master_hashes, kdf, os.urandom(DATA_KEY_SIZE))
+            if legacy:
+                # rewrite() reopened the new file, so the backup of the SHA256-keyed one can go
+                remove_backups(VAULT_FILE, BACKUP_GENERATIONS)
+            print(f"Vault upgraded to format version {FORMAT_VERSION}.")
+        return vault, vault.key
     except Exception as e:
         print("Failed to unlock vault:", e)
         return None, None
 
-def save_vault(data, key):
-    raw = json.dumps(data).encode()
-    encrypted = encrypt(raw, key)
-    with open(VAULT_FILE, "wb") as f:
-        f.write(encrypted)
-
 def input_master_passwords():
     print(f"Enter your {MASTER_PASS_COUNT} master passwords:")
     pwds = []
@@ -73,35 +419,52 @@ def input_master_passwords():
         pwds.append(pw)
     return pwds
 
-def add_entry(data):
+def input_tags():
+    return [t.strip() for t in input("Tags (comma separated, optional): ").split(",") if t.strip()]
+
+def add_entry(vault):
     user = input("New username: ").strip()
-    if user in data["vault"]:
+    if user in vault:
         print("Username exists.")
         return
     pw = getpass.getpass("Password for this username: ")
-    data["vault"][user] = pw
+    url = input("URL (optional): ").strip()
+    notes = input("Notes (optional): ").strip()
+    vault.put(user, pw, url, notes, input_tags())
     print("Entry added.")
+    return user
 
-def edit_entry(data):
+def edit_entry(vault):
     user = input("Username to edit: ").strip()
-    if user not in data["vault"]:
+    if user not in vault:
         print("Not found.")
         return
+    record = vault.get_record(user)
     pw = getpass.getpass("New password: ")
-    data["vault"][user] = pw
+    vault.put(user, pw, record.get("url", ""), record.get("notes", ""), record.get("tags", ()))
     print("Entry updated.")
+    return user
 
-def change_master_passwords(data):
+def show_entry(vault, name):
+    meta = vault.meta(name)
+    details = [meta.get("url") or "", ", ".join(meta.get("tags") or ())]
+    if meta.get("modified"):
+        details.append(time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["modified"])))
+    print(" -", name, " ".join(f"[{d}]" for d in details if d))
+
+def change_master_passwords(vault):
     print("Changing master passwords. Enter old passwords first.")
     old_pwds = input_master_passwords()
     # verify old passwords:
-    for i, h in enumerate(data["master_hashes"]):
-        if not check_password(old_pwds[i], h.encode()):
-            print("Old master password incorrect. Abort.")
-            return False
+    if not verify_master_passwords(old_pwds, vault.master_hashes):
+        print("Old master password incorrect. Abort.")
+        return False
     print("Enter new master passwords:")
     new_pwds = input_master_passwords()
-    data["master_hashes"] = [hash_password(pw).decode() for pw in new_pwds]
+    # Keep the (possibly calibrated) cost, but with a fresh salt
+    old = vault.header["kdf"]
+    kdf = new_kdf_params(old["n"], old["r"], old["p"])
+    vault.rekey(generate_key(new_pwds, kdf), hash_master_passwords(new_pwds), kdf)
     print("Master passwords updated.")
     return new_pwds
 
@@ -113,47 +476,207 @@ def main():
     else:
         master_passwords = input_master_passwords()
 
-    data, key = load_vault(master_passwords)
-    if data is None:
+    vault, key = load_vault(master_passwords)
+    if vault is None:
         print("Cannot unlock vault. Exiting.")
         return
 
-    while True:
-        print("\nOptions:")
-        print("1 - Add new username/password")
-        print("2 - Edit existing password")
-        print("3 - Change master passwords")
-        print("4 - List usernames")
-        print("5 - View password for username")
-        print("6 - Exit")
-        choice = input("Choice: ").strip()
-
-        if choice == "1":
-            add_entry(data)
-        elif choice == "2":
-            edit_entry(data)
-        elif choice == "3":
-            new_pwds = change_master_passwords(data)
-            if new_pwds:
-                master_passwords = new_pwds
-                key = generate_key(master_passwords)
-        elif choice == "4":
-            print("Usernames:")
-            for u in data["vault"]:
-                print(" -", u)
-        elif choice == "5":
-            u = input("Username to view password: ").strip()
-            if u in data["vault"]:
-                print(f"Password for {u}: {data['vault'][u]}")
+    # Only edits mark the session dirty; they are written out in batches and on exit
+    session = VaultSession(vault.save)
+    index = None  # built on the first search, then kept up to date by edits
+    try:
+        while True:
+            print("\nOptions:")
+            print("1 - Add new username/password")
+            print("2 - Edit existing password")
+            print("3 - Change master passwords")
+            print("4 - List usernames")
+            print("5 - View password for username")
+            print("6 - Exit")
+            print("7 - Search entries")
+            choice = input("Choice: ").strip()
+
+            if choice in ("1", "2"):
+                user = add_entry(vault) if choice == "1" else edit_entry(vault)
+                if user:
+                    session.changed()
+                    if index is not None:
+                        index.add(user, vault.meta(user))
+            elif choice == "3":
+                new_pwds = change_master_passwords(vault)
+                if new_pwds:
+                    # rekey() appends any pending edits before it rewrites only the two header
+                    # slots; this just clears the session's count of unsaved edits
+                    session.save()
+                    master_passwords = new_pwds
+                    key = vault.key
+            elif choice == "4":
+                print("Usernames:")
+                for u in vault.names():
+                    print(" -", u)
+            elif choice == "5":
+                u = input("Username to view password: ").strip()
+                if u in vault:
+                    record = vault.get_record(u)
+                    print(f"Password for {u}: {record['password']}")
+                    for field, label in (("url", "URL"), ("notes", "Notes")):
+                        if record.get(field):
+                            print(f"{label}: {record[field]}")
+                    if record.get("tags"):
+                        print("Tags:", ", ".join(record["tags"]))
+                else:
+                    print("Not found.")
+            elif choice == "7":
+                if index is None:
+                    index = SearchIndex((name, vault.meta(name)) for name in vault.names())
+                search_prompt(index, lambda name: show_entry(vault, name))
+            elif choice == "6":
+                break
             else:
-                print("Not found.")
-        elif choice == "6":
-            save_vault(data, key)
-            print("Vault saved. Exiting.")
-            break
+                print("Invalid choice.")
+            session.maybe_save()
+    finally:
+        if session.save():
+            print("Vault saved.")
+        vault.close()
+    print("Exiting.")
+
+def calibrate(target, apply):
+    params, took = calibrate_kdf(target)
+    print(f"scrypt N={params['n']} r={params['r']} p={params['p']} takes {took * 1000:.0f} ms here.")
+    if not apply:
+        return
+    master_passwords = input_master_passwords()
+    vault, _ = load_vault(master_passwords)
+    if vault is None:
+        return
+    vault.rekey(generate_key(master_passwords, params), vault.master_hashes, params)
+    vault.close()
+    print("Vault re-keyed with the calibrated parameters.")
+
+def rekey_file(path, old_passwords, new_passwords, new_hashes):
+    # One vault of a bulk rekey; runs in a worker process. The envelope unwrap already
+    # proves the old passwords, so the bcrypt checks are skipped. Returns an error or None.
+    try:
+        if not is_segmented(path):
+            return "not a segmented vault (open version 1 vaults once to upgrade them)"
+        vault = open_vault_file(path, old_passwords)
+    except (ValueError, OSError) as e:
+        return str(e)
+    try:
+        old = vault.header["kdf"]
+        kdf = new_kdf_params() if old == LEGACY_KDF else new_kdf_params(old["n"], old["r"], old["p"])
+        kek = generate_key(new_passwords, kdf)
+        if vault.header["version"] < FORMAT_VERSION:
+            vault.rewrite(kek, new_hashes, kdf, os.urandom(DATA_KEY_SIZE))
         else:
-            print("Invalid choice.")
-        save_vault(data, key)
+            vault.rekey(kek, new_hashes, kdf)
+    finally:
+        vault.close()
+    return None
+
+def rekey_files(paths, old_passwords, new_passwords, jobs=None):
+    # Every file needs two scrypt derivations (old and new salt), so the files are spread
+    # over a process pool. Returns the number of failures.
+    new_hashes = hash_master_passwords(new_passwords)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(rekey_file, path, old_passwords, new_passwords, new_hashes): path for path in paths}
+        for future in as_completed(futures):
+            error = future.result()
+            print(f"{futures[future]}: {error or 'rekeyed'}", file=sys.stderr)
+            failures += error is not None
+    return failures
+
+def read_new_master_passwords(fd):
+    if fd is not None:
+        return read_fd_lines(fd, MASTER_PASS_COUNT)
+    print("Enter new master passwords:")
+    return input_master_passwords()
+
+def run_command(args):
+    # Status messages go to stderr so `get` and `export -` output can be piped
+    with redirect_stdout(sys.stderr):
+        if args.password_fd is not None:
+            master_passwords = read_fd_lines(args.password_fd, MASTER_PASS_COUNT)
+        else:
+            master_passwords = input_master_passwords()
+        if args.command == "rekey" and args.files:
+            new_pwds = read_new_master_passwords(args.new_password_fd)
+            sys.exit(1 if rekey_files(args.files, master_passwords, new_pwds, args.jobs) else 0)
+        if not os.path.exists(VAULT_FILE):
+            if args.command not in ("add", "import"):
+                sys.exit("No vault found.")
+            create_vault(master_passwords)
+        vault, _ = load_vault(master_passwords)
+    if vault is None:
+        sys.exit(1)
+    try:
+        if args.command == "rekey":
+            with redirect_stdout(sys.stderr):
+                new_pwds = read_new_master_passwords(args.new_password_fd)
+            old = vault.header["kdf"]
+            kdf = new_kdf_params(old["n"], old["r"], old["p"])
+            if args.rotate_data_key:
+                vault.rewrite(generate_key(new_pwds, kdf), hash_master_passwords(new_pwds), kdf,
+                              os.urandom(DATA_KEY_SIZE))
+            else:
+                vault.rekey(generate_key(new_pwds, kdf), hash_master_passwords(new_pwds), kdf)
+            print("Master passwords updated.", file=sys.stderr)
+        elif run_cli_command(args, vault):
+            # A whole import is one append of new records plus one index write
+            vault.save()
+    except (ValueError, RuntimeError) as e:
+        sys.exit(str(e))
+    finally:
+        vault.close()
+
+def run_agent(args):
+    # The key is derived here, then memory is locked before the agent starts serving
+    if args.password_fd is not None:
+        master_passwords = read_fd_lines(args.password_fd, MASTER_PASS_COUNT)
+    else:
+        master_passwords = input_master_passwords()
+    if not os.path.exists(VAULT_FILE):
+        sys.exit("No vault found.")
+    vault, _ = load_vault(master_passwords)
+    del master_passwords
+    if vault is None:
+        sys.exit(1)
+    if not vault_agent.harden_process():
+        print("Warning: could not lock the agent's memory; it may be swapped out (see `ulimit -l`).", file=sys.stderr)
+    session = VaultSession(vault.save, autosave_seconds=vault_agent.SAVE_DELAY)
+    try:
+        vault_agent.serve(vault, session, args.socket, args.idle_timeout)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    finally:
+        vault.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Password vault protected by five master passwords.")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("calibrate", help="pick scrypt parameters that take about --target seconds to derive")
+    p.add_argument("--target", type=float, default=0.5, help="seconds the key derivation should take")
+    p.add_argument("--apply", action="store_true", help="re-key the existing vault with the chosen parameters")
+    add_cli_commands(sub, MASTER_PASS_COUNT)
+    p = sub.choices["rekey"]
+    p.add_argument("files", nargs="*", help=f"vault files to rekey in parallel (default: {VAULT_FILE})")
+    p.add_argument("--jobs", type=int, help="worker processes for several files (default: one per CPU)")
+    p.add_argument("--rotate-data-key", action="store_true",
+                   help="also re-encrypt every entry under a new data key (single vault only)")
+    p = sub.add_parser("agent", help="unlock once and serve entries to vault_agent.py clients over a Unix socket")
+    p.add_argument("--password-fd", type=int, metavar="FD",
+                   help=f"read the {MASTER_PASS_COUNT} master passwords, one per line, from this descriptor")
+    p.add_argument("--socket", help="socket path (default: $VAULT_AGENT_SOCK or a per-user runtime path)")
+    p.add_argument("--idle-timeout", type=float, default=vault_agent.IDLE_TIMEOUT,
+                   help="seconds without requests before the agent saves and exits")
+    args = parser.parse_args()
+    if args.command == "calibrate":
+        calibrate(args.target, args.apply)
+    elif args.command == "agent":
+        run_agent(args)
+    elif args.command:
+        run_command(args)
+    else:
+        main()
@@ -1,31 +1,163 @@
+import os
+import sys
+import time
+import getpass
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK_SIZE = 1024 * 1024  # bytes per read in file mode; memory use stays at about two chunks
+TRANSLATE_BLOCK = 1024 * 1024  # bytes per block on the translate-table path (no NumPy)
+
+def key_shifts(key):
+    # One shift per key position: each key character's code, as the text cipher always used
+    if isinstance(key, str):
+        shifts = bytes(ord(c) % 256 for c in key)
+    else:
+        shifts = bytes(key)
+    if not shifts:
+        raise ValueError("The key must not be empty.")
+    return shifts
+
+class ShiftCipher:
+    # Adds (or, to decrypt, subtracts) the repeating key to every byte, mod 256.
+    # Works on whole buffers: with NumPy the key is broadcast over rows of key length,
+    # otherwise every key position gets a 256-byte translate table and handles its
+    # stride of the buffer in one call. `offset` carries the key position from one
+    # process() call to the next, so a stream can be fed in chunks of any size.
+    def __init__(self, key, decrypt=False):
+        shifts = key_shifts(key)
+        if decrypt:
+            shifts = bytes(-s % 256 for s in shifts)
+        self.shifts = shifts
+        self.offset = 0
+        self._tables = None
+
+    def _rolled(self, start):
+        return self.shifts[start:] + self.shifts[:start]
+
+    def process(self, data):
+        view = memoryview(data).cast("B")
+        size = len(view)
+        if not size:
+            return b""
+        start = self.offset
+        self.offset = (start + size) % len(self.shifts)
+        shifts = self._rolled(start)
+        klen = len(shifts)
+        if np is not None:
+            buf = np.frombuffer(view, dtype=np.uint8)
+            karr = np.frombuffer(shifts, dtype=np.uint8)
+            out = np.empty(size, dtype=np.uint8)
+            full = size - size % klen
+            # uint8 addition wraps around, which is the mod 256
+            np.add(buf[:full].reshape(-1, klen), karr, out=out[:full].reshape(-1, klen))
+            np.add(buf[full:], karr[:size - full], out=out[full:])
+            return out.tobytes()
+        if self._tables is None:
+            self._tables = {s: bytes((b + s) % 256 for b in range(256)) for s in set(self.shifts)}
+        # Blocks of a whole number of key lengths keep the strided passes in cache
+        block = max(klen, TRANSLATE_BLOCK - TRANSLATE_BLOCK % klen)
+        tables = [self._tables[s] for s in shifts]
+        out = bytearray(size)
+        for pos in range(0, size, block):
+            src = view[pos:pos + block].tobytes()
+            end = pos + len(src)
+            for i in range(min(klen, len(src))):
+                out[pos + i:end:klen] = src[i::klen].translate(tables[i])
+        return bytes(out)
+
+def encrypt_bytes(data, key):
+    return ShiftCipher(key).process(data)
+
+def decrypt_bytes(data, key):
+    return ShiftCipher(key, decrypt=True).process(data)
+
 def encrypt(text, key):
-    encrypted_text = []
-    key_length = len(key)
-    
-    for i in range(len(text)):
-        shift = ord(key[i % key_length])  # Get ASCII value of key character
-        encrypted_text.append(chr((ord(text[i]) + shift) % 256))  # Encrypt
-    
-    return "".join(encrypted_text)  # Return as a string
+    # Text is encrypted as UTF-8, so any character works. The result maps each byte to the
+    # character with that code, which matches what earlier versions printed for ASCII text.
+    return encrypt_bytes(text.encode("utf-8"), key).decode("latin-1")
 
 def decrypt(text, key):
-    decrypted_text = []
-    key_length = len(key)
-    
-    for i in range(len(text)):
-        shift = ord(key[i % key_length])  # Get ASCII value of key character
-        decrypted_text.append(chr((ord(text[i]) - shift) % 256))  # Decrypt
-    
-    return "".join(decrypted_text)  # Return as a string
+    try:
+        data = decrypt_bytes(text.encode("latin-1"), key)
+    except UnicodeEncodeError:
+        raise ValueError("Not an encrypted text: it has characters above code 255.")
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        # Earlier versions shifted code points instead of UTF-8 bytes
+        return data.decode("latin-1")
+
+# Streaming pipeline: read_chunks -> transform (or transform_parallel) -> write_chunks.
+# Every stage is a generator, so memory stays at a few chunks whatever the input size.
+
+def read_chunks(src, chunk_size=CHUNK_SIZE):
+    # read1 returns whatever a pipe has ready (up to chunk_size) instead of waiting for a
+    # full chunk, so a slow live producer such as `tail -f` is passed through as it writes
+    read = getattr(src, "read1", src.read)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def transform(chunks, cipher):
+    # The cipher keeps the key offset between chunks
+    for chunk in chunks:
+        yield cipher.process(chunk)
+
+def _process_chunk(shifts, position, chunk):
+    cipher = ShiftCipher(shifts)
+    cipher.offset = position % len(shifts)
+    return cipher.process(chunk)
+
+def transform_parallel(chunks, cipher, jobs):
+    # Each chunk is sent with its absolute position, from which the worker works out the
+    # key offset. Results come back in order, with at most two chunks per worker in flight.
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        position = 0
+        for chunk in chunks:
+            pending.append(pool.submit(_process_chunk, cipher.shifts, position, chunk))
+            position += len(chunk)
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_chunks(chunks, dst):
+    total = 0
+    for chunk in chunks:
+        dst.write(chunk)
+        dst.flush()  # live output; with full chunks this costs nothing a large write did not already
+        total += len(chunk)
+    return total
+
+def process_stream(src, dst, cipher, chunk_size=CHUNK_SIZE, jobs=1):
+    chunks = read_chunks(src, chunk_size)
+    out = transform_parallel(chunks, cipher, jobs) if jobs > 1 else transform(chunks, cipher)
+    return write_chunks(out, dst)
+
+def process_file(src_path, dst_path, key, decrypt=False, chunk_size=CHUNK_SIZE):
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return process_stream(src, dst, ShiftCipher(key, decrypt), chunk_size)
 
 def main():
     print("Choose an option:")
     print("1. Encrypt Data")
     print("2. Decrypt Data")
-    
-    choice = input("Enter choice (1/2): ")
+    print("3. Encrypt File")
+    print("4. Decrypt File")
+
+    choice = input("Enter choice (1-4): ")
     key = input("Enter a word as a key: ")
-    
+
     if choice == '1':
         text = input("Enter the text to encrypt: ")
         encrypted = encrypt(text, key)
@@ -34,8 +166,57 @@ def main():
         encrypted_text = input("Enter the text to decrypt: ")
         decrypted = decrypt(encrypted_text, key)
         print("Decrypted Text:", decrypted)
+    elif choice in ('3', '4'):
+        src = input("Input file: ").strip()
+        dst = input("Output file: ").strip()
+        size = process_file(src, dst, key, decrypt=choice == '4')
+        print(f"Wrote {size} bytes to {dst}.")
     else:
         print("Invalid choice!")
 
+def parse_size(text):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def read_key(key_fd):
+    if key_fd is None:
+        return getpass.getpass("Key: ")
+    with os.fdopen(key_fd, "r", closefd=False) as f:
+        return f.readline().rstrip("\r\n")
+
+def run_cli(args):
+    key = read_key(args.key_fd)
+    cipher = ShiftCipher(key, decrypt=args.command == "decrypt")
+    src = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    dst = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        start = time.perf_counter()
+        total = process_stream(src, dst, cipher, args.buffer_size, args.jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        for f in (src, dst):
+            if f not in (sys.stdin.buffer, sys.stdout.buffer):
+                f.close()
+    if args.stats:
+        print(f"{total} bytes in {elapsed:.2f} s ({total / max(elapsed, 1e-9) / 1e6:.1f} MB/s)", file=sys.stderr)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) == 1:
+        main()
+    else:
+        parser = argparse.ArgumentParser(description="Key-shift cipher for text, files and pipes. "
+                                                     "Run without arguments for the interactive menu.")
+        sub = parser.add_subparsers(dest="command", required=True)
+        for name in ("encrypt", "decrypt"):
+            p = sub.add_parser(name, help=f"{name} a file or stdin")
+            p.add_argument("-i", "--input", default="-", help="input file (default: stdin)")
+            p.add_argument("-o", "--output", default="-", help="output file (default: stdout)")
+            p.add_argument("--key-fd", type=int, metavar="FD", help="read the key from this descriptor instead of prompting")
+            p.add_argument("--buffer-size", type=parse_size, default=CHUNK_SIZE, metavar="SIZE",
+                           help="bytes per chunk, e.g. 256K or 4M (default: 1M)")
+            p.add_argument("-j", "--jobs", type=int, default=1, help="worker processes (default: 1, no pool)")
+            p.add_argument("--stats", action="store_true", help="print bytes and throughput to stderr")
+        run_cli(parser.parse_args())
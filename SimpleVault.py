@@ -1,11 +1,27 @@
 import os
+import sys
 import json
+import time
 import getpass
 import hashlib
+import argparse
+from contextlib import redirect_stdout
+from vault_common import (VaultSession, SearchIndex, add_cli_commands, atomic_write, calibrate_kdf, derive_key,
+                          new_kdf_params, read_fd_lines, remove_backups, run_cli_command, search_prompt)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 VAULT_FILE = "vault.bin"
 MASTER_PASS_COUNT = 5
 SALT_SIZE = 16
+BACKUP_GENERATIONS = 1  # copies of the previous file kept on every save (vault.bin.bak1, ...)
+# Files start with MAGIC and a JSON line holding the scrypt parameters; older files have no header
+MAGIC = b"SVLT2\n"
+LEGACY_KDF = "sha256"
+XOR_CHUNK_SIZE = 1024 * 1024  # bytes per big-int XOR when NumPy is not installed
 
 def hash_password(pw, salt=None):
     if not salt:
@@ -19,12 +35,52 @@ def check_password(pw, stored):
     hashed = hashlib.sha256(salt + pw.encode()).digest().hex()
     return hashed == hashed_hex
 
-def generate_key(master_passwords):
-    combined = "".join(master_passwords).encode()
-    return hashlib.sha256(combined).digest()
+def generate_key(master_passwords, kdf=LEGACY_KDF):
+    if kdf == LEGACY_KDF:
+        combined = "".join(master_passwords).encode()
+        return hashlib.sha256(combined).digest()
+    return derive_key(master_passwords, kdf)
+
+def pack_vault(data, key, kdf):
+    return MAGIC + json.dumps(kdf).encode() + b"\n" + encrypt(json.dumps(data).encode(), key)
+
+def unpack_header(raw):
+    # Returns (kdf params, encrypted body)
+    if not raw.startswith(MAGIC):
+        return LEGACY_KDF, raw
+    line_end = raw.index(b"\n", len(MAGIC))
+    return json.loads(raw[len(MAGIC):line_end]), raw[line_end + 1:]
 
 def xor_encrypt(data: bytes, key: bytes) -> bytes:
-    return bytes([b ^ key[i % len(key)] for i, b in enumerate(data)])
+    # Works on whole buffers instead of one byte per interpreter step. Accepts bytes,
+    # bytearray or memoryview without copying the input.
+    view = memoryview(data).cast("B")
+    size = len(view)
+    if not size:
+        return b""
+    if np is not None:
+        # Broadcast the key over rows of key length, then handle the short tail
+        klen = len(key)
+        buf = np.frombuffer(view, dtype=np.uint8)
+        karr = np.frombuffer(key, dtype=np.uint8)
+        out = np.empty(size, dtype=np.uint8)
+        full = size - size % klen
+        np.bitwise_xor(buf[:full].reshape(-1, klen), karr, out=out[:full].reshape(-1, klen))
+        np.bitwise_xor(buf[full:], karr[:size - full], out=out[full:])
+        return out.tobytes()
+    # Without NumPy: XOR fixed-size chunks as big integers. The chunk size is a multiple
+    # of the key length, so one precomputed keystream integer fits every full chunk.
+    chunk = min(size, XOR_CHUNK_SIZE)
+    chunk += -chunk % len(key)
+    keystream = key * (chunk // len(key))
+    full_key = int.from_bytes(keystream, "little")
+    out = bytearray(size)
+    for start in range(0, size, chunk):
+        part = view[start:start + chunk]
+        n = len(part)
+        k = full_key if n == chunk else int.from_bytes(keystream[:n], "little")
+        out[start:start + n] = (int.from_bytes(part, "little") ^ k).to_bytes(n, "little")
+    return bytes(out)
 
 def encrypt(data: bytes, key: bytes) -> bytes:
     return xor_encrypt(data, key)
@@ -33,59 +89,115 @@ def decrypt(enc_data: bytes, key: bytes) -> bytes:
     return xor_encrypt(enc_data, key)
 
 def create_vault(master_passwords):
-    key = generate_key(master_passwords)
+    kdf = new_kdf_params()
+    key = generate_key(master_passwords, kdf)
     master_hashes = [hash_password(pw) for pw in master_passwords]
-    empty_data = json.dumps({"master_hashes": master_hashes, "vault": {}}).encode()
-    encrypted = encrypt(empty_data, key)
-    with open(VAULT_FILE, "wb") as f:
-        f.write(encrypted)
+    atomic_write(VAULT_FILE, pack_vault({"master_hashes": master_hashes, "vault": {}}, key, kdf))
     print("Vault created and encrypted.")
 
 def load_vault(master_passwords):
     if not os.path.exists(VAULT_FILE):
         print("Vault file not found. Creating new vault.")
         create_vault(master_passwords)
-    key = generate_key(master_passwords)
     with open(VAULT_FILE, "rb") as f:
-        enc = f.read()
+        raw = f.read()
     try:
+        kdf, enc = unpack_header(raw)
+        key = generate_key(master_passwords, kdf)
         dec = decrypt(enc, key)
         data = json.loads(dec.decode())
         for i, h in enumerate(data["master_hashes"]):
             if not check_password(master_passwords[i], h):
                 raise ValueError("Master password incorrect.")
-        return data, key
+        if kdf == LEGACY_KDF:
+            kdf = new_kdf_params()
+            key = generate_key(master_passwords, kdf)
+            save_vault(data, key, kdf)
+            # The backup save_vault just made is the SHA256-keyed file; drop it once the new one reads back
+            with open(VAULT_FILE, "rb") as f:
+                if json.loads(decrypt(unpack_header(f.read())[1], key).decode()) != data:
+                    raise ValueError(f"Vault upgrade could not be verified; the old file is kept as {VAULT_FILE}.bak1.")
+            remove_backups(VAULT_FILE, BACKUP_GENERATIONS)
+            print("Vault key upgraded to salted scrypt.")
+        return data, key, kdf
     except Exception as e:
         print("Failed to unlock vault:", e)
-        return None, None
+        return None, None, None
 
-def save_vault(data, key):
-    raw = json.dumps(data).encode()
-    encrypted = encrypt(raw, key)
-    with open(VAULT_FILE, "wb") as f:
-        f.write(encrypted)
+def save_vault(data, key, kdf):
+    atomic_write(VAULT_FILE, pack_vault(data, key, kdf), BACKUP_GENERATIONS)
 
 def input_master_passwords():
     print(f"Enter your {MASTER_PASS_COUNT} master passwords:")
     return [getpass.getpass(f"Master password {i+1}: ") for i in range(MASTER_PASS_COUNT)]
 
+def get_entry(data, user):
+    # Older vaults store just the password string
+    entry = data["vault"].get(user)
+    if entry is None or isinstance(entry, dict):
+        return entry
+    return {"password": entry}
+
+def entry_meta(data, user):
+    entry = get_entry(data, user) or {}
+    return {k: entry[k] for k in ("url", "tags", "modified") if k in entry}
+
+def put_entry(data, user, password, url="", notes="", tags=(), modified=None):
+    data["vault"][user] = {"password": password, "url": url, "notes": notes,
+                           "tags": list(tags), "modified": modified or time.time()}
+
+class Entries:
+    # The names()/get_record()/meta()/put() view of `data` that the shared CLI commands use
+    def __init__(self, data):
+        self.data = data
+
+    def __contains__(self, user):
+        return user in self.data["vault"]
+
+    def names(self):
+        return list(self.data["vault"])
+
+    def get_record(self, user):
+        return get_entry(self.data, user)
+
+    def meta(self, user):
+        return entry_meta(self.data, user)
+
+    def put(self, user, *args, **kwargs):
+        put_entry(self.data, user, *args, **kwargs)
+
+def input_tags():
+    return [t.strip() for t in input("Tags (comma separated, optional): ").split(",") if t.strip()]
+
 def add_entry(data):
     user = input("New username: ").strip()
     if user in data["vault"]:
         print("Username exists.")
         return
     pw = getpass.getpass("Password for this username: ")
-    data["vault"][user] = pw
+    url = input("URL (optional): ").strip()
+    notes = input("Notes (optional): ").strip()
+    put_entry(data, user, pw, url, notes, input_tags())
     print("Entry added.")
+    return user
 
 def edit_entry(data):
     user = input("Username to edit: ").strip()
     if user not in data["vault"]:
         print("Not found.")
         return
+    entry = get_entry(data, user)
     pw = getpass.getpass("New password: ")
-    data["vault"][user] = pw
+    put_entry(data, user, pw, entry.get("url", ""), entry.get("notes", ""), entry.get("tags", ()))
     print("Entry updated.")
+    return user
+
+def show_entry(data, user):
+    meta = entry_meta(data, user)
+    details = [meta.get("url") or "", ", ".join(meta.get("tags") or ())]
+    if meta.get("modified"):
+        details.append(time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["modified"])))
+    print(" -", user, " ".join(f"[{d}]" for d in details if d))
 
 def change_master_passwords(data):
     print("Changing master passwords. Enter old passwords first.")
@@ -108,47 +220,128 @@ def main():
     else:
         master_passwords = input_master_passwords()
 
-    data, key = load_vault(master_passwords)
+    data, key, kdf = load_vault(master_passwords)
     if data is None:
         print("Cannot unlock vault. Exiting.")
         return
 
-    while True:
-        print("\nOptions:")
-        print("1 - Add new username/password")
-        print("2 - Edit existing password")
-        print("3 - Change master passwords")
-        print("4 - List usernames")
-        print("5 - View password for username")
-        print("6 - Exit")
-        choice = input("Choice: ").strip()
-
-        if choice == "1":
-            add_entry(data)
-        elif choice == "2":
-            edit_entry(data)
-        elif choice == "3":
-            new_pwds = change_master_passwords(data)
-            if new_pwds:
-                master_passwords = new_pwds
-                key = generate_key(master_passwords)
-        elif choice == "4":
-            print("Usernames:")
-            for u in data["vault"]:
-                print(" -", u)
-        elif choice == "5":
-            u = input("Username to view password: ").strip()
-            if u in data["vault"]:
-                print(f"Password for {u}: {data['vault'][u]}")
+    # Only edits mark the session dirty; they are written out in batches and on exit.
+    # The lambda looks up `key` when it runs, so it follows master password changes.
+    session = VaultSession(lambda: save_vault(data, key, kdf))
+    index = None  # built on the first search, then kept up to date by edits
+    try:
+        while True:
+            print("\nOptions:")
+            print("1 - Add new username/password")
+            print("2 - Edit existing password")
+            print("3 - Change master passwords")
+            print("4 - List usernames")
+            print("5 - View password for username")
+            print("6 - Exit")
+            print("7 - Search entries")
+            choice = input("Choice: ").strip()
+
+            if choice in ("1", "2"):
+                user = add_entry(data) if choice == "1" else edit_entry(data)
+                if user:
+                    session.changed()
+                    if index is not None:
+                        index.add(user, entry_meta(data, user))
+            elif choice == "3":
+                new_pwds = change_master_passwords(data)
+                if new_pwds:
+                    master_passwords = new_pwds
+                    # Keep the (possibly calibrated) cost, but with a fresh salt
+                    kdf = new_kdf_params(kdf["n"], kdf["r"], kdf["p"])
+                    key = generate_key(master_passwords, kdf)
+                    # Re-encrypt under the new key right away
+                    session.changed()
+                    session.save()
+            elif choice == "4":
+                print("Usernames:")
+                for u in data["vault"]:
+                    print(" -", u)
+            elif choice == "5":
+                u = input("Username to view password: ").strip()
+                if u in data["vault"]:
+                    entry = get_entry(data, u)
+                    print(f"Password for {u}: {entry['password']}")
+                    for field, label in (("url", "URL"), ("notes", "Notes")):
+                        if entry.get(field):
+                            print(f"{label}: {entry[field]}")
+                    if entry.get("tags"):
+                        print("Tags:", ", ".join(entry["tags"]))
+                else:
+                    print("Not found.")
+            elif choice == "7":
+                if index is None:
+                    index = SearchIndex((u, entry_meta(data, u)) for u in data["vault"])
+                search_prompt(index, lambda u: show_entry(data, u))
+            elif choice == "6":
+                break
             else:
-                print("Not found.")
-        elif choice == "6":
-            save_vault(data, key)
-            print("Vault saved. Exiting.")
-            break
+                print("Invalid choice.")
+            session.maybe_save()
+    finally:
+        if session.save():
+            print("Vault saved.")
+    print("Exiting.")
+
+def calibrate(target, apply):
+    params, took = calibrate_kdf(target)
+    print(f"scrypt N={params['n']} r={params['r']} p={params['p']} takes {took * 1000:.0f} ms here.")
+    if not apply:
+        return
+    master_passwords = input_master_passwords()
+    data, _, _ = load_vault(master_passwords)
+    if data is None:
+        return
+    save_vault(data, generate_key(master_passwords, params), params)
+    print("Vault re-keyed with the calibrated parameters.")
+
+def run_command(args):
+    # Status messages go to stderr so `get` and `export -` output can be piped
+    with redirect_stdout(sys.stderr):
+        if args.password_fd is not None:
+            master_passwords = read_fd_lines(args.password_fd, MASTER_PASS_COUNT)
         else:
-            print("Invalid choice.")
-        save_vault(data, key)
+            master_passwords = input_master_passwords()
+        if not os.path.exists(VAULT_FILE):
+            if args.command not in ("add", "import"):
+                sys.exit("No vault found.")
+            create_vault(master_passwords)
+        data, key, kdf = load_vault(master_passwords)
+    if data is None:
+        sys.exit(1)
+    try:
+        if args.command == "rekey":
+            with redirect_stdout(sys.stderr):
+                if args.new_password_fd is not None:
+                    new_pwds = read_fd_lines(args.new_password_fd, MASTER_PASS_COUNT)
+                else:
+                    print("Enter new master passwords:")
+                    new_pwds = input_master_passwords()
+            data["master_hashes"] = [hash_password(pw) for pw in new_pwds]
+            kdf = new_kdf_params(kdf["n"], kdf["r"], kdf["p"])
+            save_vault(data, generate_key(new_pwds, kdf), kdf)
+            print("Master passwords updated.", file=sys.stderr)
+        elif run_cli_command(args, Entries(data)):
+            # However many entries an import adds, the vault is encrypted and written once
+            save_vault(data, key, kdf)
+    except (ValueError, RuntimeError) as e:
+        sys.exit(str(e))
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Simple password vault protected by five master passwords.")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("calibrate", help="pick scrypt parameters that take about --target seconds to derive")
+    p.add_argument("--target", type=float, default=0.5, help="seconds the key derivation should take")
+    p.add_argument("--apply", action="store_true", help="re-key the existing vault with the chosen parameters")
+    add_cli_commands(sub, MASTER_PASS_COUNT)
+    args = parser.parse_args()
+    if args.command == "calibrate":
+        calibrate(args.target, args.apply)
+    elif args.command:
+        run_command(args)
+    else:
+        main()
@@ -0,0 +1,96 @@
+import os, time, hmac, hashlib, threading
+from collections import OrderedDict
+
+# scrypt cost parameters; raise KDF_N to make each hash slower (and login storms cheaper to survive)
+KDF_N = int(os.environ.get('CHAT_KDF_N', 2 ** 14))
+KDF_R = 8
+KDF_P = 1
+SALT_SIZE = 16
+PREFIX = 'scrypt'
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60.0
+
+
+def _scrypt(password, salt, n, r, p):
+    # maxmem has to cover 128 * n * r bytes plus some slack
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+
+def hash_password(password, n=KDF_N, r=KDF_R, p=KDF_P):
+    salt = os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, n, r, p)
+    return f'{PREFIX}${n}${r}${p}${salt.hex()}${digest.hex()}'
+
+
+def _parse_hash(stored):
+    # -> (n, r, p, salt, digest hex) for a well-formed hash, None for anything else: a legacy
+    # plaintext password may itself begin with "scrypt$"
+    fields = stored.split('$')
+    if len(fields) != 6 or fields[0] != PREFIX:
+        return None
+    _, n, r, p, salt_hex, digest_hex = fields
+    if not (n.isdecimal() and r.isdecimal() and p.isdecimal()) or len(digest_hex) != 64:
+        return None
+    n, r, p = int(n), int(r), int(p)
+    if n < 2 or n & (n - 1) or n > 2 ** 20 or not 1 <= r <= 32 or not 1 <= p <= 16:
+        return None
+    try:
+        salt = bytes.fromhex(salt_hex)
+        bytes.fromhex(digest_hex)
+    except ValueError:
+        return None
+    return n, r, p, salt, digest_hex.lower()
+
+
+def verify_password(password, stored):
+    parsed = _parse_hash(stored)
+    if parsed is None:
+        # Accounts created before hashing was added still hold the plaintext password
+        return hmac.compare_digest(password.encode(), stored.encode())
+    n, r, p, salt, digest_hex = parsed
+    digest = _scrypt(password, salt, n, r, p)
+    return hmac.compare_digest(digest.hex(), digest_hex)
+
+
+def needs_rehash(stored, n=KDF_N, r=KDF_R, p=KDF_P):
+    parsed = _parse_hash(stored)
+    return parsed is None or parsed[:3] != (n, r, p)
+
+
+# Small LRU cache with per-entry expiry, used in front of the users table
+class TTLCache:
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
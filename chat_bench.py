@@ -0,0 +1,230 @@
+import argparse, asyncio, multiprocessing, os, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import chat_auth
+import chat_mq
+
+# Benchmarks for the chat server. Run `python chat_bench.py <command> -h` for options.
+
+
+def _fanout_worker(path, count, size, total, ready, start, results):
+    sub = chat_mq.subscribe(path)
+    pub = chat_mq.connect(path)
+    ready.release()
+    start.wait()
+    begin = time.perf_counter()
+
+    def publish():
+        payload = b'x' * size
+        for _ in range(count):
+            chat_mq.send_frame(pub, payload)
+
+    t = threading.Thread(target=publish)
+    t.start()
+    for _ in range(total):
+        chat_mq.recv_frame(sub)
+    t.join()
+    results.put(time.perf_counter() - begin)
+
+
+def bench_fanout(args):
+    # Every worker publishes its share of messages and must receive every message
+    # published by any worker, which is what a broadcast costs across processes.
+    path = os.path.join(tempfile.mkdtemp(), 'bench-mq.sock')
+    hub = chat_mq.start_hub(path)
+    print(f"{'workers':>8} {'messages':>9} {'msgs/s':>12} {'deliveries/s':>14} {'MB/s':>9}")
+    try:
+        for workers in args.workers:
+            per_worker = args.messages // workers
+            total = per_worker * workers
+            ready = multiprocessing.Semaphore(0)
+            start = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_fanout_worker, args=(path, per_worker, args.size, total, ready, start, results))
+                     for _ in range(workers)]
+            for p in procs:
+                p.start()
+            for _ in procs:
+                ready.acquire()
+            time.sleep(0.1)  # let the hub register the subscriptions
+            start.set()
+            elapsed = max(results.get() for _ in procs)
+            for p in procs:
+                p.join()
+            deliveries = total * workers
+            print(f"{workers:>8} {total:>9} {total / elapsed:>12.0f} {deliveries / elapsed:>14.0f} "
+                  f"{deliveries * args.size / elapsed / 1e6:>9.1f}")
+    finally:
+        hub.shutdown()
+        hub.server_close()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def _load(args):
+    import socketio  # python-socketio[asyncio_client]
+
+    latencies = []
+    received = 0
+
+    async def open_client(i):
+        sio = socketio.AsyncClient(reconnection=False)
+
+        @sio.on('message')
+        async def on_message(data):
+            nonlocal received
+            msg = data.get('msg', '')
+            if msg.startswith('bench:'):
+                received += 1
+                latencies.append(time.time() - float(msg.split(':')[1]))
+
+        await sio.connect(args.url, transports=['websocket'])
+        await sio.emit('join', args.room)
+        return sio
+
+    print(f'Connecting {args.clients} clients to {args.url} ...')
+    clients = []
+    for start in range(0, args.clients, args.connect_batch):
+        batch = range(start, min(start + args.connect_batch, args.clients))
+        clients += await asyncio.gather(*(open_client(i) for i in batch))
+    print(f'Connected {len(clients)} clients')
+
+    senders = clients[:args.senders]
+    interval = args.senders / args.rate
+    sent = 0
+
+    async def send_loop(sio):
+        nonlocal sent
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            await sio.emit('message', {'room': args.room, 'msg': f'bench:{time.time()}'})
+            sent += 1
+            await asyncio.sleep(interval)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(send_loop(sio) for sio in senders))
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - begin
+
+    expected = sent * len(clients)
+    print(f'sent {sent} messages, {received}/{expected} deliveries ({received / elapsed:.0f} deliveries/s)')
+    print(f'latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms, '
+          f'max {max(latencies, default=0) * 1000:.1f} ms')
+    await asyncio.gather(*(sio.disconnect() for sio in clients))
+
+
+def bench_load(args):
+    # Raise the open-file limit first for thousands of clients, e.g. `ulimit -n 65535`
+    asyncio.run(_load(args))
+
+
+def bench_login(args):
+    # A login storm through the server's own KDF path, Chatapp.run_kdf: CHAT_KDF_WORKERS hashes
+    # run at once, up to CHAT_KDF_MAX_PENDING wait for a worker, and the rest are turned away
+    # (the 503 /login answers with). Every attempt arrives at once on its own thread, as
+    # requests do, and latency includes the time queued for a worker.
+    os.environ['CHAT_KDF_WORKERS'] = str(args.workers)
+    os.environ['CHAT_KDF_MAX_PENDING'] = str(args.max_pending)
+    os.chdir(tempfile.mkdtemp())  # Chatapp keeps chat.db in the working directory
+    import Chatapp
+    print(f"{'N':>8} {'hash ms':>8} {'logins/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'503s':>6}")
+    for n in args.cost:
+        stored = chat_auth.hash_password('hunter2', n=n)
+        begin = time.perf_counter()
+        chat_auth.verify_password('hunter2', stored)
+        single = time.perf_counter() - begin
+
+        def attempt(submitted):
+            ok = Chatapp.run_kdf(chat_auth.verify_password, 'hunter2', stored)
+            return ok, time.perf_counter() - submitted
+
+        with ThreadPoolExecutor(max_workers=args.logins) as pool:
+            begin = time.perf_counter()
+            futures = [pool.submit(attempt, time.perf_counter()) for _ in range(args.logins)]
+            results = [f.result() for f in futures]
+            elapsed = time.perf_counter() - begin
+        latencies = [took for ok, took in results if ok is not None]
+        busy = len(results) - len(latencies)
+        print(f"{n:>8} {single * 1000:>8.1f} {len(latencies) / elapsed:>9.1f} "
+              f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} {busy:>6}")
+
+
+def _rate(client, path, seconds):
+    # Requests/sec for GETs of `path` over about `seconds`
+    count, begin = 0, time.perf_counter()
+    while time.perf_counter() - begin < seconds:
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path}: HTTP {response.status_code}')
+        count += 1
+    return count / (time.perf_counter() - begin)
+
+
+def bench_pages(args):
+    # Page rendering through Flask's test client (no network): the templates compiled once
+    # at startup, against render_template_string parsing and compiling them per request.
+    os.chdir(tempfile.mkdtemp())  # Chatapp keeps chat.db in the working directory
+    import flask
+    import Chatapp
+    sources = {Chatapp.login_template: Chatapp.login_page, Chatapp.chat_template: Chatapp.chat_page}
+    compiled = Chatapp.render_template
+
+    def per_request(template, **context):
+        return flask.render_template_string(sources[template], **context)
+
+    for i in range(args.messages):
+        Chatapp.db.insert_message(Chatapp.db.DEFAULT_ROOM, f'user{i % 7}', f'message {i} ' + 'x' * 60, time.time())
+    guest = Chatapp.app.test_client()
+    user = Chatapp.app.test_client()
+    user.post('/register', data={'username': 'bench', 'password': 'bench-password'})
+    print(f"{'page':>8} {'templates':>18} {'req/s':>9}")
+    for label, renderer in (('per request', per_request), ('compiled once', compiled)):
+        Chatapp.render_template = renderer
+        for page, client, path in (('login', guest, '/'), ('chat', user, '/chat')):
+            print(f"{page:>8} {label:>18} {_rate(client, path, args.seconds):>9.0f}")
+    Chatapp.render_template = compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('fanout', help='cross-process broadcast throughput through the local message queue hub')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.add_argument('--messages', type=int, default=20000, help='messages published per run, split across workers')
+    p.add_argument('--size', type=int, default=200, help='payload bytes per message')
+    p.set_defaults(func=bench_fanout)
+
+    p = sub.add_parser('load', help='open many Socket.IO clients against a running server and measure delivery latency')
+    p.add_argument('--url', default='http://127.0.0.1:5000')
+    p.add_argument('--clients', type=int, default=2000)
+    p.add_argument('--senders', type=int, default=20, help='clients that send messages; every client receives them')
+    p.add_argument('--rate', type=float, default=50, help='total messages per second across all senders')
+    p.add_argument('--duration', type=float, default=10, help='seconds to keep sending')
+    p.add_argument('--drain', type=float, default=2, help='seconds to wait for deliveries after sending stops')
+    p.add_argument('--room', default='bench', help='room every client joins')
+    p.add_argument('--connect-batch', type=int, default=200, help='clients connected concurrently')
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('login', help='login-storm throughput and p99 latency at different scrypt costs')
+    p.add_argument('--cost', type=int, nargs='+', default=[2 ** 12, 2 ** 14, 2 ** 15], help='scrypt N values')
+    p.add_argument('--workers', type=int, default=2, help='KDF pool size, as CHAT_KDF_WORKERS')
+    p.add_argument('--max-pending', type=int, default=32, help='queued hashes before logins get 503, as CHAT_KDF_MAX_PENDING')
+    p.add_argument('--logins', type=int, default=100, help='concurrent login attempts per cost setting')
+    p.set_defaults(func=bench_login)
+
+    p = sub.add_parser('pages', help='login and chat page requests/sec: templates compiled per request vs once')
+    p.add_argument('--seconds', type=float, default=3, help='time spent on each page and mode')
+    p.add_argument('--messages', type=int, default=50, help='messages in the room, embedded in the chat page')
+    p.set_defaults(func=bench_pages)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
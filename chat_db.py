@@ -0,0 +1,287 @@
+import sqlite3, threading, queue, time, atexit, signal, logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'chat.db'
+POOL_SIZE = 8
+ACQUIRE_TIMEOUT = 10.0
+
+# Write-behind: messages are queued and group-committed by a background thread
+FLUSH_BATCH_SIZE = 256
+FLUSH_MAX_DELAY = 0.05  # seconds a queued message may wait before it is on disk
+FLUSH_RETRIES = 5        # attempts at a failed batch before its messages are dropped and counted
+FLUSH_RETRY_DELAY = 0.1  # seconds before the first retry, doubling after each
+
+DEFAULT_ROOM = 'general'
+
+# Applied to every new connection. WAL lets readers run while a writer commits,
+# and synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',  # ~16 MB page cache per connection
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+# SQL is kept as constants so sqlite3's per-connection statement cache reuses the prepared statements
+SQL_CREATE_USERS = 'CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)'
+SQL_CREATE_MESSAGES = "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, sender TEXT, content TEXT, created_at REAL, room TEXT NOT NULL DEFAULT 'general')"
+SQL_INDEX_CREATED_AT = 'CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)'
+SQL_INDEX_ROOM = 'CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)'
+SQL_INSERT_USER = 'INSERT INTO users (username, password) VALUES (?,?)'
+SQL_GET_USER = 'SELECT id, username, password FROM users WHERE username=?'
+SQL_UPDATE_PASSWORD = 'UPDATE users SET password=? WHERE username=?'
+SQL_INSERT_MESSAGE = 'INSERT INTO messages (room, sender, content, created_at) VALUES (?, ?, ?, ?)'
+SQL_LATEST_MESSAGES = 'SELECT id, sender, content, created_at FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?'
+SQL_MESSAGES_BEFORE = 'SELECT id, sender, content, created_at FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?'
+
+
+# A fixed-size pool of long-lived SQLite connections. Readers share the pool freely;
+# writers first take a process-wide lock so they queue here instead of spinning on SQLITE_BUSY,
+# and at most one connection is ever tied up by writing.
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=ACQUIRE_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._acquires = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if len(self._all) < self.size:
+                    conn = self._connect()
+                    self._all.append(conn)
+            if conn is None:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError('timed out waiting for a database connection')
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._acquires += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def read(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def write(self):
+        # The write lock is taken first, so queued writers do not each hold a connection readers could use
+        with self._write_lock:
+            conn = self._acquire()
+            try:
+                with conn:  # commits on success, rolls back on error
+                    yield conn
+            finally:
+                self._release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.size,
+                'open_connections': len(self._all),
+                'idle_connections': self._idle.qsize(),
+                'acquires': self._acquires,
+                'wait_avg_ms': (self._wait_total / self._acquires * 1000) if self._acquires else 0.0,
+                'wait_max_ms': self._wait_max * 1000,
+            }
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+
+pool = ConnectionPool()
+
+
+def init_db():
+    with pool.write() as conn:
+        conn.execute(SQL_CREATE_USERS)
+        conn.execute(SQL_CREATE_MESSAGES)
+        # Older databases were created without the timestamp and room columns
+        cols = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'created_at' not in cols:
+            conn.execute('ALTER TABLE messages ADD COLUMN created_at REAL')
+        if 'room' not in cols:
+            conn.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'general'")
+        conn.execute(SQL_INDEX_CREATED_AT)
+        conn.execute(SQL_INDEX_ROOM)
+
+
+def create_user(username, password):
+    with pool.write() as conn:
+        conn.execute(SQL_INSERT_USER, (username, password))
+
+
+def get_user(username):
+    with pool.read() as conn:
+        return conn.execute(SQL_GET_USER, (username,)).fetchone()
+
+
+def update_password(username, password):
+    with pool.write() as conn:
+        conn.execute(SQL_UPDATE_PASSWORD, (password, username))
+
+
+def insert_message(room, sender, content, created_at):
+    with pool.write() as conn:
+        return conn.execute(SQL_INSERT_MESSAGE, (room, sender, content, created_at)).lastrowid
+
+
+def fetch_messages(room=DEFAULT_ROOM, before=None, limit=50):
+    # Keyset pagination on (room, id): cost depends on the page size, not the table or room size
+    with pool.read() as conn:
+        if before is None:
+            rows = conn.execute(SQL_LATEST_MESSAGES, (room, limit)).fetchall()
+        else:
+            rows = conn.execute(SQL_MESSAGES_BEFORE, (room, before, limit)).fetchall()
+    rows.reverse()
+    return rows
+
+
+# Batches queued messages into one transaction (one fsync) per FLUSH_BATCH_SIZE rows
+# or FLUSH_MAX_DELAY seconds, whichever comes first.
+class MessageWriter:
+    _STOP = object()
+
+    def __init__(self, pool, batch_size=FLUSH_BATCH_SIZE, max_delay=FLUSH_MAX_DELAY,
+                 retries=FLUSH_RETRIES, retry_delay=FLUSH_RETRY_DELAY):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._enqueued = 0
+        self._flushed = 0
+        self._flushes = 0
+        self._flush_total = 0.0
+        self._flush_max = 0.0
+        self._retried = 0
+        self._failed = 0
+        self._thread = threading.Thread(target=self._run, name='chat-db-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, room, sender, content, created_at):
+        with self._lock:
+            self._enqueued += 1
+        self._queue.put((room, sender, content, created_at))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    # Drain whatever is left so nothing queued before shutdown is lost
+                    stopping = True
+                    continue
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # A failed batch is retried with backoff (a locked or full disk often clears up);
+        # new messages keep queueing meanwhile. Only then are its messages dropped.
+        delay = self.retry_delay
+        for attempt in range(1, self.retries + 1):
+            start = time.perf_counter()
+            try:
+                with self.pool.write() as conn:
+                    conn.executemany(SQL_INSERT_MESSAGE, batch)
+                break
+            except sqlite3.Error as e:
+                if attempt == self.retries:
+                    with self._lock:
+                        self._failed += len(batch)
+                    logger.exception('Dropped %d messages: flush failed %d times', len(batch), attempt)
+                    return
+                with self._lock:
+                    self._retried += 1
+                logger.warning('Flushing %d messages failed (%s), retrying in %.2fs', len(batch), e, delay)
+                time.sleep(delay)
+                delay *= 2
+        took = time.perf_counter() - start
+        with self._lock:
+            self._flushed += len(batch)
+            self._flushes += 1
+            self._flush_total += took
+            self._flush_max = max(self._flush_max, took)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'enqueued': self._enqueued,
+                'flushed': self._flushed,
+                'flushes': self._flushes,
+                'retried_flushes': self._retried,
+                'failed_messages': self._failed,
+                'avg_batch': (self._flushed / self._flushes) if self._flushes else 0.0,
+                'flush_avg_ms': (self._flush_total / self._flushes * 1000) if self._flushes else 0.0,
+                'flush_max_ms': self._flush_max * 1000,
+                'max_delay_ms': self.max_delay * 1000,
+            }
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+    def close_on_sigterm(self):
+        # atexit handlers do not run when SIGTERM kills the process, so exit through
+        # SystemExit instead, after flushing; must be called from the main thread
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handler(signum, frame):
+            self.close()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                raise SystemExit(128 + signum)
+        signal.signal(signal.SIGTERM, handler)
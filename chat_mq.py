@@ -0,0 +1,186 @@
+import os, queue, socket, socketserver, struct, tempfile, threading, time
+
+# Local stand-in for a Redis/AMQP message queue: a tiny hub on a Unix socket that
+# relays every frame it receives to every connected worker (including the sender).
+# Frames are a 4-byte big-endian length followed by the payload. A connection only
+# receives frames after it sends SUBSCRIBE, so publish-only connections never fill up.
+SOCKET_NAME = 'chat-mq.sock'
+SUBSCRIBE = b'\x00SUBSCRIBE'
+HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+PEER_BUFFER = 64 * 1024 * 1024  # bytes waiting for one subscriber before it is disconnected as stalled
+
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('message queue connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError('frame too large')
+    return _recv_exact(sock, size)
+
+
+class _Peer:
+    # Each subscriber has its own bounded outbox and writer thread, so a slow or stalled
+    # worker cannot hold up publishes or deliveries to the others
+    def __init__(self, sock):
+        self.sock = sock
+        self.subscribed = False
+        self.closed = False
+        self.outbox = None
+        self.lock = threading.Lock()
+        self.pending = 0  # bytes in the outbox
+
+    def subscribe(self):
+        self.outbox = queue.SimpleQueue()
+        threading.Thread(target=self._write, name='chat-mq-peer', daemon=True).start()
+        self.subscribed = True
+
+    def _write(self):
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                return
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.drop()
+                return
+            with self.lock:
+                self.pending -= len(frame)
+
+    def send(self, frame):
+        # False once the peer has fallen PEER_BUFFER bytes behind
+        with self.lock:
+            if self.pending + len(frame) > PEER_BUFFER:
+                return False
+            self.pending += len(frame)
+        self.outbox.put(frame)
+        return True
+
+    def drop(self):
+        # Ends the handler's recv loop as well; the worker reconnects and resubscribes
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def stop(self):
+        if self.outbox is not None:
+            self.outbox.put(None)
+
+
+class _HubHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        peer = _Peer(self.request)
+        with self.server.peers_lock:
+            self.server.peers.append(peer)
+        try:
+            while True:
+                payload = recv_frame(self.request)
+                if payload == SUBSCRIBE:
+                    if not peer.subscribed:
+                        peer.subscribe()
+                    continue
+                self.server.relay(HEADER.pack(len(payload)) + payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.server.peers_lock:
+                self.server.peers.remove(peer)
+            peer.stop()
+
+
+class Hub(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self._prepare_path(path)
+        self.peers = []
+        self.peers_lock = threading.Lock()
+        self.relayed = 0
+        self.dropped = 0
+        # The socket is created 0600, so only the user running the workers may publish; a
+        # chmod after bind() would leave a window in which anyone could connect
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _HubHandler)
+        finally:
+            os.umask(umask)
+
+    @staticmethod
+    def _prepare_path(path):
+        # Only in a directory no one else can write to, and never over another live hub
+        directory = os.path.dirname(os.path.abspath(path))
+        st = os.stat(directory)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise RuntimeError(f'{directory} must be owned by you and not writable by others.')
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise RuntimeError(f'A message queue hub is already listening on {path}.')
+            except OSError:
+                os.unlink(path)  # left behind by a hub that did not shut down cleanly
+            finally:
+                probe.close()
+
+    def relay(self, frame):
+        with self.peers_lock:
+            peers = [p for p in self.peers if p.subscribed and not p.closed]
+            self.relayed += 1
+        for peer in peers:
+            if not peer.send(frame):
+                peer.drop()
+                with self.peers_lock:
+                    self.dropped += 1
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def private_socket_path():
+    # A fresh 0700 directory per deployment, so neither other users nor a second set of
+    # workers can reach or replace this hub; pass the path on to the workers
+    return os.path.join(tempfile.mkdtemp(prefix='chat-mq-'), SOCKET_NAME)
+
+
+def start_hub(path):
+    hub = Hub(path)
+    threading.Thread(target=hub.serve_forever, name='chat-mq-hub', daemon=True).start()
+    return hub
+
+
+def connect(path, retries=50, delay=0.1):
+    # Workers may start before the hub is listening, so retry for a few seconds
+    for attempt in range(retries):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except OSError:
+            sock.close()
+            if attempt == retries - 1:
+                raise
+            time.sleep(delay)
+
+
+def subscribe(path):
+    sock = connect(path)
+    send_frame(sock, SUBSCRIBE)
+    return sock
@@ -0,0 +1,138 @@
+import os, stat, time, tarfile, zipfile, mimetypes
+from flask import request, Response
+from werkzeug.security import safe_join
+from file_serve import READ_BLOCK, compressible, choose_encoding, EncodedBody, content_disposition
+
+# Streaming multi-file downloads for speed.py.
+#
+# The archive is produced by a generator while it is sent: no temp file, and memory stays
+# at about one READ_BLOCK whatever the number or size of the files. ZIP entries of
+# text-like files are deflated and everything else (photos, video, archives) is stored
+# as is. A tar is sent uncompressed, or with the client's preferred Content-Encoding
+# when most of its bytes are compressible.
+FORMATS = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+ZIP_LEVEL = 6
+MAX_FILES = 10000  # names a request may list one by one; the whole folder (all=1) has no cap
+
+
+def plan(folder, names):
+    # -> [(name, path, size, compressible)] for the regular files among `names`
+    files, seen = [], set()
+    for name in names:
+        path = safe_join(folder, name)
+        if path is None or name in seen or name.startswith('.'):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            seen.add(name)
+            files.append((name, path, st.st_size, compressible(mimetypes.guess_type(name)[0])))
+    return files
+
+
+class _Pipe:
+    # Write-only sink for ZipFile; zipfile sees no tell() and writes a streamable archive
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+def _open(path):
+    # The open file and its stat, or None if it vanished or changed type since plan()
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        return None
+    return f, st
+
+
+def zip_stream(files, block=READ_BLOCK):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', compresslevel=ZIP_LEVEL) as zf:
+        for name, path, _, deflate in files:
+            opened = _open(path)
+            if opened is None:
+                continue
+            f, st = opened
+            with f:
+                info = zipfile.ZipInfo(name, max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+                info.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+                info.external_attr = 0o644 << 16
+                info.file_size = st.st_size
+                with zf.open(info, 'w', force_zip64=st.st_size >= zipfile.ZIP64_LIMIT) as dest:
+                    for data in iter(lambda: f.read(block), b''):
+                        dest.write(data)
+                        if pipe.size >= block:
+                            yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain()  # central directory
+
+
+def tar_stream(files, block=READ_BLOCK):
+    for name, path, _, _ in files:
+        opened = _open(path)
+        if opened is None:
+            continue
+        f, st = opened
+        with f:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = st.st_size, int(st.st_mtime), 0o644
+            # PAX headers carry long and non-ASCII names and sizes over 8 GiB
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            remaining = st.st_size
+            while remaining:
+                data = f.read(min(block, remaining))
+                if not data:
+                    data = bytes(min(block, remaining))  # the file shrank: pad to the size in the header
+                remaining -= len(data)
+                yield data
+            yield bytes(-st.st_size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def archive_response(folder, names, fmt='zip', download_name=None):
+    # Streams the named files of `folder` as one archive; None if none of them exists
+    files = plan(folder, names)
+    if not files:
+        return None
+    fmt = fmt if fmt in FORMATS else 'zip'
+    download_name = f"{download_name or time.strftime('files-%Y%m%d-%H%M%S')}.{fmt}"
+    headers = {'Cache-Control': 'no-store'}
+    if fmt == 'zip':
+        body = zip_stream(files)
+    else:
+        body = tar_stream(files)
+        total = sum(size for _, _, size, _ in files)
+        if sum(size for _, _, size, c in files if c) * 2 >= total:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = choose_encoding()
+            if encoding:
+                headers['Content-Encoding'] = encoding
+                body = EncodedBody(body, encoding)
+    response = Response(body, headers=headers, mimetype=FORMATS[fmt], direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', **content_disposition(download_name))
+    return response
+
+
+def requested_names():
+    # `name` values from the query string or a submitted form
+    return request.values.getlist('name')
@@ -0,0 +1,436 @@
+import argparse, http.client, json, logging, mimetypes, multiprocessing, os, random, shutil, signal, socket, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, send_file, jsonify
+from werkzeug.serving import make_server
+import file_archive
+import file_serve
+
+# Benchmarks for the file routes of speed.py and server.py. Run `python file_bench.py <command> -h` for options.
+
+MODES = ('send_file', 'read', 'sendfile')
+APPS = {'speed': ('speed.py', '/download/'), 'server': ('server.py', '/uploads/')}  # script, download route
+
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def make_app(folder, rtt=0.0):
+    app = Flask(__name__)
+
+    if rtt:
+        @app.before_request
+        def delay():
+            time.sleep(rtt)  # stands in for a network round trip per request
+
+    @app.route('/send_file/<name>')
+    def old(name):
+        # download_file before file_serve
+        path = os.path.join(folder, name)
+        return send_file(path, as_attachment=True, mimetype=mimetypes.guess_type(path)[0])
+
+    @app.route('/file_serve/<name>')
+    def new(name):
+        return file_serve.send_path(folder, name, as_attachment=True)
+
+    @app.route('/archive')
+    def archive():
+        names = sorted(n for n in os.listdir(folder) if not n.startswith('.'))
+        return file_archive.archive_response(folder, names, request.args.get('format', 'zip'))
+
+    @app.route('/cpu')
+    def cpu():
+        return jsonify(cpu=time.process_time())
+
+    return app
+
+
+def _serve(folder, mode, ports, rtt=0.0):
+    # One server process per mode, so its CPU time covers that mode only
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    file_serve.SENDFILE = mode == 'sendfile'
+    server = make_server('127.0.0.1', 0, make_app(folder, rtt), threaded=True)
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def fetch(port, path, headers=None, bufsize=1024 * 1024):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        resp = conn.getresponse()
+        buf = memoryview(bytearray(bufsize))
+        total = 0
+        while True:
+            n = resp.readinto(buf)
+            if not n:
+                break
+            total += n
+        if resp.status not in (200, 206):
+            raise RuntimeError(f'{path}: HTTP {resp.status}')
+        return total
+    finally:
+        conn.close()
+
+
+def fetch_raw(port, path, headers=None):
+    # Bytes as they came over the wire (no decoding of Content-Encoding)
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f'{path}: HTTP {resp.status}')
+        return len(data)
+    finally:
+        conn.close()
+
+
+def server_cpu(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        conn.request('GET', '/cpu')
+        return json.loads(conn.getresponse().read())['cpu']
+    finally:
+        conn.close()
+
+
+def bench_download(args):
+    # Client and server share the machine, so throughput is a lower bound; the CPU column
+    # is the server process alone.
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'bench.bin')
+    with open(path, 'wb') as f:
+        for _ in range(0, args.size, 1024 * 1024):
+            f.write(os.urandom(min(1024 * 1024, args.size - f.tell())))
+    print(f"{'mode':>10} {'clients':>8} {'requests':>9} {'MB/s':>9} {'req/s':>9} {'CPU s/GB':>9}")
+    try:
+        for mode in args.modes:
+            ports = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_serve, args=(folder, mode, ports), daemon=True)
+            proc.start()
+            port = ports.get()
+            route = f"/{'send_file' if mode == 'send_file' else 'file_serve'}/bench.bin"
+            try:
+                fetch(port, route)  # warm the page cache
+                for clients in args.clients:
+                    rng = random.Random(0)
+
+                    def one(_):
+                        if not args.range:
+                            return fetch(port, route)
+                        start = rng.randrange(0, max(args.size - args.range, 1))
+                        return fetch(port, route, {'Range': f'bytes={start}-{start + args.range - 1}'})
+
+                    cpu = server_cpu(port)
+                    begin = time.perf_counter()
+                    with ThreadPoolExecutor(clients) as pool:
+                        total = sum(pool.map(one, range(args.requests)))
+                    elapsed = time.perf_counter() - begin
+                    cpu = server_cpu(port) - cpu
+                    print(f"{mode:>10} {clients:>8} {args.requests:>9} {total / elapsed / 1e6:>9.1f} "
+                          f"{args.requests / elapsed:>9.1f} {cpu / (total / 1024 ** 3):>9.3f}")
+            finally:
+                proc.terminate()
+                proc.join()
+    finally:
+        os.remove(path)
+        os.rmdir(folder)
+
+
+def bench_many(args):
+    # Many small files: one request per file (the download route, `clients` at a time, as a
+    # browser would) against one streamed archive. --rtt adds a delay per request to stand
+    # in for Wi-Fi round trips, which is where per-file downloads lose most.
+    folder = tempfile.mkdtemp()
+    rng = random.Random(0)
+    words = [f'word{i}' for i in range(500)]
+    names, total = [], 0
+    for i in range(args.files):
+        name = f'file{i:05d}.{"txt" if args.kind == "text" else "jpg"}'
+        if args.kind == 'text':
+            data = ' '.join(rng.choice(words) for _ in range(args.file_size // 8)).encode()[:args.file_size]
+        else:
+            data = os.urandom(args.file_size)
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+        names.append(name)
+        total += len(data)
+    ports = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(folder, 'sendfile', ports, args.rtt / 1000), daemon=True)
+    proc.start()
+    port = ports.get()
+    print(f"{args.files} files, {total / 1e6:.1f} MB of {args.kind}, {args.rtt:g} ms per request")
+    print(f"{'method':>16} {'requests':>9} {'seconds':>9} {'wire MB':>9} {'files/s':>9}")
+    runs = [(f'per-file x{c}', c, None, {}) for c in args.clients]
+    runs += [('zip', 1, 'zip', {}), ('tar', 1, 'tar', {})]
+    runs += [(f'tar+{e}', 1, 'tar', {'Accept-Encoding': e}) for e in file_serve.encodings()]
+    try:
+        for label, clients, fmt, headers in runs:
+            begin = time.perf_counter()
+            if fmt is None:
+                with ThreadPoolExecutor(clients) as pool:
+                    wire = sum(pool.map(lambda n: fetch_raw(port, f'/file_serve/{n}', headers), names))
+                requests = len(names)
+            else:
+                wire = fetch_raw(port, f'/archive?format={fmt}', headers)
+                requests = 1
+            elapsed = time.perf_counter() - begin
+            print(f"{label:>16} {requests:>9} {elapsed:>9.2f} {wire / 1e6:>9.1f} {args.files / elapsed:>9.0f}")
+    finally:
+        proc.terminate()
+        proc.join()
+        for name in names:
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+
+
+def bench_pages(args):
+    # Index pages of speed.py and server.py through Flask's test client (no network): the
+    # template compiled once at startup, against render_template_string per request. The
+    # apps are imported as they are (creating their upload folders if missing), then
+    # pointed at a temp folder of --files files.
+    import flask
+    from file_index import DirectoryIndex
+    folder = tempfile.mkdtemp()
+    for i in range(args.files):
+        with open(os.path.join(folder, f'photo{i:05d}.jpg'), 'wb') as f:
+            f.write(bytes(i % 4096))
+    print(f"{'app':>8} {'templates':>18} {'req/s':>9}")
+    try:
+        for name in args.apps:
+            module = __import__(name)
+            module.folder_index = DirectoryIndex(folder)
+            compiled = module.render_template
+
+            def per_request(template, **context):
+                return flask.render_template_string(module.HTML_TEMPLATE, **context)
+
+            client = module.app.test_client()
+            for label, renderer in (('per request', per_request), ('compiled once', compiled)):
+                module.render_template = renderer
+                count, begin = 0, time.perf_counter()
+                while time.perf_counter() - begin < args.seconds:
+                    if client.get('/').status_code != 200:
+                        raise RuntimeError(f'{name}: index page failed')
+                    count += 1
+                print(f"{name:>8} {label:>18} {count / (time.perf_counter() - begin):>9.0f}")
+            module.render_template = compiled
+    finally:
+        for entry in os.scandir(folder):
+            os.remove(entry.path)
+        os.rmdir(folder)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _start(script, folder, options):
+    # The app as a separate server process on a free port, in its own session so the
+    # reloader and pre-fork workers are stopped with it
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, script), '--host', '127.0.0.1', '--port', str(port)] + options,
+                            env=dict(os.environ, UPLOAD_FOLDER=folder), cwd=folder, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            fetch(port, '/api/files')
+            return proc, port
+        except (OSError, RuntimeError, http.client.HTTPException):
+            if proc.poll() is not None or time.monotonic() > deadline:
+                _stop(proc)
+                raise RuntimeError(f'{script} {" ".join(options)} did not start')
+            time.sleep(0.2)
+
+
+def _stop(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def upload(host, port, name, data):
+    # multipart/form-data POST to /upload, as the upload forms send it
+    boundary = 'bench' + os.urandom(8).hex()
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    conn = http.client.HTTPConnection(host, port)
+    try:
+        conn.putrequest('POST', '/upload')
+        conn.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+        conn.putheader('Content-Length', str(len(head) + len(data) + len(tail)))
+        conn.endheaders()
+        conn.send(head)
+        conn.send(data)
+        conn.send(tail)
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status not in (200, 302, 303):
+            raise RuntimeError(f'upload {name}: HTTP {resp.status}')
+        return len(data)
+    finally:
+        conn.close()
+
+
+def _load_run(host, port, route, names, args):
+    # -> {op: [(seconds, bytes, ok)]} for a mix of uploads and downloads from `args.clients` threads
+    rng = random.Random(0)
+    ops = ['upload' if rng.random() < args.upload_share else 'download' for _ in range(args.requests)]
+    picks = [rng.choice(names) for _ in ops]
+    payload = os.urandom(args.upload_size)
+    token = os.urandom(4).hex()
+
+    def one(i):
+        begin = time.perf_counter()
+        try:
+            if ops[i] == 'upload':
+                size = upload(host, port, f'load-{token}-{i:05d}.bin', payload)
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=args.timeout)
+                try:
+                    conn.request('GET', route + picks[i])
+                    resp = conn.getresponse()
+                    size = 0
+                    while True:
+                        data = resp.read(1024 * 1024)
+                        if not data:
+                            break
+                        size += len(data)
+                    if resp.status != 200:
+                        raise RuntimeError(f'HTTP {resp.status}')
+                finally:
+                    conn.close()
+            return ops[i], time.perf_counter() - begin, size, True
+        except (OSError, RuntimeError, http.client.HTTPException):
+            return ops[i], time.perf_counter() - begin, 0, False
+
+    results = {'upload': [], 'download': []}
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as pool:
+        for op, seconds, size, ok in pool.map(one, range(len(ops))):
+            results[op].append((seconds, size, ok))
+    return results, time.perf_counter() - begin
+
+
+def bench_load(args):
+    # Many concurrent uploads and downloads against the real app. Without --url each server
+    # setup is started on a temp folder of --files files; with --url the files already
+    # listed by that instance are downloaded and the uploads are left in its folder.
+    # Client and server share the machine unless --url points elsewhere.
+    script, route = APPS[args.app]
+    setups = {'dev': ['--dev'],
+              'prod': ['--workers', str(args.workers), '--threads', str(args.threads)]}
+    print(f"{'server':>8} {'op':>9} {'requests':>9} {'errors':>7} {'MB/s':>8} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+
+    def report(label, results, elapsed):
+        for op, rows in results.items():
+            if not rows:
+                continue
+            ok = [seconds for seconds, _, good in rows if good]
+            total = sum(size for _, size, _ in rows)
+            print(f"{label:>8} {op:>9} {len(rows):>9} {len(rows) - len(ok):>7} {total / elapsed / 1e6:>8.1f} "
+                  f"{len(rows) / elapsed:>8.1f} {percentile(ok, 50) * 1000:>8.0f} {percentile(ok, 99) * 1000:>8.0f} "
+                  f"{max(ok, default=0) * 1000:>8.0f}")
+
+    if args.url:
+        host, _, port = args.url.split('//')[-1].rstrip('/').partition(':')
+        port = int(port or 80)
+        conn = http.client.HTTPConnection(host, port)
+        conn.request('GET', '/api/files?per_page=1000')
+        names = [f['name'] for f in json.loads(conn.getresponse().read())['files'] if not f['name'].startswith('.')]
+        conn.close()
+        if not names:
+            raise SystemExit('The instance lists no files to download.')
+        report('remote', *_load_run(host, port, route, names, args))
+        return
+
+    folder = tempfile.mkdtemp()
+    names = []
+    for i in range(args.files):
+        names.append(f'seed{i:04d}.bin')
+        with open(os.path.join(folder, names[-1]), 'wb') as f:
+            f.write(os.urandom(args.file_size))
+    try:
+        for label in args.servers:
+            proc, port = _start(script, folder, setups[label])
+            try:
+                report(label, *_load_run('127.0.0.1', port, route, names, args))
+            finally:
+                _stop(proc)
+                for entry in os.scandir(folder):
+                    if entry.name.startswith('load-'):
+                        os.remove(entry.path)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File download benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('download', help='throughput and server CPU per GB: send_file vs file_serve reads vs sendfile')
+    p.add_argument('--size', type=parse_size, default=parse_size('256M'), help='file size (default 256M)')
+    p.add_argument('--requests', type=int, default=8, help='downloads per run')
+    p.add_argument('--clients', type=int, nargs='+', default=[1, 4], help='concurrent downloads')
+    p.add_argument('--range', type=parse_size, default=0, metavar='SIZE',
+                   help='fetch random ranges of this size instead of the whole file')
+    p.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser('many', help='many small files: per-file downloads vs one streamed zip/tar archive')
+    p.add_argument('--files', type=int, default=2000)
+    p.add_argument('--file-size', type=parse_size, default=parse_size('32K'), help='bytes per file (default 32K)')
+    p.add_argument('--kind', choices=('photo', 'text'), default='photo',
+                   help='random bytes named .jpg (stored as is) or compressible .txt')
+    p.add_argument('--clients', type=int, nargs='+', default=[1, 6], help='parallel per-file downloads (browsers use 6)')
+    p.add_argument('--rtt', type=float, default=0, metavar='MS', help='extra delay per request, in milliseconds')
+    p.set_defaults(func=bench_many)
+
+    p = sub.add_parser('pages', help='index page requests/sec of speed.py and server.py: template compiled per request vs once')
+    p.add_argument('--apps', nargs='+', choices=('speed', 'server'), default=['speed', 'server'])
+    p.add_argument('--files', type=int, default=100, help='files in the listed folder (one page is 100)')
+    p.add_argument('--seconds', type=float, default=3, help='time spent on each app and mode')
+    p.set_defaults(func=bench_pages)
+
+    p = sub.add_parser('load', help='concurrent uploads and downloads against speed.py or server.py: throughput and tail latency')
+    p.add_argument('--app', choices=sorted(APPS), default='speed')
+    p.add_argument('--url', help='a running instance (e.g. http://phone:8080) instead of starting one')
+    p.add_argument('--servers', nargs='+', choices=('dev', 'prod'), default=['dev', 'prod'],
+                   help="app.run's development server and/or web_server.py")
+    p.add_argument('--workers', type=int, default=2, help='web_server.py processes')
+    p.add_argument('--threads', type=int, default=16, help='web_server.py threads per process')
+    p.add_argument('--clients', type=int, default=32, help='concurrent requests')
+    p.add_argument('--requests', type=int, default=400)
+    p.add_argument('--upload-share', type=float, default=0.3, help='fraction of requests that are uploads')
+    p.add_argument('--files', type=int, default=20, help='files to download from')
+    p.add_argument('--file-size', type=parse_size, default=parse_size('8M'))
+    p.add_argument('--upload-size', type=parse_size, default=parse_size('4M'))
+    p.add_argument('--timeout', type=float, default=120, help='client socket timeout in seconds')
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import os, stat, time, secrets, threading
+from flask import request, jsonify
+
+# Cached listing of the upload folder for speed.py and server.py.
+#
+# A watcher thread stats the folder every CHECK_INTERVAL seconds. Its mtime changes when
+# files are added, removed or renamed; only then is the folder scanned again, and only the
+# new names are stat'ed. Files rewritten in place keep the folder mtime, so their sizes are
+# picked up by a full rescan every RESCAN_INTERVAL seconds, or at once when the app
+# reports its own writes with update(). Sorted name lists are cached per sort key until
+# something changes, so serving a page costs a slice of a list, not a directory scan.
+CHECK_INTERVAL = 2.0
+RESCAN_INTERVAL = 300.0
+PER_PAGE = 100
+MAX_PER_PAGE = 1000
+SORT_KEYS = {
+    'name': lambda item: (item[0].lower(), item[0]),
+    'size': lambda item: (item[1][0], item[0].lower()),
+    'mtime': lambda item: (item[1][1], item[0].lower()),
+}
+
+
+class DirectoryIndex:
+    def __init__(self, folder, hidden=False, interval=CHECK_INTERVAL, rescan_interval=RESCAN_INTERVAL):
+        # `hidden` also lists dotfiles (speed.py keeps unfinished uploads in .partial)
+        self.folder = folder
+        self.hidden = hidden
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> (size, mtime)
+        self.generation = 0
+        self.token = secrets.token_hex(4)  # keeps ETags from one run from matching the next
+        self._dir_mtime = None
+        self._last_check = self._last_scan = 0.0
+        self._sorted = {}
+        self._recent = None
+        self._thread = None
+
+    def _changed(self):
+        self.generation += 1
+        self._sorted = {}
+
+    def refresh(self, full=False):
+        dir_mtime = os.stat(self.folder).st_mtime_ns
+        self._last_check = time.monotonic()
+        if not full and dir_mtime == self._dir_mtime:
+            return
+        with self.lock:
+            old = self.entries
+            self._recent = {}  # update() calls made while the folder is being scanned
+        entries = {}
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    name = entry.name
+                    if not self.hidden and name.startswith('.'):
+                        continue
+                    if not full and name in old:
+                        entries[name] = old[name]
+                        continue
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries[name] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        pass  # removed while scanning
+        finally:
+            with self.lock:
+                recent, self._recent = self._recent, None
+        with self.lock:
+            for name, value in recent.items():
+                if value is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = value
+            self._dir_mtime = dir_mtime
+            if full:
+                self._last_scan = self._last_check
+            if entries != self.entries:
+                self.entries = entries
+                self._changed()
+
+    def update(self, *names):
+        # Record files the app has just written, renamed or removed
+        for name in names:
+            if not self.hidden and name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+                value = (st.st_size, st.st_mtime) if stat.S_ISREG(st.st_mode) else None
+            except OSError:
+                value = None
+            with self.lock:
+                if self._recent is not None:
+                    self._recent[name] = value
+                if self.entries.get(name) == value:
+                    continue
+                if value is None:
+                    del self.entries[name]
+                else:
+                    self.entries[name] = value
+                self._changed()
+
+    def start(self):
+        # Scans once, then keeps the index fresh from a daemon thread
+        if self._thread is None:
+            self.refresh(full=True)
+            self._thread = threading.Thread(target=self._watch, name='directory-index', daemon=True)
+            self._thread.start()
+        return self
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh(full=time.monotonic() - self._last_scan >= self.rescan_interval)
+            except OSError:
+                pass  # folder briefly missing (e.g. storage remounting)
+
+    def _maybe_refresh(self):
+        # Without the watcher thread, requests check the folder at most once per interval
+        if self._thread is None and time.monotonic() - self._last_check >= self.interval:
+            self.refresh(full=time.monotonic() - self._last_scan >= self.rescan_interval)
+
+    def etag(self):
+        return f'{self.token}-{self.generation}'
+
+    def _ordered(self, sort):
+        # Names sorted by `sort`, cached until the next change; called with the lock held
+        names = self._sorted.get(sort)
+        if names is None:
+            names = self._sorted[sort] = [n for n, _ in sorted(self.entries.items(), key=SORT_KEYS[sort])]
+        return names
+
+    def names(self, sort='name'):
+        self._maybe_refresh()
+        with self.lock:
+            return list(self._ordered(sort))
+
+    def page(self, sort='name', reverse=False, page=1, per_page=PER_PAGE):
+        # -> (listing dict, etag)
+        self._maybe_refresh()
+        with self.lock:
+            names = self._ordered(sort)
+            total = len(names)
+            start = (page - 1) * per_page
+            if reverse:
+                chunk = names[max(total - start - per_page, 0):max(total - start, 0)][::-1]
+            else:
+                chunk = names[start:start + per_page]
+            files = [{'name': n, 'size': self.entries[n][0], 'mtime': self.entries[n][1]} for n in chunk]
+            listing = {'total': total, 'page': page, 'per_page': per_page, 'pages': max(-(-total // per_page), 1),
+                       'sort': sort, 'order': 'desc' if reverse else 'asc', 'files': files}
+            return listing, self.etag()
+
+
+def page_args():
+    # ?sort=name|size|mtime&order=asc|desc&page=N&per_page=N from the current request
+    args = request.args
+    sort = args.get('sort', 'name')
+    sort = sort if sort in SORT_KEYS else 'name'
+    page = max(args.get('page', 1, type=int), 1)
+    per_page = min(max(args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    return {'sort': sort, 'reverse': args.get('order') == 'desc', 'page': page, 'per_page': per_page}
+
+
+def listing_response(index):
+    # JSON page of the index; 304 when the client's ETag is still current
+    listing, etag = index.page(**page_args())
+    response = jsonify(listing)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
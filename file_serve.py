@@ -0,0 +1,268 @@
+import os, stat, zlib, secrets, mimetypes, unicodedata
+from urllib.parse import quote
+from flask import request, Response
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File downloads for speed.py and server.py.
+#
+# Responses carry a strong ETag built from the file's inode, mtime and size, so a
+# replaced or rewritten file never matches an old tag. If-None-Match / If-Modified-Since
+# answer 304, If-Match fails with 412, and Range requests (one range or several, with
+# If-Range) answer 206 or 416. Under the werkzeug server the body goes out with
+# socket.sendfile (os.sendfile underneath): the kernel copies page cache straight to
+# the socket and the request thread only waits. Other servers get their
+# wsgi.file_wrapper for whole files, or plain reads of READ_BLOCK bytes.
+#
+# Text-like files are compressed on the fly (zstd when the zstandard package or Python
+# 3.14 provides it, else gzip) if the client accepts it and sends no Range header.
+# Compressed responses have their own ETag and no Content-Length. Photos, video and
+# archives are already compressed and always go out as they are.
+READ_BLOCK = 256 * 1024
+MAX_RANGES = 16  # requests asking for more ranges than this get the whole file
+SENDFILE = True  # turn off if a middleware needs to see or rewrite the body
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSIBLE_PREFIXES = ('text/',)
+COMPRESSIBLE_SUFFIXES = ('+xml', '+json')
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/xml', 'application/x-tar', 'application/x-sh',
+    'application/sql', 'application/wasm', 'application/x-ndjson', 'image/svg+xml', 'image/bmp', 'audio/x-wav',
+}
+
+
+def file_etag(st):
+    return f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def parse_ranges(header, size):
+    # "bytes=0-99,-500,1000-" -> sorted, merged [start, stop) spans inside the file.
+    # None when the header is not a byte range set, [] when no range overlaps the file.
+    # (werkzeug's parser drops the whole header for overlapping or unordered ranges.)
+    units, _, spec = (header or '').partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+    spans = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash or not (first or last) or not (first or '0').isdigit() or not (last or '0').isdigit():
+            return None
+        if not first:  # "-N": the last N bytes
+            start, stop = max(size - int(last), 0), size
+        else:
+            start, stop = int(first), min(int(last) + 1, size) if last else size
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            spans.append([start, stop])
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def content_disposition(name):
+    try:
+        name.encode('ascii')
+        return {'filename': name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': "UTF-8''" + quote(name, safe="!#$&+^`|~")}
+
+
+def compressible(mimetype):
+    mimetype = (mimetype or '').split(';')[0].strip().lower()
+    return (mimetype.startswith(COMPRESSIBLE_PREFIXES) or mimetype.endswith(COMPRESSIBLE_SUFFIXES)
+            or mimetype in COMPRESSIBLE_TYPES)
+
+
+def encodings():
+    # Content codings this process can produce, preferred first
+    return ('zstd', 'gzip') if zstd or zstandard else ('gzip',)
+
+
+def choose_encoding():
+    # The client's preferred coding from Accept-Encoding, or None for identity
+    best = request.accept_encodings.best_match(encodings())
+    return best if best and request.accept_encodings[best] > 0 else None
+
+
+def compressor(encoding):
+    # Object with compress(data) and flush() for a content coding
+    if encoding == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zstd.ZstdCompressor(level=ZSTD_LEVEL)
+
+
+class EncodedBody:
+    # Compresses an iterable of bytes as it is sent; closing it closes the source
+    def __init__(self, chunks, encoding):
+        self.chunks = chunks
+        self.encoding = encoding
+
+    def __iter__(self):
+        encoder = compressor(self.encoding)
+        for chunk in self.chunks:
+            out = encoder.compress(chunk)
+            if out:
+                yield out
+        yield encoder.flush()
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+class FileBody:
+    # WSGI body made of bytes (multipart part headers) and (offset, length) regions of one
+    # open file. `sock` is the client socket when the server lets us write to it directly.
+    def __init__(self, f, parts, sock=None):
+        self.file = f
+        self.parts = parts
+        self.sock = sock
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            offset, length = part
+            if self.sock is not None:
+                # An empty write makes the server send the status line and headers first
+                yield b''
+                self.sock.sendfile(self.file, offset, length)
+                continue
+            self.file.seek(offset)
+            while length:
+                block = self.file.read(min(READ_BLOCK, length))
+                if not block:
+                    return  # the file shrank; the client sees a short body
+                length -= len(block)
+                yield block
+
+    def close(self):
+        self.file.close()
+
+
+def _not_modified(st, etag):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and int(st.st_mtime) <= since.timestamp()
+
+
+def _range_allowed(st, etag):
+    # If-Range: serve the ranges only if the client's copy is still this file
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(st.st_mtime) == if_range.date.timestamp()
+    return True
+
+
+def _body(f, parts, size):
+    environ = request.environ
+    sock = environ.get('werkzeug.socket') if SENDFILE else None
+    if sock is not None:
+        return FileBody(f, parts, sock)
+    if parts == [(0, size)] and 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](f, READ_BLOCK)  # gunicorn and uWSGI sendfile these
+    return FileBody(f, parts)
+
+
+def serve_file(path, as_attachment=False, download_name=None, mimetype=None, compress=True):
+    # Returns None if `path` is not a regular file
+    try:
+        # Checked before opening: opening a FIFO would block the request
+        if not stat.S_ISREG(os.stat(path).st_mode):
+            return None
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    try:
+        # fstat the open file, so the ETag always describes the bytes being sent
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            return None
+        size, etag = st.st_size, file_etag(st)
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        headers = {'Accept-Ranges': 'bytes', 'Last-Modified': http_date(st.st_mtime), 'Cache-Control': 'no-cache'}
+        encoding = None
+        if compress and size >= MIN_COMPRESS_SIZE and compressible(mimetype):
+            headers['Vary'] = 'Accept-Encoding'
+            if 'Range' not in request.headers:
+                encoding = choose_encoding()
+                if encoding:
+                    etag = f'{etag}-{encoding}'  # a different representation needs a different tag
+        headers['ETag'] = f'"{etag}"'
+
+        if request.if_match and not request.if_match.contains(etag):
+            f.close()
+            return Response(status=412, headers=headers)
+        if request.method in ('GET', 'HEAD') and _not_modified(st, etag):
+            f.close()
+            return Response(status=304, headers=headers)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            response = Response(EncodedBody(FileBody(f, [(0, size)]), encoding), headers=headers,
+                                mimetype=mimetype, direct_passthrough=True)
+        else:
+            status, parts, length = 200, [(0, size)], size
+            spans = parse_ranges(request.headers.get('Range'), size) if request.method == 'GET' else None
+            if spans is not None and _range_allowed(st, etag):
+                if not spans:
+                    f.close()
+                    headers['Content-Range'] = f'bytes */{size}'
+                    return Response(status=416, headers=headers)
+                if len(spans) == 1:
+                    start, stop = spans[0]
+                    status, parts, length = 206, [(start, stop - start)], stop - start
+                    headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+                elif len(spans) <= MAX_RANGES:
+                    boundary = secrets.token_hex(16)
+                    parts = []
+                    for start, stop in spans:
+                        parts.append(f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                                     f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'.encode())
+                        parts.append((start, stop - start))
+                    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+                    status = 206
+                    length = sum(len(p) if isinstance(p, bytes) else p[1] for p in parts)
+                    mimetype = f'multipart/byteranges; boundary={boundary}'
+
+            response = Response(_body(f, parts, size), status=status, headers=headers, mimetype=mimetype,
+                                direct_passthrough=True)
+    except BaseException:
+        f.close()
+        raise
+    if not encoding:
+        response.content_length = length
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment',
+                             **content_disposition(download_name or os.path.basename(path)))
+    return response
+
+
+def send_path(folder, filename, **kwargs):
+    # serve_file for a name inside `folder`; None for missing files and names that escape it
+    path = safe_join(folder, filename)
+    return None if path is None else serve_file(path, **kwargs)
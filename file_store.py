@@ -0,0 +1,237 @@
+import os, re, hashlib, secrets, sqlite3, tempfile, threading
+
+# Content-addressed storage for uploads, used by speed.py and server.py when UPLOAD_DEDUP=1.
+#
+# Every distinct file is stored once, as .blobs/<first two hex digits>/<sha256> inside the
+# upload folder, and each visible name is a hard link to its blob. Downloads, the folder
+# listing and file_serve.py therefore need no changes. Blobs are read-only, so nothing can
+# rewrite a file in place under another name's feet; new content always arrives through
+# a rename. A SQLite catalog maps names to digests and counts the names using each blob,
+# and a blob is deleted together with its last name. A client that knows a file's SHA-256
+# can ask has() first and link() a name to it without sending the body.
+BLOB_DIR = '.blobs'
+CATALOG = 'catalog.db'
+COPY_BUFFER = 1024 * 1024
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+)
+
+# Taken before reading a row the transaction then updates, so concurrent worker processes
+# (web_server.py --workers) cannot both read the same old refcount
+SQL_BEGIN = 'BEGIN IMMEDIATE'
+SQL_CREATE_BLOBS = 'CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)'
+SQL_CREATE_NAMES = 'CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, digest TEXT NOT NULL)'
+SQL_INDEX_NAMES_DIGEST = 'CREATE INDEX IF NOT EXISTS idx_names_digest ON names (digest)'
+SQL_GET_BLOB = 'SELECT size FROM blobs WHERE digest=?'
+SQL_GET_NAME = 'SELECT digest FROM names WHERE name=?'
+SQL_ALL_NAMES = 'SELECT name, digest FROM names'
+SQL_ADD_BLOB = 'INSERT OR IGNORE INTO blobs (digest, size, refs) VALUES (?, ?, 0)'
+SQL_SET_NAME = 'INSERT OR REPLACE INTO names (name, digest) VALUES (?, ?)'
+SQL_DELETE_NAME = 'DELETE FROM names WHERE name=?'
+SQL_ADD_REFS = 'UPDATE blobs SET refs = refs + ? WHERE digest=?'
+SQL_UNUSED_BLOBS = 'SELECT digest FROM blobs WHERE refs <= 0'
+SQL_DELETE_BLOB = 'DELETE FROM blobs WHERE digest=?'
+SQL_STATS = 'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refs), 0) FROM blobs'
+
+
+def valid_name(name):
+    # Plain names only: no paths, and nothing hidden (which would reach .blobs)
+    return bool(name) and '/' not in name and '\\' not in name and not name.startswith('.')
+
+
+def save_file(path, stream):
+    # Upload without the store: the body goes to a new file that is renamed over `path`. A name
+    # left as a hard link to a blob (by an earlier run with UPLOAD_DEDUP=1) is replaced, never
+    # written through, so the blob and every other name linked to it keep their content.
+    fd, tmp = tempfile.mkstemp(prefix='.upload-', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for block in iter(lambda: stream.read(COPY_BUFFER), b''):
+                f.write(block)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class BlobStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.root = os.path.join(folder, BLOB_DIR)
+        self.tmp = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+        self._check_links()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, CATALOG), check_same_thread=False)
+        for pragma in PRAGMAS:
+            self.db.execute(pragma)
+        with self.db:
+            self.db.execute(SQL_CREATE_BLOBS)
+            self.db.execute(SQL_CREATE_NAMES)
+            self.db.execute(SQL_INDEX_NAMES_DIGEST)
+        self.check()
+
+    def _check_links(self):
+        probe = os.path.join(self.tmp, 'link-probe')
+        open(probe, 'w').close()
+        try:
+            os.link(probe, probe + '.link')
+            os.remove(probe + '.link')
+        except OSError as e:
+            raise RuntimeError(f'Deduplicated uploads need hard links, which {self.folder} does not support '
+                               f'({e.strerror}). Use a folder on another filesystem or turn UPLOAD_DEDUP off.')
+        finally:
+            os.remove(probe)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        # Size of the stored blob, or None
+        if not DIGEST_RE.match(digest or ''):
+            return None
+        with self.lock:
+            row = self.db.execute(SQL_GET_BLOB, (digest,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, name, stream):
+        # Streams an upload to a temp file, hashing it on the way, then stores it by digest
+        if not valid_name(name):
+            raise ValueError(f'Invalid file name: {name!r}')
+        sha = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: stream.read(COPY_BUFFER), b''):
+                    sha.update(block)
+                    f.write(block)
+            return self._commit(name, tmp, sha.hexdigest())
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def adopt(self, name, path, digest=None):
+        # Moves a file that is already on disk (a finished resumable upload) into the store.
+        # Pass `digest` if the file's SHA-256 is already known to skip reading it again.
+        if not valid_name(name):
+            raise ValueError(f'Invalid file name: {name!r}')
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(COPY_BUFFER), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()
+        try:
+            return self._commit(name, path, digest)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def link(self, name, digest):
+        # Gives `name` the content of a stored blob; None if the blob is unknown
+        if not valid_name(name):
+            raise ValueError(f'Invalid file name: {name!r}')
+        if not DIGEST_RE.match(digest or ''):
+            return None
+        with self.lock:
+            row = self.db.execute(SQL_GET_BLOB, (digest,)).fetchone()
+            if row is None:
+                return None
+            size = row[0]
+            self._link(name, digest, size)
+        return {'name': name, 'size': size, 'sha256': digest, 'duplicate': True}
+
+    def _commit(self, name, path, digest):
+        size = os.path.getsize(path)
+        blob = self.blob_path(digest)
+        with self.lock:
+            duplicate = os.path.exists(blob)
+            if not duplicate:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.chmod(path, 0o444)
+                os.replace(path, blob)
+            self._link(name, digest, size)
+        return {'name': name, 'size': size, 'sha256': digest, 'duplicate': duplicate}
+
+    def _link(self, name, digest, size):
+        # Called with the lock held. The new link replaces the visible name atomically.
+        tmp = os.path.join(self.tmp, secrets.token_hex(8))
+        os.link(self.blob_path(digest), tmp)
+        os.replace(tmp, os.path.join(self.folder, name))
+        if os.path.exists(tmp):
+            os.remove(tmp)  # the name was already this blob: rename() left both links alone
+        with self.db:
+            self.db.execute(SQL_BEGIN)
+            old = self.db.execute(SQL_GET_NAME, (name,)).fetchone()
+            self.db.execute(SQL_ADD_BLOB, (digest, size))
+            self.db.execute(SQL_SET_NAME, (name, digest))
+            self.db.execute(SQL_ADD_REFS, (1, digest))
+            if old:
+                self.db.execute(SQL_ADD_REFS, (-1, old[0]))
+        if old and old[0] != digest:
+            self._collect()
+
+    def renamed(self, old, new):
+        # Follows a rename the app did itself (server.py's re-upload)
+        with self.lock, self.db:
+            self.db.execute(SQL_BEGIN)
+            row = self.db.execute(SQL_GET_NAME, (old,)).fetchone()
+            if row is None:
+                return
+            replaced = self.db.execute(SQL_GET_NAME, (new,)).fetchone()
+            self.db.execute(SQL_DELETE_NAME, (old,))
+            self.db.execute(SQL_SET_NAME, (new, row[0]))
+            if replaced:
+                self.db.execute(SQL_ADD_REFS, (-1, replaced[0]))
+        self._collect_locked()
+
+    def forget(self, name):
+        with self.lock, self.db:
+            self.db.execute(SQL_BEGIN)
+            row = self.db.execute(SQL_GET_NAME, (name,)).fetchone()
+            if row is None:
+                return
+            self.db.execute(SQL_DELETE_NAME, (name,))
+            self.db.execute(SQL_ADD_REFS, (-1, row[0]))
+        self._collect_locked()
+
+    def check(self):
+        # Drops names that were deleted or replaced behind the store's back; run at startup
+        with self.lock:
+            rows = self.db.execute(SQL_ALL_NAMES).fetchall()
+        gone = []
+        for name, digest in rows:
+            try:
+                if not os.path.samefile(os.path.join(self.folder, name), self.blob_path(digest)):
+                    gone.append(name)
+            except OSError:
+                gone.append(name)
+        for name in gone:
+            self.forget(name)
+        self._collect_locked()
+        return len(gone)
+
+    def _collect_locked(self):
+        with self.lock:
+            self._collect()
+
+    def _collect(self):
+        # Deletes blobs no name uses any more; called with the lock held
+        with self.db:
+            for (digest,) in self.db.execute(SQL_UNUSED_BLOBS).fetchall():
+                path = self.blob_path(digest)
+                try:
+                    os.remove(path)
+                    os.rmdir(os.path.dirname(path))  # only succeeds once the directory is empty
+                except OSError:
+                    pass
+                self.db.execute(SQL_DELETE_BLOB, (digest,))
+
+    def stats(self):
+        with self.lock:
+            blobs, stored, referenced = self.db.execute(SQL_STATS).fetchone()
+        return {'blobs': blobs, 'stored_bytes': stored, 'saved_bytes': referenced - stored}
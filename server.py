@@ -1,13 +1,28 @@
-from flask import Flask, request, render_template_string, redirect, url_for, send_from_directory
-import os
+from flask import Flask, request, render_template, redirect, url_for, abort, jsonify
+import os, argparse
+from file_serve import send_path
+from web_assets import AssetBundle
+import web_server
+from file_index import DirectoryIndex, page_args, listing_response
+from file_store import BlobStore, save_file
+from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 
-# Define upload directory in Termux home
-UPLOAD_FOLDER = os.path.expanduser("~/hi/uploads")
+# Bootstrap CSS served from static/ with far-future cache headers, see web_assets.py
+assets = AssetBundle().init_app(app)
+
+# Define upload directory in Termux home (UPLOAD_FOLDER overrides it)
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER") or os.path.expanduser("~/hi/uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+# Optional deduplicated storage (UPLOAD_DEDUP=1): identical files are stored once, see file_store.py
+blobs = BlobStore(UPLOAD_FOLDER) if os.environ.get('UPLOAD_DEDUP') == '1' else None
+
+# Cached folder listing: see file_index.py. Routes that write files report them with update().
+folder_index = DirectoryIndex(UPLOAD_FOLDER, hidden=True).start()
 #You can edit this
 # HTML Template
 HTML_TEMPLATE = '''
@@ -17,7 +32,7 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>File Upload & Re-Upload</title>
-    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css">
+    <link rel="stylesheet" href="{{ asset_url('bootstrap.min.css') }}">
 </head>
 <body class="container mt-5">
     <h1 class="text-center">Upload and Re-Upload Files</h1>
@@ -32,40 +47,87 @@ HTML_TEMPLATE = '''
 
     <!-- File List -->
     <h2 class="mt-5">Uploaded Files</h2>
+    <p class="text-muted small">{{ listing.total }} files &middot; sort by
+        <a href="{{ url_for('index', sort='name') }}">name</a>,
+        <a href="{{ url_for('index', sort='size', order='desc') }}">size</a>,
+        <a href="{{ url_for('index', sort='mtime', order='desc') }}">newest</a></p>
     <ul class="list-group">
-        {% for file in files %}
+        {% for file in listing.files %}
             <li class="list-group-item d-flex justify-content-between align-items-center">
-                <a href="{{ url_for('uploaded_file', filename=file) }}" target="_blank">{{ file }}</a>
-                <a href="{{ url_for('reupload_file', filename=file) }}" class="btn btn-warning btn-sm">Re-Upload</a>
+                <span><a href="{{ url_for('uploaded_file', filename=file.name) }}" target="_blank">{{ file.name }}</a>
+                    <small class="text-muted">{{ file.size|filesizeformat }}</small></span>
+                <a href="{{ url_for('reupload_file', filename=file.name) }}" class="btn btn-warning btn-sm">Re-Upload</a>
             </li>
         {% endfor %}
     </ul>
+    {% if listing.pages > 1 %}
+    <nav class="mt-3">
+        <ul class="pagination justify-content-center">
+            {% if listing.page > 1 %}
+                <li class="page-item"><a class="page-link" href="{{ url_for('index', page=listing.page - 1, sort=listing.sort, order=listing.order) }}">Previous</a></li>
+            {% endif %}
+            <li class="page-item disabled"><span class="page-link">{{ listing.page }} / {{ listing.pages }}</span></li>
+            {% if listing.page < listing.pages %}
+                <li class="page-item"><a class="page-link" href="{{ url_for('index', page=listing.page + 1, sort=listing.sort, order=listing.order) }}">Next</a></li>
+            {% endif %}
+        </ul>
+    </nav>
+    {% endif %}
 
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
 </body>
 </html>
 '''
 
+# Compiled once; render_template_string would parse and compile it again on every request
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 @app.route('/')
 def index():
-    files = os.listdir(UPLOAD_FOLDER)
-    return render_template_string(HTML_TEMPLATE, files=files)
+    listing, _ = folder_index.page(**page_args())
+    return render_template(INDEX_TEMPLATE, listing=listing)
+
+@app.route('/api/files')
+def list_files():
+    # ?sort=name|size|mtime&order=asc|desc&page=N&per_page=N, revalidated with ETag
+    return listing_response(folder_index)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
-        return redirect(url_for('index'))
-    
-    file = request.files['file']
-    if file.filename == '':
-        return redirect(url_for('index'))
-
-    file.save(os.path.join(UPLOAD_FOLDER, file.filename))
+    # Every file of a multiple selection
+    for file in request.files.getlist('file'):
+        filename = secure_filename(file.filename or '')
+        if not filename:
+            continue
+        if blobs is not None:
+            blobs.save(filename, file.stream)  # hashed while it streams; stored once per content
+        else:
+            save_file(os.path.join(UPLOAD_FOLDER, filename), file.stream)
+        folder_index.update(filename)
     return redirect(url_for('index'))
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_path(app.config['UPLOAD_FOLDER'], filename) or abort(404)
+
+@app.route('/api/blobs/<digest>', methods=['GET'])
+def blob_status(digest):
+    # "Do you already have this file?" by SHA-256: its size, or 404
+    size = blobs.has(digest.lower()) if blobs is not None else None
+    if size is None:
+        return jsonify(error='Not stored.'), 404
+    return jsonify(sha256=digest.lower(), size=size)
+
+@app.route('/api/blobs/<digest>', methods=['POST'])
+def blob_link(digest):
+    # {"name": ...}: creates the file from a stored blob, so the body never has to be sent
+    name = secure_filename((request.get_json(silent=True) or {}).get('name') or '')
+    if not name:
+        return jsonify(error='A file name is required.'), 400
+    result = blobs.link(name, digest.lower()) if blobs is not None else None
+    if result is None:
+        return jsonify(error='Not stored.'), 404
+    folder_index.update(name)
+    return jsonify(result), 201
 
 @app.route('/reupload/<filename>')
 def reupload_file(filename):
@@ -73,7 +135,16 @@ def reupload_file(filename):
     if os.path.exists(original_path):
         new_path = os.path.join(UPLOAD_FOLDER, f"reuploaded_{filename}")
         os.rename(original_path, new_path)  # Rename to simulate re-upload
+        if blobs is not None:
+            blobs.renamed(filename, f"reuploaded_{filename}")
+        folder_index.update(filename, f"reuploaded_{filename}")
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    parser = argparse.ArgumentParser(description='File upload and re-upload server')
+    web_server.add_arguments(parser, port=8080)
+    args = parser.parse_args()
+    if args.dev:
+        app.run(host=args.host, port=args.port, debug=True)  # reloader and debugger: never expose this
+    else:
+        web_server.serve(app, args)
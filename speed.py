@@ -1,16 +1,34 @@
-from flask import Flask, request, render_template_string, redirect, url_for, send_file, Response
-import os
-import mimetypes
+from flask import Flask, request, render_template, redirect, url_for, Response, jsonify
+import os, argparse
 from werkzeug.utils import secure_filename
+from speed_uploads import UploadStore, UploadError
+from file_serve import send_path
+from web_assets import AssetBundle
+import web_server
+from file_index import DirectoryIndex, page_args, listing_response
+from file_store import BlobStore, save_file
+from file_archive import MAX_FILES, archive_response, requested_names
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 
-# Define upload directory in /sdcard/upload/
-UPLOAD_FOLDER = "/sdcard/upload"
+# Bootstrap CSS served from static/ with far-future cache headers, see web_assets.py
+assets = AssetBundle().init_app(app)
+
+# Define upload directory in /sdcard/upload/ (UPLOAD_FOLDER overrides it)
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "/sdcard/upload")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Optional deduplicated storage (UPLOAD_DEDUP=1): identical files are stored once, see file_store.py
+blobs = BlobStore(UPLOAD_FOLDER) if os.environ.get('UPLOAD_DEDUP') == '1' else None
+
+# Resumable uploads: see speed_uploads.py for the protocol
+uploads = UploadStore(UPLOAD_FOLDER, blobs)
+
+# Cached folder listing: see file_index.py. Routes that write files report them with update().
+folder_index = DirectoryIndex(UPLOAD_FOLDER).start()
+
 # HTML Template
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -19,7 +37,7 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Fast File Upload & Download</title>
-    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css">
+    <link rel="stylesheet" href="{{ asset_url('bootstrap.min.css') }}">
     <style>
         body { background-color: #f8f9fa; }
         .container { max-width: 600px; margin-top: 50px; background: white; padding: 20px; border-radius: 10px; box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1); }
@@ -37,64 +55,301 @@ HTML_TEMPLATE = '''
 
         <div id="upload-section" class="mt-4">
             <h2>Upload File</h2>
-            <form action="{{ url_for('upload_file') }}" method="post" enctype="multipart/form-data">
+            <form id="upload-form" action="{{ url_for('upload_file') }}" method="post" enctype="multipart/form-data">
                 <div class="input-group">
-                    <input type="file" name="file" class="form-control" required>
+                    <input type="file" name="file" class="form-control" multiple required>
                     <button type="submit" class="btn btn-primary">Upload</button>
                 </div>
             </form>
+            <div id="upload-progress" class="mt-3"></div>
         </div>
 
         <div id="file-list" class="mt-5">
             <h2>Uploaded Files</h2>
+            <p class="text-muted small">{{ listing.total }} files &middot; sort by
+                <a href="{{ url_for('index', sort='name') }}">name</a>,
+                <a href="{{ url_for('index', sort='size', order='desc') }}">size</a>,
+                <a href="{{ url_for('index', sort='mtime', order='desc') }}">newest</a></p>
             <ul class="list-group">
-                {% for file in files %}
+                {% for file in listing.files %}
                     <li class="list-group-item d-flex justify-content-between align-items-center">
-                        <span>{{ file }}</span>
-                        <a href="{{ url_for('download_file', filename=file) }}" class="btn btn-success btn-sm">Download</a>
+                        <label class="text-break">
+                            <input type="checkbox" class="form-check-input me-2" name="name" value="{{ file.name }}" form="archive-form">
+                            {{ file.name }} <small class="text-muted">{{ file.size|filesizeformat }}</small>
+                        </label>
+                        <a href="{{ url_for('download_file', filename=file.name) }}" class="btn btn-success btn-sm">Download</a>
                     </li>
                 {% endfor %}
             </ul>
+            <form id="archive-form" action="{{ url_for('download_archive') }}" method="post" class="d-flex gap-2 mt-3">
+                <select name="format" class="form-select w-auto">
+                    <option value="zip">ZIP</option>
+                    <option value="tar">tar</option>
+                </select>
+                <button type="submit" class="btn btn-outline-success">Download selected</button>
+                <button type="submit" name="all" value="1" class="btn btn-outline-secondary">Download all</button>
+            </form>
+            {% if listing.pages > 1 %}
+            <nav class="mt-3">
+                <ul class="pagination justify-content-center">
+                    {% if listing.page > 1 %}
+                        <li class="page-item"><a class="page-link" href="{{ url_for('index', page=listing.page - 1, sort=listing.sort, order=listing.order) }}">Previous</a></li>
+                    {% endif %}
+                    <li class="page-item disabled"><span class="page-link">{{ listing.page }} / {{ listing.pages }}</span></li>
+                    {% if listing.page < listing.pages %}
+                        <li class="page-item"><a class="page-link" href="{{ url_for('index', page=listing.page + 1, sort=listing.sort, order=listing.order) }}">Next</a></li>
+                    {% endif %}
+                </ul>
+            </nav>
+            {% endif %}
         </div>
     </div>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+    <script>
+    // Resumable uploader: files go up in chunks, several at a time, through the /uploads API.
+    // An interrupted upload resumes from its missing chunks when the same file is picked again.
+    const PARALLEL_CHUNKS = 4;
+    const MAX_RETRIES = 6;
+
+    // Pages served over plain http (the usual LAN case) have no crypto.subtle, so fall back to CRC32
+    const CRC_TABLE = new Uint32Array(256).map((_, n) => {
+        for (let k = 0; k < 8; k++) n = n & 1 ? 0xEDB88320 ^ (n >>> 1) : n >>> 1;
+        return n >>> 0;
+    });
+    function crc32(buffer) {
+        const bytes = new Uint8Array(buffer);
+        let c = 0xFFFFFFFF;
+        for (let i = 0; i < bytes.length; i++) c = CRC_TABLE[(c ^ bytes[i]) & 0xFF] ^ (c >>> 8);
+        return ((c ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+    }
+    const ALGORITHM = window.crypto && crypto.subtle ? 'sha256' : 'crc32';
+    async function checksum(buffer) {
+        if (ALGORITHM === 'crc32') return crc32(buffer);
+        const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', buffer));
+        return Array.from(digest, b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    // With deduplication on, a file the server already has gets linked instead of uploaded.
+    // Hashing needs crypto.subtle and the whole file in memory, so only up to DEDUP_MAX bytes.
+    const DEDUP = {{ 'true' if dedup else 'false' }};
+    const DEDUP_MAX = 256 * 1024 * 1024;
+    async function linkExisting(file) {
+        if (!DEDUP || ALGORITHM !== 'sha256' || file.size > DEDUP_MAX) return false;
+        const digest = await checksum(await file.arrayBuffer());
+        const response = await fetch(`/api/blobs/${digest}`, {
+            method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({name: file.name}),
+        }).catch(() => null);
+        return Boolean(response && response.ok);
+    }
+
+    class FatalError extends Error {}
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+    async function request(url, options) {
+        // Retries network errors and 5xx with backoff; other errors are final
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const response = await fetch(url, options);
+                if (response.ok) return response.json();
+                const message = (await response.json().catch(() => ({}))).error || response.statusText;
+                if (response.status < 500) throw new FatalError(message);
+                if (attempt >= MAX_RETRIES) throw new Error(message);
+            } catch (e) {
+                if (e instanceof FatalError || attempt >= MAX_RETRIES) throw e;
+            }
+            await sleep(Math.min(30000, 500 * 2 ** attempt));
+        }
+    }
+
+    async function startUpload(file) {
+        const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+        const saved = localStorage.getItem(key);
+        if (saved) {
+            const status = await fetch(`/uploads/${saved}`).then(r => r.ok ? r.json() : null).catch(() => null);
+            if (status) return [key, status];
+        }
+        const status = await request('/uploads', {
+            method: 'POST', headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({name: file.name, size: file.size}),
+        });
+        localStorage.setItem(key, status.id);
+        return [key, status];
+    }
+
+    async function uploadFile(file, bar) {
+        if (await linkExisting(file)) {
+            bar.style.width = '100%';
+            return;
+        }
+        const [key, status] = await startUpload(file);
+        const size = status.chunk_size, received = new Set(status.received);
+        const sums = new Array(status.chunks);
+        let next = 0, sent = status.bytes_received;
+        bar.style.width = `${100 * sent / Math.max(file.size, 1)}%`;
+
+        async function worker() {
+            while (next < status.chunks) {
+                const index = next++;
+                const buffer = await file.slice(index * size, Math.min(file.size, (index + 1) * size)).arrayBuffer();
+                sums[index] = await checksum(buffer);
+                if (received.has(index)) continue;
+                await request(`/uploads/${status.id}?offset=${index * size}`, {
+                    method: 'PUT', headers: {'X-Chunk-Checksum': `${ALGORITHM}=${sums[index]}`}, body: buffer,
+                });
+                sent += buffer.byteLength;
+                bar.style.width = `${100 * sent / file.size}%`;
+            }
+        }
+        await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+        await request(`/uploads/${status.id}/finalize`, {
+            method: 'POST', headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({algorithm: ALGORITHM, chunks: sums}),
+        });
+        localStorage.removeItem(key);
+    }
+
+    document.getElementById('upload-form').addEventListener('submit', async event => {
+        if (!window.fetch || !window.localStorage) return;  // plain form post instead
+        event.preventDefault();
+        const files = Array.from(event.target.elements.file.files);
+        const box = document.getElementById('upload-progress');
+        let failed = false;
+        for (const file of files) {
+            const row = document.createElement('div');
+            row.innerHTML = '<div class="small"></div><div class="progress"><div class="progress-bar"></div></div>';
+            row.firstChild.textContent = file.name;
+            box.appendChild(row);
+            const bar = row.querySelector('.progress-bar');
+            try {
+                await uploadFile(file, bar);
+                bar.classList.add('bg-success');
+            } catch (e) {
+                failed = true;
+                bar.classList.add('bg-danger');
+                row.firstChild.textContent = `${file.name}: ${e.message} (pick the file again to resume)`;
+            }
+        }
+        if (!failed) location.reload();
+    });
+    </script>
 </body>
 </html>
 '''
 
+# Compiled once; render_template_string would parse and compile it again on every request
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 @app.route('/')
 def index():
-    files = os.listdir(UPLOAD_FOLDER)
-    return render_template_string(HTML_TEMPLATE, files=files)
+    listing, _ = folder_index.page(**page_args())
+    return render_template(INDEX_TEMPLATE, listing=listing, dedup=blobs is not None)
+
+@app.route('/api/files')
+def list_files():
+    # ?sort=name|size|mtime&order=asc|desc&page=N&per_page=N, revalidated with ETag
+    return listing_response(folder_index)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
-        return redirect(url_for('index'))
-    
-    file = request.files['file']
-    if file.filename == '':
-        return redirect(url_for('index'))
-    
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-
-    # Speed optimized file saving
-    with open(file_path, "wb") as f:
-        for chunk in file.stream:
-            f.write(chunk)
-
+    # Every file of a multiple selection (without JavaScript; the page's script uses /uploads)
+    for file in request.files.getlist('file'):
+        filename = secure_filename(file.filename or '')
+        if not filename:
+            continue
+        if blobs is not None:
+            blobs.save(filename, file.stream)  # hashed while it streams; stored once per content
+        else:
+            save_file(os.path.join(UPLOAD_FOLDER, filename), file.stream)
+        folder_index.update(filename)
     return redirect(url_for('index'))
 
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify(error=str(e)), e.status
+
+@app.route('/uploads', methods=['POST'])
+def upload_init():
+    # {"name": ..., "size": ..., "chunk_size": optional} -> upload status with its id
+    data = request.get_json(silent=True) or {}
+    return jsonify(uploads.create(data.get('name'), data.get('size'), data.get('chunk_size'), secure_filename)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    return jsonify(uploads.status(upload_id))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    # The raw body is one chunk; reading request.stream avoids multipart parsing and spooling
+    offset = request.args.get('offset', type=int)
+    status = uploads.write_chunk(upload_id, offset, request.stream, request.content_length,
+                                 request.headers.get('X-Chunk-Checksum'))
+    return jsonify(status)
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    # {"algorithm": "sha256"|"crc32", "chunks": [...]} or {"sha256": "<whole file>"}
+    data = request.get_json(silent=True) or {}
+    result = uploads.finalize(upload_id, data.get('algorithm'), data.get('chunks'), data.get('sha256'))
+    folder_index.update(result['name'])
+    return jsonify(result)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def upload_abort(upload_id):
+    uploads.abort(upload_id)
+    return '', 204
+
+@app.route('/api/blobs', methods=['GET'])
+def blob_stats():
+    if blobs is None:
+        raise UploadError('Deduplication is off.', 404)
+    return jsonify(blobs.stats())
+
+@app.route('/api/blobs/<digest>', methods=['GET'])
+def blob_status(digest):
+    # "Do you already have this file?" by SHA-256: its size, or 404
+    size = blobs.has(digest.lower()) if blobs is not None else None
+    if size is None:
+        raise UploadError('Not stored.', 404)
+    return jsonify(sha256=digest.lower(), size=size)
+
+@app.route('/api/blobs/<digest>', methods=['POST'])
+def blob_link(digest):
+    # {"name": ...}: creates the file from a stored blob, so the body never has to be sent
+    name = secure_filename((request.get_json(silent=True) or {}).get('name') or '')
+    if not name:
+        raise UploadError('A file name is required.')
+    result = blobs.link(name, digest.lower()) if blobs is not None else None
+    if result is None:
+        raise UploadError('Not stored.', 404)
+    folder_index.update(name)
+    return jsonify(result), 201
+
 @app.route('/download/<filename>')
 def download_file(filename):
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-
-    if os.path.exists(file_path):
-        mimetype, _ = mimetypes.guess_type(file_path)
-        return send_file(file_path, as_attachment=True, mimetype=mimetype)
+    # Range, ETag and 304 handling, with sendfile under the werkzeug server
+    response = send_path(UPLOAD_FOLDER, filename, as_attachment=True)
+    if response is None:
+        return "File not found", 404
+    return response
 
-    return "File not found", 404
+@app.route('/archive', methods=['GET', 'POST'])
+def download_archive():
+    # One streamed ZIP or tar of the `name` files, or of the whole folder with all=1
+    if request.values.get('all'):
+        names = folder_index.names()
+    else:
+        names = requested_names()
+        if len(names) > MAX_FILES:
+            return f"Too many files selected: at most {MAX_FILES}, or use all=1 for the whole folder", 413
+    response = archive_response(UPLOAD_FOLDER, names, request.values.get('format', 'zip'))
+    if response is None:
+        return "No files selected", 400
+    return response
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)	
+    parser = argparse.ArgumentParser(description='Fast file upload and download server')
+    web_server.add_arguments(parser, port=8080)
+    args = parser.parse_args()
+    if args.dev:
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    else:
+        web_server.serve(app, args)
@@ -0,0 +1,237 @@
+import os, re, json, errno, time, zlib, hashlib, secrets, threading, contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: one process only
+
+# Resumable chunked uploads for speed.py.
+#
+# An upload is a preallocated `<id>.part` file plus a `<id>.json` state file, both in a
+# hidden `.partial` directory under the upload folder, so an upload survives dropped
+# connections and server restarts. The file is split into fixed-size chunks; each PUT
+# writes one chunk straight into the part file at its offset and records the chunk's
+# SHA-256 and CRC32, holding the upload's lock so that chunks of one upload are written one at
+# a time (different uploads still proceed in parallel). Finalizing compares the client's per-chunk checksums (or a whole-file
+# SHA-256) and renames the part file into place.
+CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+PARTIAL_MAX_AGE = 7 * 24 * 3600  # unfinished uploads untouched for this long are removed
+CHECKSUMS = ('sha256', 'crc32')
+ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def chunk_count(size, chunk_size):
+    return -(-size // chunk_size)
+
+
+class UploadStore:
+    def __init__(self, folder, blobs=None):
+        # `blobs` is an optional file_store.BlobStore that finished uploads are moved into
+        self.folder = folder
+        self.blobs = blobs
+        self.partial = os.path.join(folder, '.partial')
+        os.makedirs(self.partial, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _paths(self, upload_id):
+        if not ID_RE.match(upload_id or ''):
+            raise UploadError('Unknown upload.', 404)
+        base = os.path.join(self.partial, upload_id)
+        return base + '.json', base + '.part'
+
+    def _thread_lock(self, upload_id):
+        with self._locks_lock:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    @contextlib.contextmanager
+    def _lock(self, upload_id):
+        # Serializes state changes of one upload across threads, and with an flock on its part
+        # file across the worker processes of web_server.py --workers
+        with self._thread_lock(upload_id):
+            _, data_path = self._paths(upload_id)
+            try:
+                fd = os.open(data_path, os.O_RDONLY) if fcntl else None
+            except FileNotFoundError:
+                fd = None  # finished or aborted meanwhile; _load() will say so
+            if fd is None:
+                yield
+                return
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _load(self, upload_id):
+        state_path, _ = self._paths(upload_id)
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Unknown upload.', 404)
+
+    def _save(self, state):
+        state_path, _ = self._paths(state['id'])
+        tmp = state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, state_path)
+
+    def create(self, name, size, chunk_size=None, safe_name=None):
+        # `safe_name` turns the client's file name into one that is safe on disk
+        if not isinstance(size, int) or size < 0:
+            raise UploadError('size must be a non-negative integer.')
+        name = safe_name(name or '') if safe_name else name
+        if not name:
+            raise UploadError('A file name is required.')
+        chunk_size = min(max(int(chunk_size or CHUNK_SIZE), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        self.sweep()
+        upload_id = secrets.token_hex(16)
+        _, data_path = self._paths(upload_id)
+        fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            # Reserve the space up front: fails early when the disk is too small and
+            # avoids fragmenting a file that is written out of order
+            try:
+                if size:
+                    os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError) as e:
+                if getattr(e, 'errno', None) == errno.ENOSPC:
+                    raise
+                os.ftruncate(fd, size)  # no fallocate here (e.g. Android shared storage)
+        except OSError:
+            os.remove(data_path)
+            raise UploadError('Not enough space for this file.', 507)
+        finally:
+            os.close(fd)
+        now = time.time()
+        state = {'id': upload_id, 'name': name, 'size': size, 'chunk_size': chunk_size,
+                 'chunks': {}, 'created': now, 'updated': now}
+        self._save(state)
+        return self.describe(state)
+
+    def describe(self, state):
+        received = sorted(int(i) for i in state['chunks'])
+        count = chunk_count(state['size'], state['chunk_size'])
+        return {'id': state['id'], 'name': state['name'], 'size': state['size'],
+                'chunk_size': state['chunk_size'], 'chunks': count, 'received': received,
+                'bytes_received': sum(self._chunk_length(state, i) for i in received)}
+
+    def status(self, upload_id):
+        return self.describe(self._load(upload_id))
+
+    @staticmethod
+    def _chunk_length(state, index):
+        return min(state['chunk_size'], state['size'] - index * state['chunk_size'])
+
+    def write_chunk(self, upload_id, offset, stream, length, checksum=None):
+        # `checksum` is the X-Chunk-Checksum header, "sha256=<hex>" or "crc32=<hex>"
+        state = self._load(upload_id)
+        size, chunk_size = state['size'], state['chunk_size']
+        if offset is None or offset < 0 or offset % chunk_size or offset >= max(size, 1):
+            raise UploadError(f'offset must be a multiple of {chunk_size} below {size}.', 416)
+        index = offset // chunk_size
+        expected = self._chunk_length(state, index)
+        if length != expected:
+            raise UploadError(f'Chunk {index} must be {expected} bytes.', 416)
+        algorithm, _, want = (checksum or '').partition('=')
+        if checksum and algorithm not in CHECKSUMS:
+            raise UploadError('X-Chunk-Checksum must be sha256=<hex> or crc32=<hex>.')
+
+        # The whole write holds the upload's lock: it cannot race finalize() or abort(), nor
+        # another copy of the same chunk. A chunk sent again loses its recorded sums before
+        # its bytes on disk are touched, so a resend that fails leaves it missing, not stale.
+        with self._lock(upload_id):
+            state = self._load(upload_id)
+            if state['chunks'].pop(str(index), None) is not None:
+                self._save(state)
+            _, data_path = self._paths(upload_id)
+            try:
+                fd = os.open(data_path, os.O_WRONLY)
+            except FileNotFoundError:
+                raise UploadError('Unknown upload.', 404)
+            sha, crc, pos = hashlib.sha256(), 0, 0
+            try:
+                while pos < length:
+                    buf = stream.read(min(WRITE_BUFFER, length - pos))
+                    if not buf:
+                        raise UploadError(f'Chunk {index} ended early; send it again.', 400)
+                    os.pwrite(fd, buf, offset + pos)
+                    sha.update(buf)
+                    crc = zlib.crc32(buf, crc)
+                    pos += len(buf)
+                os.fsync(fd)  # only recorded as received once it is on disk
+            finally:
+                os.close(fd)
+            sums = {'sha256': sha.hexdigest(), 'crc32': f'{crc:08x}'}
+            if checksum and sums[algorithm] != want.lower():
+                raise UploadError(f'Chunk {index} checksum mismatch; send it again.', 422)
+            state['chunks'][str(index)] = sums
+            state['updated'] = time.time()
+            self._save(state)
+        return self.describe(state)
+
+    def finalize(self, upload_id, algorithm=None, chunks=None, sha256=None):
+        # Either the client's checksum of every chunk (no re-read needed) or a whole-file SHA-256
+        with self._lock(upload_id):
+            state = self._load(upload_id)
+            count = chunk_count(state['size'], state['chunk_size'])
+            missing = [i for i in range(count) if str(i) not in state['chunks']]
+            if missing:
+                raise UploadError(f'{len(missing)} chunk(s) missing, first {missing[0]}.', 409)
+            _, data_path = self._paths(upload_id)
+            if chunks is not None:
+                if not isinstance(chunks, list) or algorithm not in CHECKSUMS or len(chunks) != count:
+                    raise UploadError(f'Send {count} {"/".join(CHECKSUMS)} chunk checksums.')
+                bad = [i for i, c in enumerate(chunks) if state['chunks'][str(i)][algorithm] != str(c).lower()]
+                if bad:
+                    for i in bad:
+                        del state['chunks'][str(i)]
+                    self._save(state)
+                    raise UploadError(f'{len(bad)} chunk(s) do not match; send them again.', 422)
+            elif sha256:
+                if not isinstance(sha256, str):
+                    raise UploadError('sha256 must be a hex string.')
+                digest = hashlib.sha256()
+                with open(data_path, 'rb') as f:
+                    for block in iter(lambda: f.read(WRITE_BUFFER), b''):
+                        digest.update(block)
+                if digest.hexdigest() != sha256.lower():
+                    raise UploadError('File checksum mismatch.', 422)
+            else:
+                raise UploadError('A checksum is required to finalize.')
+            if self.blobs is not None:
+                # The whole-file digest, when the client sent one, saves hashing the file again
+                self.blobs.adopt(state['name'], data_path, sha256.lower() if sha256 and chunks is None else None)
+            else:
+                target = os.path.join(self.folder, state['name'])
+                os.chmod(data_path, 0o644)
+                os.replace(data_path, target)
+            os.remove(self._paths(upload_id)[0])
+        with self._locks_lock:
+            self._locks.pop(upload_id, None)
+        return {'name': state['name'], 'size': state['size']}
+
+    def abort(self, upload_id):
+        with self._lock(upload_id):
+            for path in self._paths(upload_id):
+                if os.path.exists(path):
+                    os.remove(path)
+        with self._locks_lock:
+            self._locks.pop(upload_id, None)
+
+    def sweep(self, max_age=PARTIAL_MAX_AGE):
+        cutoff = time.time() - max_age
+        for entry in os.scandir(self.partial):
+            if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                self.abort(entry.name[:-len('.json')])
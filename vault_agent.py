@@ -0,0 +1,309 @@
+import os, sys, json, time, ctypes, ctypes.util, signal, socket, socketserver, struct, tempfile, threading, argparse
+
+# Unlock agent for Master vault.py. `python "Master vault.py" agent` unlocks the vault once
+# and serves it on a Unix socket; scripts then use AgentClient (or this file's CLI) and
+# skip the KDF and bcrypt checks entirely. This module only needs the standard library,
+# so the client starts fast.
+#
+# Frames are a 4-byte big-endian length and a payload. A request payload is a one-byte
+# op followed by fields, each a 4-byte length and its bytes; a reply is a status byte
+# and a body.
+HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+IDLE_TIMEOUT = 15 * 60.0  # seconds without a request before the agent saves and exits
+SAVE_DELAY = 1.0  # edits are written within this many seconds, batched with any that follow
+
+OP_GET, OP_RECORD, OP_PUT, OP_LIST, OP_SAVE, OP_STATUS, OP_LOCK = b'g', b'r', b'p', b'l', b's', b'?', b'x'
+OK, NOT_FOUND, ERROR = b'\x00', b'\x01', b'\x02'
+
+
+def default_socket_path():
+    if os.environ.get('VAULT_AGENT_SOCK'):
+        return os.environ['VAULT_AGENT_SOCK']
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), f'vault-agent-{os.getuid()}')
+    return os.path.join(base, 'vault-agent.sock')
+
+
+def pack_fields(*fields):
+    return b''.join(HEADER.pack(len(f)) + f for f in fields)
+
+
+def unpack_fields(data):
+    fields, pos = [], 0
+    while pos < len(data):
+        (size,) = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        if pos + size > len(data):
+            raise ValueError('truncated field')
+        fields.append(data[pos:pos + size])
+        pos += size
+    return fields
+
+
+def send_frame(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('vault agent connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    (size,) = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError('frame too large')
+    return _recv_exact(sock, size)
+
+
+def harden_process():
+    # Keep the key out of core dumps, ptrace and (where the memlock limit allows) swap.
+    # Returns True if memory could be locked.
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    except (ImportError, ValueError, OSError):
+        pass
+    name = ctypes.util.find_library('c')
+    if not name:
+        return False
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        if sys.platform.startswith('linux'):
+            libc.prctl(4, 0, 0, 0, 0)  # PR_SET_DUMPABLE = 0
+        # MCL_CURRENT only: with MCL_FUTURE every later allocation past the limit would fail
+        return libc.mlockall(1) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            return
+        try:
+            while True:
+                send_frame(self.request, self.server.dispatch(recv_frame(self.request)))
+        except (ConnectionError, OSError):
+            pass
+
+
+class Agent(socketserver.ThreadingUnixStreamServer):
+    # `vault` is an unlocked VaultFile and `session` the VaultSession that saves it.
+    # One lock serialises requests: VaultFile shares a single file handle.
+    daemon_threads = True
+
+    def __init__(self, vault, session, path=None, idle_timeout=IDLE_TIMEOUT):
+        path = path or default_socket_path()
+        self._prepare_path(path)
+        self.vault = vault
+        self.session = session
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.requests = 0
+        # The socket is created 0600, so only this user can connect
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _AgentHandler)
+        finally:
+            os.umask(umask)
+
+    @staticmethod
+    def _prepare_path(path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise RuntimeError(f'{directory} must be owned by you and not writable by others.')
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise RuntimeError(f'An agent is already listening on {path}.')
+            except OSError:
+                os.unlink(path)  # left behind by an agent that did not shut down cleanly
+            finally:
+                probe.close()
+
+    def peer_allowed(self, sock):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True  # the 0600 socket still keeps other users out
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def dispatch(self, request):
+        with self.lock:
+            self.last_used = time.monotonic()
+            self.requests += 1
+            try:
+                # A malformed frame (bad lengths, invalid UTF-8) gets an ERROR reply like any other failure
+                fields = [f.decode() for f in unpack_fields(request[1:])]
+                return self._dispatch(request[:1], fields)
+            except Exception as e:
+                return ERROR + str(e).encode()
+
+    def _dispatch(self, op, fields):
+        vault = self.vault
+        if op == OP_GET:
+            password = vault.get(fields[0])
+            return NOT_FOUND if password is None else OK + password.encode()
+        if op == OP_RECORD:
+            record = vault.get_record(fields[0])
+            return NOT_FOUND if record is None else OK + json.dumps(record).encode()
+        if op == OP_PUT:
+            name, password = fields[:2]
+            meta = json.loads(fields[2]) if len(fields) > 2 else {}
+            vault.put(name, password, meta.get('url', ''), meta.get('notes', ''), meta.get('tags', ()))
+            self.session.changed()
+            return OK
+        if op == OP_LIST:
+            return OK + pack_fields(*(n.encode() for n in sorted(vault.names())))
+        if op == OP_SAVE:
+            self.session.save()
+            return OK
+        if op == OP_STATUS:
+            return OK + json.dumps({'entries': len(vault), 'unsaved': self.session.edits, 'requests': self.requests,
+                                    'idle_timeout': self.idle_timeout}).encode()
+        if op == OP_LOCK:
+            threading.Thread(target=self.shutdown).start()
+            return OK
+        return ERROR + b'unknown request'
+
+    def watch(self):
+        # Writes batched edits and exits once the agent has been idle for idle_timeout
+        while True:
+            time.sleep(min(SAVE_DELAY, self.idle_timeout))
+            with self.lock:
+                self.session.maybe_save()
+                if time.monotonic() - self.last_used >= self.idle_timeout:
+                    break
+        self.shutdown()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def serve(vault, session, path=None, idle_timeout=IDLE_TIMEOUT):
+    agent = Agent(vault, session, path, idle_timeout)
+    # Turn SIGTERM into a normal exit so pending edits are saved
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    threading.Thread(target=agent.watch, name='vault-agent-watch', daemon=True).start()
+    print(f'Vault agent listening on {agent.server_address} (idle timeout {idle_timeout:.0f}s).', file=sys.stderr)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with agent.lock:
+            session.save()
+        agent.server_close()
+    print('Vault agent stopped.', file=sys.stderr)
+
+
+class AgentError(Exception):
+    pass
+
+
+class AgentClient:
+    # Keeps one connection open, so each lookup is a single round trip
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path or default_socket_path())
+        except OSError as e:
+            self.sock.close()
+            raise AgentError(f'No vault agent running ({e.strerror}). Start one with `python "Master vault.py" agent`.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _call(self, op, *fields):
+        send_frame(self.sock, op + pack_fields(*(f.encode() for f in fields)))
+        reply = recv_frame(self.sock)
+        status, body = reply[:1], reply[1:]
+        if status == ERROR:
+            raise AgentError(body.decode())
+        return None if status == NOT_FOUND else body
+
+    def get(self, name):
+        body = self._call(OP_GET, name)
+        return None if body is None else body.decode()
+
+    def record(self, name):
+        body = self._call(OP_RECORD, name)
+        return None if body is None else json.loads(body)
+
+    def put(self, name, password, url='', notes='', tags=()):
+        self._call(OP_PUT, name, password, json.dumps({'url': url, 'notes': notes, 'tags': list(tags)}))
+
+    def names(self):
+        return [n.decode() for n in unpack_fields(self._call(OP_LIST))]
+
+    def save(self):
+        self._call(OP_SAVE)
+
+    def status(self):
+        return json.loads(self._call(OP_STATUS))
+
+    def lock(self):
+        self._call(OP_LOCK)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Talk to a running vault agent')
+    parser.add_argument('--socket', help='agent socket (default: $VAULT_AGENT_SOCK or a per-user runtime path)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('get', help='print an entry password')
+    p.add_argument('name')
+    p.add_argument('--json', action='store_true', help='print the whole record')
+    p = sub.add_parser('put', help='add or replace an entry')
+    p.add_argument('name')
+    p.add_argument('--url', default='')
+    p.add_argument('--notes', default='')
+    p.add_argument('--tag', action='append', default=[], dest='tags')
+    p.add_argument('--secret-fd', type=int, default=0, metavar='FD', help='read the password from this descriptor (default stdin)')
+    sub.add_parser('list', help='list entry names')
+    sub.add_parser('save', help='write pending edits now')
+    sub.add_parser('status', help='show entry count, unsaved edits and idle timeout')
+    sub.add_parser('lock', help='save, forget the key and stop the agent')
+    args = parser.parse_args()
+
+    try:
+        with AgentClient(args.socket) as client:
+            if args.command == 'get':
+                value = client.record(args.name) if args.json else client.get(args.name)
+                if value is None:
+                    sys.exit(f'{args.name} not found.')
+                print(json.dumps(value) if args.json else value)
+            elif args.command == 'put':
+                with os.fdopen(args.secret_fd, 'r', closefd=False) as f:
+                    client.put(args.name, f.readline().rstrip('\r\n'), args.url, args.notes, args.tags)
+            elif args.command == 'list':
+                print('\n'.join(client.names()))
+            elif args.command == 'save':
+                client.save()
+            elif args.command == 'status':
+                print(json.dumps(client.status()))
+            elif args.command == 'lock':
+                client.lock()
+    except AgentError as e:
+        sys.exit(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse, os, time, random
+import SimpleVault
+from vault_common import SearchIndex
+
+# Benchmarks for the vaults. Run `python vault_bench.py <command> -h` for options.
+
+
+def xor_per_byte(data, key):
+    # The implementation SimpleVault.py used before the bulk XOR path
+    return bytes([b ^ key[i % len(key)] for i, b in enumerate(data)])
+
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def throughput(fn, data, key, min_time=0.5):
+    # Repeats small inputs until the measurement takes at least min_time
+    runs, elapsed = 0, 0.0
+    while elapsed < min_time:
+        start = time.perf_counter()
+        fn(data, key)
+        elapsed += time.perf_counter() - start
+        runs += 1
+        if len(data) * runs >= 1024 ** 3:
+            break
+    return len(data) * runs / elapsed / 1e6
+
+
+def bench_xor(args):
+    key = os.urandom(32)
+    impls = [('per-byte', xor_per_byte)]
+    np = SimpleVault.np
+    SimpleVault.np = None
+    impls.append(('big-int', lambda d, k: SimpleVault.xor_encrypt(d, k)))
+    print(f"{'size':>8} {'implementation':>15} {'MB/s':>10}")
+    try:
+        for size_text in args.sizes:
+            size = parse_size(size_text)
+            data = os.urandom(size)
+            for name, fn in impls:
+                if name == 'per-byte' and size > args.slow_limit:
+                    # The loop costs the same per byte at any size, so its rate on the first
+                    # slow_limit bytes stands for the whole input without the memory it would need
+                    rate = throughput(fn, memoryview(data)[:args.slow_limit], key)
+                    print(f"{size_text:>8} {name:>15} {rate:>10.1f}  (extrapolated from the first {args.slow_limit} bytes)")
+                    continue
+                print(f"{size_text:>8} {name:>15} {throughput(fn, data, key):>10.1f}")
+            if np is not None:
+                SimpleVault.np = np
+                print(f"{size_text:>8} {'numpy':>15} {throughput(SimpleVault.xor_encrypt, data, key):>10.1f}")
+                SimpleVault.np = None
+    finally:
+        SimpleVault.np = np
+
+
+def bench_search(args):
+    # Builds an index of synthetic entries and times each query (best of --repeat runs)
+    rng = random.Random(0)
+    tags = ['work', 'home', 'bank', 'mail', 'dev']
+    entries = [(f'site{i}', {'url': f'https://usr{i}.example.com', 'tags': [rng.choice(tags)]})
+               for i in range(args.entries)]
+    start = time.perf_counter()
+    index = SearchIndex(entries)
+    print(f"{args.entries} entries indexed in {time.perf_counter() - start:.2f} s; target {args.target:g} ms per query")
+    print(f"{'query':>16} {'ms':>9} {'matches':>9}")
+    for query in args.queries:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            page, total = index.search(query)
+            best = min(best, time.perf_counter() - start)
+        flag = '' if best * 1000 <= args.target else '  over target'
+        print(f"{query:>16} {best * 1000:>9.3f} {total:>9}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vault benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('xor', help='SimpleVault XOR throughput: old per-byte loop vs big-int vs NumPy')
+    p.add_argument('--sizes', nargs='+', default=['1K', '1M', '100M'])
+    p.add_argument('--slow-limit', type=parse_size, default=parse_size('16M'),
+                   help='time the per-byte loop on this many bytes of larger inputs and extrapolate '
+                        '(it needs ~8 bytes of RAM per input byte)')
+    p.set_defaults(func=bench_xor)
+
+    p = sub.add_parser('search', help='SearchIndex query latency on a large vault')
+    p.add_argument('--entries', type=int, default=100000)
+    p.add_argument('--queries', nargs='+',
+                   default=['site123', '*9', '*99', '*site99', '*example', '~usr123', '~site9999', '~stie123',
+                            '~exmaple', 'tag:bank', 'tag:bank *site99', 'tag:bank *example'])
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--target', type=float, default=1.0, help='per-query target in milliseconds')
+    p.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
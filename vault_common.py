@@ -0,0 +1,706 @@
+import io
+import os
+import re
+import csv
+import sys
+import json
+import time
+import shutil
+import heapq
+import bisect
+import getpass
+import hashlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    # Only encrypted exports need it; SimpleVault works without
+    AESGCM = None
+
+# Helpers shared by Master vault.py and SimpleVault.py
+
+AUTOSAVE_EDITS = 20      # save after this many unsaved edits...
+AUTOSAVE_SECONDS = 30.0  # ...or once the oldest unsaved edit is this old
+
+# scrypt parameters for new vaults; `calibrate` picks N for a target unlock time
+KDF_N = 2 ** 15
+KDF_R = 8
+KDF_P = 1
+KDF_SALT_SIZE = 16
+KDF_MAX_N = 2 ** 20
+KDF_MAX_R = 32
+KDF_MAX_P = 16
+KDF_MAX_MEM = 128 * KDF_MAX_N * KDF_R  # scrypt needs 128 * N * r bytes; 1 GiB at the largest calibrated N
+
+SEARCH_PAGE_SIZE = 20
+FUZZY_MIN_SHARED = 0.4  # fuzzy candidates share at least this fraction of the query's trigrams...
+FUZZY_MIN_SCORE = 0.3   # ...and score at least this, so a vague query does not match the whole vault
+FUZZY_COMMON = 0.05     # grams in more than this fraction of entries (and over FUZZY_COMMON_MIN) only add
+FUZZY_COMMON_MIN = 1000  # to scores: a candidate must also share a rarer one
+
+# Encrypted exports: MAGIC, a JSON header line, then frames of u32 length | nonce | AES-GCM ciphertext
+EXPORT_MAGIC = b"VEXPORT1\n"
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_NONCE_SIZE = 12
+RECORD_FIELDS = ("name", "password", "url", "notes", "tags", "modified")
+
+def fsync_dir(path):
+    # Makes a rename durable; not every platform lets you open a directory
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def rotate_backups(path, generations):
+    # path.bak1 is the newest backup, path.bak<generations> the oldest
+    if generations <= 0 or not os.path.exists(path):
+        return
+    for i in range(generations - 1, 0, -1):
+        older = f"{path}.bak{i}"
+        if os.path.exists(older):
+            os.replace(older, f"{path}.bak{i + 1}")
+    newest = f"{path}.bak1"
+    if os.path.exists(newest):
+        os.remove(newest)
+    try:
+        os.link(path, newest)
+    except OSError:
+        # e.g. shared storage on Android has no hard links
+        shutil.copy2(path, newest)
+
+def remove_backups(path, generations):
+    # For key upgrades: the backups rotate_backups kept are still readable with the old, weaker key
+    for i in range(1, generations + 1):
+        if os.path.exists(f"{path}.bak{i}"):
+            os.remove(f"{path}.bak{i}")
+
+@contextmanager
+def atomic_open(path, backups=0):
+    # Write to a temp file next to path, fsync it, then rename it over path.
+    # Readers (and crashes) only ever see the old file or the complete new one.
+    tmp = path + ".tmp"
+    f = open(tmp, "wb")
+    try:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        rotate_backups(path, backups)
+        os.replace(tmp, path)
+        fsync_dir(path)
+    except BaseException:
+        f.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def atomic_write(path, data, backups=0):
+    with atomic_open(path, backups) as f:
+        f.write(data)
+
+def new_kdf_params(n=KDF_N, r=KDF_R, p=KDF_P):
+    return {"name": "scrypt", "n": n, "r": r, "p": p, "salt": os.urandom(KDF_SALT_SIZE).hex()}
+
+def check_kdf_params(params):
+    # KDF parameters are read from file headers before anything is authenticated, so a
+    # tampered header must not be able to make unlocking take unbounded time or memory
+    try:
+        n, r, p = params["n"], params["r"], params["p"]
+        bytes.fromhex(params["salt"])
+    except (TypeError, KeyError, ValueError):
+        raise ValueError("Invalid KDF parameters.")
+    if not all(type(v) is int for v in (n, r, p)):
+        raise ValueError("Invalid KDF parameters.")
+    if not (2 <= n <= KDF_MAX_N and n & (n - 1) == 0 and 1 <= r <= KDF_MAX_R and 1 <= p <= KDF_MAX_P
+            and 128 * n * r <= KDF_MAX_MEM):
+        raise ValueError(f"KDF parameters out of range (n={n}, r={r}, p={p}).")
+    return n, r, p
+
+def derive_key(master_passwords, params):
+    # Length-prefix every password so ["ab", "c"] and ["a", "bc"] give different keys
+    secret = b"".join(len(pw.encode()).to_bytes(4, "big") + pw.encode() for pw in master_passwords)
+    n, r, p = check_kdf_params(params)
+    return hashlib.scrypt(secret, salt=bytes.fromhex(params["salt"]), n=n, r=r, p=p,
+                          maxmem=256 * n * r * p + 1024 * 1024, dklen=32)
+
+def calibrate_kdf(target_seconds, r=KDF_R, p=KDF_P, max_n=KDF_MAX_N):
+    # Doubles N while the next doubling still fits in the target; returns (params, seconds)
+    def measure(n):
+        params = new_kdf_params(n, r, p)
+        start = time.perf_counter()
+        derive_key(["calibrate"], params)
+        return params, time.perf_counter() - start
+
+    n = 2 ** 12
+    params, took = measure(n)
+    while n < max_n and took * 2 <= target_seconds:
+        n *= 2
+        params, took = measure(n)
+    return params, took
+
+def run_parallel(fn, args_list):
+    # bcrypt and scrypt release the GIL, so threads give real parallelism here
+    args_list = list(args_list)
+    if not args_list:
+        return []
+    with ThreadPoolExecutor(max_workers=len(args_list)) as pool:
+        return list(pool.map(lambda args: fn(*args), args_list))
+
+class VaultSession:
+    # Tracks unsaved edits so read-only actions never write, and several edits
+    # share one save. `save` is the function that writes the vault out.
+    def __init__(self, save, autosave_edits=AUTOSAVE_EDITS, autosave_seconds=AUTOSAVE_SECONDS):
+        self._save = save
+        self.autosave_edits = autosave_edits
+        self.autosave_seconds = autosave_seconds
+        self.edits = 0
+        self.first_edit = None
+        self.saves = 0
+
+    @property
+    def dirty(self):
+        return self.edits > 0
+
+    def changed(self, count=1):
+        if count <= 0:
+            return
+        if not self.edits:
+            self.first_edit = time.monotonic()
+        self.edits += count
+
+    def maybe_save(self):
+        if self.dirty and (self.edits >= self.autosave_edits
+                           or time.monotonic() - self.first_edit >= self.autosave_seconds):
+            return self.save()
+        return False
+
+    def save(self):
+        if not self.dirty:
+            return False
+        self._save()
+        self.edits = 0
+        self.first_edit = None
+        self.saves += 1
+        return True
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def ngrams(text):
+    # Single characters, bigrams and trigrams, so substring queries of any length use the index
+    return set(text) | bigrams(text) | trigrams(text)
+
+def subsequence_pattern(needle):
+    # Matches text containing the needle's characters in order, e.g. "gogle" in "google"
+    return re.compile(".*?".join(map(re.escape, needle)), re.DOTALL)
+
+class SearchIndex:
+    # In-memory index over entry names, URLs and tags, built once at unlock time.
+    # Prefix search bisects a sorted name list, substring search intersects n-gram
+    # postings and fuzzy search ranks trigram candidates by similarity, so none of
+    # them scans every entry. Every search returns (page of names, total matches).
+    def __init__(self, entries=()):
+        self._sorted = []                # (lowercase name, name), kept sorted
+        self._meta = {}                  # name -> metadata dict (url, tags, modified)
+        self._lower = {}                 # name -> (lowercase name, lowercase url, bigram count, trigram count)
+        self._grams = defaultdict(set)   # 1-, 2- and 3-gram -> names whose name or url contains it
+        self._tags = defaultdict(set)    # tag -> names
+        for name, meta in entries:
+            self._index(name, meta)
+            self._sorted.append((name.lower(), name))
+        self._sorted.sort()
+
+    def __len__(self):
+        return len(self._meta)
+
+    def _name_grams(self, name):
+        name_text, url_text = self._lower[name][:2]
+        return ngrams(name_text) | ngrams(url_text)
+
+    def _index(self, name, meta):
+        meta = meta or {}
+        self._meta[name] = meta
+        name_text, url_text = name.lower(), (meta.get("url") or "").lower()
+        # Gram counts of the name alone, for fuzzy similarity
+        self._lower[name] = (name_text, url_text, len(bigrams(name_text)), len(trigrams(name_text)))
+        for gram in self._name_grams(name):
+            self._grams[gram].add(name)
+        for tag in meta.get("tags") or ():
+            self._tags[tag.lower()].add(name)
+
+    def add(self, name, meta=None):
+        if name in self._meta:
+            self.remove(name)
+        self._index(name, meta)
+        bisect.insort(self._sorted, (name.lower(), name))
+
+    def remove(self, name):
+        meta = self._meta.pop(name, None)
+        if meta is None:
+            return
+        for gram in self._name_grams(name):
+            self._grams[gram].discard(name)
+        del self._lower[name]
+        for tag in meta.get("tags") or ():
+            self._tags[tag.lower()].discard(name)
+        i = bisect.bisect_left(self._sorted, (name.lower(), name))
+        if i < len(self._sorted) and self._sorted[i][1] == name:
+            del self._sorted[i]
+
+    def _tagged(self, tags):
+        if not tags:
+            return None
+        sets = sorted((self._tags.get(t.lower(), set()) for t in tags), key=len)
+        return sets[0] if len(sets) == 1 else set.intersection(*sets)
+
+    def _page(self, names, offset, limit):
+        names = list(names)
+        return names[offset:offset + limit], len(names)
+
+    def _ordered_page(self, matches, offset, limit):
+        # Walking the sorted name list costs about (offset + limit) * len(index) / len(matches)
+        # steps and stops once the page is full; for sparser matches it is cheaper to pick
+        # the page out of the matches themselves
+        if len(matches) ** 2 <= (offset + limit) * len(self._sorted):
+            page = heapq.nsmallest(offset + limit, matches, key=lambda n: (self._lower[n][0], n))
+            return page[offset:], len(matches)
+        page = []
+        for _, name in self._sorted:
+            if name in matches:
+                if offset:
+                    offset -= 1
+                    continue
+                page.append(name)
+                if len(page) == limit:
+                    break
+        return page, len(matches)
+
+    def prefix(self, query, tags=(), offset=0, limit=SEARCH_PAGE_SIZE):
+        q = query.lower()
+        lo = bisect.bisect_left(self._sorted, (q,))
+        hi = bisect.bisect_left(self._sorted, (q + "\U0010ffff",))
+        allowed = self._tagged(tags)
+        if allowed is None:
+            return [name for _, name in self._sorted[lo + offset:min(hi, lo + offset + limit)]], hi - lo
+        return self._page((name for _, name in self._sorted[lo:hi] if name in allowed), offset, limit)
+
+    def substring(self, query, tags=(), offset=0, limit=SEARCH_PAGE_SIZE):
+        q = query.lower()
+        allowed = self._tagged(tags)
+        if not q:
+            return self.tagged(tags, offset, limit) if tags else ([], 0)
+        grams = trigrams(q) or {q}
+        postings = sorted((self._grams.get(g, set()) for g in grams), key=len)
+        # A query that is itself one indexed n-gram needs no further checking
+        exact = len(q) <= 3
+        if exact and allowed is None:
+            return self._ordered_page(postings[0], offset, limit)
+        # Likely matches: the rarest gram's names, thinned by the tag filter. When they are
+        # common, walking the sorted names to fill the page is cheaper than intersecting
+        # (the same trade-off as in _ordered_page).
+        size = len(self._sorted)
+        likely = len(postings[0]) if allowed is None else len(postings[0]) * len(allowed) / max(size, 1)
+        if likely ** 2 > (offset + limit) * size:
+            return self._scan_page(q, round(likely), allowed, offset, limit)
+        if allowed is not None:
+            postings = sorted(postings + [allowed], key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        matches = candidates if exact else {n for n in candidates
+                                            if q in self._lower[n][0] or q in self._lower[n][1]}
+        return self._ordered_page(matches, offset, limit)
+
+    def _scan_page(self, q, estimate, allowed, offset, limit):
+        # Many names match: walk the sorted names and stop once the page is full rather than
+        # intersecting and checking every candidate. The total is exact when the walk reaches
+        # the end, and otherwise `estimate`, the likely match count worked out from the gram
+        # and tag set sizes.
+        lowered, page, seen = self._lower, [], 0
+        for _, name in self._sorted:
+            if (allowed is None or name in allowed) and (q in lowered[name][0] or q in lowered[name][1]):
+                seen += 1
+                if seen > offset:
+                    page.append(name)
+                    if len(page) == limit:
+                        break
+        else:
+            return page, seen
+        # At least one more than shown, so a pager asks for the next page
+        return page, max(estimate, seen + 1)
+
+    def _fuzzy_scores(self, q, qgrams, which, allowed, fallback=False):
+        # -> [(-score, lowercase name, name)] for names sharing enough of `qgrams`;
+        # `which` picks the bigram (2) or trigram (3) count of each name. The bigram
+        # `fallback` gives up when every gram is common, as nearly every name would match.
+        postings = [self._grams[g] for g in qgrams if g in self._grams]
+        need = max(1, -(-len(qgrams) * FUZZY_MIN_SHARED // 1))
+        if len(postings) < need:
+            return []
+        # A name sharing `need` of the rarer grams is in at least one of the smallest
+        # len(rare) - need + 1 postings, so only those are counted; the rest are looked up
+        postings.sort(key=len)
+        common = max(len(self._meta) * FUZZY_COMMON, FUZZY_COMMON_MIN)
+        rare = [names for names in postings if len(names) <= common]
+        if not rare:
+            if fallback:
+                return []
+            rare = postings[:1]
+        split = int(len(rare) - max(need - (len(postings) - len(rare)), 1) + 1)
+        shared = Counter()
+        for names in postings[:split]:
+            shared.update(names)
+        candidates = shared.keys() if allowed is None else shared.keys() & allowed
+        for names in postings[split:]:
+            shared.update(names.intersection(candidates))
+        # Prefix and substring bonuses need every query gram. A somewhat similar name that
+        # has the query's letters in order (dropped letters) is let in at the cutoff score.
+        kq, lowered, scored = len(qgrams), self._lower, []
+        in_order = subsequence_pattern(q).search
+        floor = FUZZY_MIN_SCORE / 2
+        for name in candidates:
+            count = shared[name]
+            if count < need:
+                continue
+            info = lowered[name]
+            lower = info[0]
+            union = kq + info[which] - count
+            score = count / union if union > count else 1.0  # shared grams may come from the URL
+            if count == kq and lower.startswith(q):
+                score += 1.0
+            elif count == kq and (q in lower or q in info[1]):
+                score += 0.75
+            elif floor <= score < FUZZY_MIN_SCORE and len(lower) > len(q) and in_order(lower):
+                score = FUZZY_MIN_SCORE
+            if score >= FUZZY_MIN_SCORE:
+                scored.append((-score, lower, name))
+        return scored
+
+    def fuzzy(self, query, tags=(), offset=0, limit=SEARCH_PAGE_SIZE):
+        q = query.lower()
+        if len(q) < 3:
+            return self.substring(query, tags, offset, limit)
+        allowed = self._tagged(tags)
+        # Bigrams only when no name shares enough trigrams (a typo in most of them)
+        scored = self._fuzzy_scores(q, trigrams(q), 3, allowed) or self._fuzzy_scores(q, bigrams(q), 2, allowed, True)
+        page = heapq.nsmallest(offset + limit, scored)[offset:]
+        return [name for _, _, name in page], len(scored)
+
+    def tagged(self, tags, offset=0, limit=SEARCH_PAGE_SIZE):
+        return self._ordered_page(self._tagged(tags) or set(), offset, limit)
+
+    def search(self, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        # Query syntax: "tag:<tag>" terms filter by tag; a leading "~" ranks fuzzily,
+        # a leading "*" matches anywhere in the name or URL, anything else is a prefix.
+        words = text.split()
+        tags = [w[4:] for w in words if w.startswith("tag:")]
+        query = " ".join(w for w in words if not w.startswith("tag:"))
+        if not query:
+            return self.tagged(tags, offset, limit) if tags else ([], 0)
+        if query.startswith("~"):
+            return self.fuzzy(query[1:], tags, offset, limit)
+        if query.startswith("*"):
+            return self.substring(query[1:], tags, offset, limit)
+        return self.prefix(query, tags, offset, limit)
+
+def search_prompt(index, show):
+    # Interactive paginated search used by both vault menus; `show(name)` prints one hit
+    text = input("Search (prefix, *substring, ~fuzzy, tag:<tag>): ").strip()
+    offset = 0
+    while True:
+        page, total = index.search(text, offset)
+        if not total:
+            print("No matches.")
+            return
+        if not page:
+            print("No more matches.")  # the total of a broad substring search is an estimate
+            return
+        print(f"Matches {offset + 1}-{offset + len(page)} of {total}:")
+        for name in page:
+            show(name)
+        offset += len(page)
+        if offset >= total or input("Enter for more, q to stop: ").strip().lower() == "q":
+            return
+
+# Non-interactive command line shared by both vaults. Secrets are read from file
+# descriptors (e.g. `--password-fd 3 3<masters.txt`) or prompted for, never taken from argv.
+
+_fd_files = {}
+
+def read_fd_lines(fd, count):
+    # One binary reader per descriptor, so several reads from the same fd share its buffer.
+    # For fd 0 that is sys.stdin.buffer, which `import -` reads too: the text-mode sys.stdin
+    # would read ahead past the secrets and swallow the first records.
+    f = sys.stdin.buffer if fd == 0 else _fd_files.setdefault(fd, os.fdopen(fd, "rb", closefd=False))
+    lines = [f.readline() for _ in range(count)]
+    if not all(lines):
+        raise ValueError(f"Expected {count} line(s) on file descriptor {fd}.")
+    return [line.decode().rstrip("\r\n") for line in lines]
+
+def read_secret(fd, prompt, confirm=False):
+    if fd is not None:
+        return read_fd_lines(fd, 1)[0]
+    secret = getpass.getpass(prompt + ": ")
+    if confirm and getpass.getpass(prompt + " (again): ") != secret:
+        raise ValueError("Passphrases do not match.")
+    return secret
+
+def record_format(path, fmt=None):
+    return fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+
+def read_records(f, fmt):
+    # Yields (name, fields) one at a time, so an import never holds the whole file
+    rows = csv.DictReader(f) if fmt == "csv" else (json.loads(line) for line in f if line.strip())
+    for number, row in enumerate(rows, 1):
+        name = row.get("name") or row.get("username")
+        if not name or row.get("password") is None:
+            raise ValueError(f"Record {number}: name and password are required.")
+        tags = row.get("tags") or []
+        if isinstance(tags, str):
+            tags = [t.strip() for t in tags.split(";") if t.strip()]
+        modified = row.get("modified")
+        yield name, {"password": row["password"], "url": row.get("url") or "", "notes": row.get("notes") or "",
+                     "tags": tags, "modified": float(modified) if modified else None}
+
+def write_records(f, records, fmt):
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(RECORD_FIELDS)
+    for name, record in records:
+        if fmt == "csv":
+            writer.writerow([name, record["password"], record.get("url", ""), record.get("notes", ""),
+                             ";".join(record.get("tags") or ()), record.get("modified", "")])
+        else:
+            f.write(json.dumps(dict(record, name=name)) + "\n")
+        count += 1
+    return count
+
+def _frame_aad(header, seq, last):
+    return header + seq.to_bytes(8, "big") + bytes([last])
+
+class EncryptedWriter(io.RawIOBase):
+    # Chunked AES-GCM. Each frame's AAD holds the header, its sequence number and a
+    # last-frame flag, so reordered, dropped or truncated frames fail to decrypt.
+    # close() alone leaves the export unterminated; finish() writes the last frame.
+    def __init__(self, f, passphrase, fmt):
+        if AESGCM is None:
+            raise RuntimeError("Encrypted exports need the 'cryptography' package; use --plain.")
+        kdf = new_kdf_params()
+        self._header = json.dumps({"kdf": kdf, "format": fmt}).encode()
+        self._aes = AESGCM(derive_key([passphrase], kdf))
+        self._f = f
+        self._buf = bytearray()
+        self._seq = 0
+        f.write(EXPORT_MAGIC + self._header + b"\n")
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        while len(self._buf) >= EXPORT_CHUNK_SIZE:
+            self._frame(bytes(self._buf[:EXPORT_CHUNK_SIZE]), False)
+            del self._buf[:EXPORT_CHUNK_SIZE]
+        return len(b)
+
+    def _frame(self, data, last):
+        nonce = os.urandom(EXPORT_NONCE_SIZE)
+        ct = self._aes.encrypt(nonce, data, _frame_aad(self._header, self._seq, last))
+        self._f.write(len(ct).to_bytes(4, "big") + nonce + ct)
+        self._seq += 1
+
+    def finish(self):
+        self._frame(bytes(self._buf), True)
+        self._buf.clear()
+
+class EncryptedReader(io.RawIOBase):
+    def __init__(self, f, passphrase):
+        if AESGCM is None:
+            raise RuntimeError("Reading encrypted exports needs the 'cryptography' package.")
+        header = f.readline().rstrip(b"\n")
+        params = json.loads(header)
+        self.format = params["format"]
+        self._aes = AESGCM(derive_key([passphrase], params["kdf"]))
+        self._header = header
+        self._f = f
+        self._buf = memoryview(b"")
+        self._seq = 0
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf and not self._done:
+            self._buf = memoryview(self._next_frame())
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def _next_frame(self):
+        head = self._f.read(4)
+        length = int.from_bytes(head, "big")
+        frame = self._f.read(EXPORT_NONCE_SIZE + length)
+        if len(head) < 4 or len(frame) < EXPORT_NONCE_SIZE + length:
+            raise ValueError("Export file is truncated.")
+        nonce, ct = frame[:EXPORT_NONCE_SIZE], frame[EXPORT_NONCE_SIZE:]
+        for last in (False, True):
+            try:
+                data = self._aes.decrypt(nonce, ct, _frame_aad(self._header, self._seq, last))
+            except InvalidTag:
+                continue
+            self._seq += 1
+            self._done = last
+            return data
+        raise ValueError("Wrong export passphrase or corrupt export file.")
+
+@contextmanager
+def export_writer(path, fmt, passphrase=None):
+    # Yields a text stream; with a passphrase it is encrypted a chunk at a time as it is
+    # written. A file is written atomically, "-" streams to stdout.
+    with (nullcontext(sys.stdout.buffer) if path == "-" else atomic_open(path)) as out:
+        raw = EncryptedWriter(out, passphrase, fmt) if passphrase is not None else None
+        sink = io.BufferedWriter(raw, EXPORT_CHUNK_SIZE) if raw else out
+        text = io.TextIOWrapper(sink, encoding="utf-8", newline="")
+        try:
+            yield text
+            text.flush()
+        finally:
+            text.detach()
+        if raw:
+            sink.flush()
+            raw.finish()
+        out.flush()
+
+@contextmanager
+def import_reader(path, fmt, get_passphrase):
+    # Yields (text stream, format); encrypted exports are recognised by their magic
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        head = f.read(len(EXPORT_MAGIC))
+        if head == EXPORT_MAGIC:
+            raw = EncryptedReader(f, get_passphrase())
+            fmt = raw.format
+        else:
+            raw = PrefixedReader(head, f)
+            fmt = record_format(path, fmt)
+        text = io.TextIOWrapper(io.BufferedReader(raw, EXPORT_CHUNK_SIZE), encoding="utf-8-sig", newline="")
+        try:
+            yield text, fmt
+        finally:
+            text.detach()
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+class PrefixedReader(io.RawIOBase):
+    # Puts the bytes read to sniff the format back in front of the stream
+    def __init__(self, head, f):
+        self._head = head
+        self._f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._head:
+            data, self._head = self._head[:len(b)], self._head[len(b):]
+        else:
+            data = self._f.read1(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def add_cli_commands(sub, master_count):
+    def command(name, help):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("--password-fd", type=int, metavar="FD",
+                       help=f"read the {master_count} master passwords, one per line, from this descriptor")
+        return p
+
+    p = command("add", "add one entry")
+    p.add_argument("name")
+    p.add_argument("--url", default="")
+    p.add_argument("--notes", default="")
+    p.add_argument("--tag", action="append", default=[], dest="tags")
+    p.add_argument("--secret-fd", type=int, metavar="FD", help="read the entry password from this descriptor")
+    p.add_argument("--replace", action="store_true", help="overwrite an existing entry")
+    p = command("get", "print one field of an entry")
+    p.add_argument("name")
+    p.add_argument("--field", choices=["password", "url", "notes", "tags", "json"], default="password")
+    p = command("list", "list entry names, optionally filtered with the search syntax")
+    p.add_argument("query", nargs="?", default="")
+    p = command("import", "add entries from a CSV/JSONL file or an encrypted export, with one save")
+    p.add_argument("file", nargs="?", default="-")
+    p.add_argument("--format", choices=["csv", "jsonl"])
+    p.add_argument("--replace", action="store_true", help="overwrite existing entries instead of skipping them")
+    p.add_argument("--passphrase-fd", type=int, metavar="FD", help="read the export passphrase from this descriptor")
+    p = command("export", "write every entry to a file, encrypted with a passphrase unless --plain")
+    p.add_argument("file", nargs="?", default="-")
+    p.add_argument("--format", choices=["csv", "jsonl"])
+    p.add_argument("--plain", action="store_true", help="write unencrypted CSV/JSONL")
+    p.add_argument("--passphrase-fd", type=int, metavar="FD", help="read the export passphrase from this descriptor")
+    p = command("rekey", "change the master passwords")
+    p.add_argument("--new-password-fd", type=int, metavar="FD",
+                   help="read the new master passwords, one per line, from this descriptor")
+
+def run_cli_command(args, vault):
+    # add/get/list/import/export against an unlocked vault exposing names(), get_record(),
+    # put() and `in`. Returns the number of changed entries; the caller saves once.
+    if args.command == "add":
+        if args.name in vault and not args.replace:
+            raise ValueError(f"{args.name} exists; use --replace to overwrite it.")
+        vault.put(args.name, read_secret(args.secret_fd, f"Password for {args.name}"),
+                  args.url, args.notes, args.tags)
+        return 1
+    if args.command == "get":
+        record = vault.get_record(args.name)
+        if record is None:
+            raise ValueError(f"{args.name} not found.")
+        if args.field == "json":
+            print(json.dumps(dict(record, name=args.name)))
+        elif args.field == "tags":
+            print(",".join(record.get("tags") or ()))
+        else:
+            print(record.get(args.field, ""))
+        return 0
+    if args.command == "list":
+        if args.query:
+            index = SearchIndex((name, vault.meta(name)) for name in vault.names())
+            names, _ = index.search(args.query, limit=len(index))
+        else:
+            names = sorted(vault.names())
+        for name in names:
+            print(name)
+        return 0
+    if args.command == "import":
+        added = skipped = 0
+        with import_reader(args.file, args.format, lambda: read_secret(args.passphrase_fd, "Export passphrase")) as (f, fmt):
+            for name, fields in read_records(f, fmt):
+                if name in vault and not args.replace:
+                    skipped += 1
+                    continue
+                vault.put(name, **fields)
+                added += 1
+        print(f"Imported {added} entries, skipped {skipped} existing.", file=sys.stderr)
+        return added
+    if args.command == "export":
+        fmt = record_format(args.file, args.format)
+        passphrase = None if args.plain else read_secret(args.passphrase_fd, "Export passphrase", confirm=True)
+        with export_writer(args.file, fmt, passphrase) as f:
+            count = write_records(f, ((name, vault.get_record(name)) for name in vault.names()), fmt)
+        print(f"Exported {count} entries.", file=sys.stderr)
+        return 0
+    raise ValueError(f"Unknown command {args.command}")
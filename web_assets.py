@@ -0,0 +1,76 @@
+import os, gzip, hashlib, mimetypes
+from flask import request, Response, abort
+from file_serve import compressible, choose_encoding, zstd, zstandard
+
+# Local copies of the CSS and JavaScript the pages use, for Chatapp.py, speed.py and server.py.
+#
+# Everything in static/ is read once at startup, and text files are compressed then at the
+# highest levels (gzip 9, zstd 19), since it happens only once per process. Templates link
+# to asset_url('name'), which adds a hash of the content: a response for the current hash
+# may be cached for a year and never revalidated, and a changed file gets a new URL. Other
+# requests for the same path get no-cache and a validating ETag.
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+URL_PREFIX = '/static'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+
+def precompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zstd.compress(data, level=ZSTD_LEVEL)
+
+
+class Asset:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.version = hashlib.sha256(self.data).hexdigest()[:16]
+        self.variants = {}  # encoding -> bytes, only where compression pays
+        if compressible(self.mimetype):
+            for encoding in ('zstd', 'gzip') if zstd or zstandard else ('gzip',):
+                packed = precompress(self.data, encoding)
+                if len(packed) < len(self.data):
+                    self.variants[encoding] = packed
+
+
+class AssetBundle:
+    def __init__(self, folder=STATIC_FOLDER, url_prefix=URL_PREFIX):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self.assets = {}
+        for entry in os.scandir(folder):
+            if entry.is_file() and not entry.name.startswith('.'):
+                self.assets[entry.name] = Asset(entry.path)
+
+    def init_app(self, app):
+        # The app must be created with static_folder=None so Flask's own route does not shadow this one
+        app.jinja_env.globals['asset_url'] = self.url
+        app.add_url_rule(f'{self.url_prefix}/<name>', 'asset', self.serve)
+        return self
+
+    def url(self, name):
+        return f'{self.url_prefix}/{name}?v={self.assets[name].version}'
+
+    def serve(self, name):
+        asset = self.assets.get(name)
+        if asset is None:
+            abort(404)
+        headers = {'Cache-Control': IMMUTABLE if request.args.get('v') == asset.version else 'no-cache'}
+        encoding = None
+        if asset.variants:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = choose_encoding()
+            if encoding not in asset.variants:
+                encoding = None
+        etag = f'{asset.version}-{encoding}' if encoding else asset.version
+        headers['ETag'] = f'"{etag}"'
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return Response(asset.variants.get(encoding, asset.data), headers=headers, mimetype=asset.mimetype)
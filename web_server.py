@@ -0,0 +1,128 @@
+import os, sys, time, signal, socket, argparse, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Production server for speed.py and server.py, in place of app.run's development server.
+#
+# Each process handles connections on a fixed pool of threads. When every thread is busy
+# it stops accepting, so further connections wait in the listen backlog instead of each
+# getting a thread of its own. With --workers N the socket is bound once and N copies of
+# the script are started on it (pre-fork); a worker that dies is restarted. Requests go
+# through werkzeug's request handler, so file_serve.py keeps its sendfile path. Every read
+# and write on a connection gives up after --timeout seconds, and bodies larger than
+# --max-body are refused with 413 (Flask's MAX_CONTENT_LENGTH).
+WORKERS = 1
+THREADS = 16
+TIMEOUT = 60
+MAX_BODY = '4G'
+LISTEN_BACKLOG = 1024
+RESTART_DELAY = 1.0
+
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def add_arguments(parser, port):
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--workers', type=int, default=WORKERS, help=f'processes (default {WORKERS})')
+    parser.add_argument('--threads', type=int, default=THREADS, help=f'request threads per process (default {THREADS})')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help=f'seconds a connection may stall on one read or write (default {TIMEOUT})')
+    parser.add_argument('--max-body', type=parse_size, default=parse_size(MAX_BODY), metavar='SIZE',
+                        help=f'largest request body, 0 for no limit (default {MAX_BODY})')
+    parser.add_argument('--dev', action='store_true', help="Flask's development server instead")
+    parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)  # the listening socket, passed to workers
+
+
+class RequestHandler(WSGIRequestHandler):
+    # HTTP/1.1 for chunked streaming responses; werkzeug still closes every connection after one request
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.io_timeout  # StreamRequestHandler applies it to the socket, sendfile included
+        super().setup()
+
+
+class PoolServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, threads=THREADS, timeout=TIMEOUT, fd=None):
+        self.multiprocess = fd is not None
+        self.io_timeout = timeout or None
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='web-server')
+        self.slots = threading.Semaphore(threads)
+        if fd is not None:
+            # Every worker wakes up for a new connection; the ones that lose the race go back to waiting
+            self.socket.setblocking(False)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()  # blocks the accept loop while every thread is busy
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def _stop_on_sigterm(server):
+    # Stop accepting; requests in progress finish before the process exits
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+
+
+def run_workers(host, port, workers):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    command = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:] + ['--fd', str(sock.fileno())]
+
+    def spawn():
+        return subprocess.Popen(command, pass_fds=[sock.fileno()])
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f' * Serving on http://{host}:{port} with {workers} workers', file=sys.stderr)
+    procs = [spawn() for _ in range(workers)]
+    try:
+        while True:
+            time.sleep(RESTART_DELAY)
+            for i, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    print(f' * Worker {proc.pid} exited with status {proc.returncode}, restarting', file=sys.stderr)
+                    procs[i] = spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        sock.close()
+
+
+def serve(app, args):
+    # Runs `app` as add_arguments() configured it
+    app.config['MAX_CONTENT_LENGTH'] = args.max_body or None
+    if args.workers > 1 and args.fd is None:
+        run_workers(args.host, args.port, args.workers)
+        return
+    server = PoolServer(args.host, args.port, app, args.threads, args.timeout, args.fd)
+    if args.fd is None:
+        print(f' * Serving on http://{args.host}:{server.port} with {args.threads} threads', file=sys.stderr)
+    _stop_on_sigterm(server)
+    server.serve_forever()